@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+# attributes of all products in typed arrays for the product criteria
+import array
+import bisect
+import threading
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from lfs.catalog.models import Category, Product
+from lfs.catalog.settings import CHOICES_STANDARD, CHOICES_YES, VARIANT
+
+from lfs_criterion_extra.cart import (get_product_category,
+                                      prefetch_product_categories)
+from lfs_criterion_extra.results import get_version
+
+
+PRODUCT_ATTRIBUTES = getattr(settings, 'CRITERION_PRODUCT_ATTRIBUTES', True)
+
+ATTRIBUTES_ATTR = '_criterion_product_attributes'
+# product fields, which the table is built from
+ATTRIBUTE_FIELDS = ('sub_type', 'parent', 'manufacturer', 'for_sale',
+                    'active_for_sale', 'weight', 'active_dimensions',
+                    'manual_delivery_time')
+
+# attributes of a product, ids are None if the product has none
+ProductRow = namedtuple('ProductRow', 'category_id manufacturer_id for_sale '
+                                     'weight manual_delivery_time')
+
+# the table of this process
+_attributes = None
+_attributes_lock = threading.Lock()
+
+
+class ProductAttributes(object):
+    """First category, manufacturer, for sale flag, weight and manual delivery
+    time flag of all products like ``Product.get_category``,
+    ``get_manufacturer``, ``get_for_sale``, ``get_weight`` and
+    ``get_manual_delivery_time`` return them. Variants are resolved with
+    their parent.
+
+    Columns are typed arrays ordered by product id, a product is found by
+    bisection. Id 0 stands for none.
+    """
+    __slots__ = ('version', 'ids', 'category_ids', 'manufacturer_ids',
+                 'for_sale', 'weights', 'manual_delivery_time')
+
+    def __init__(self, version):
+        self.version = version
+        self.ids = array.array('l')
+        self.category_ids = array.array('l')
+        self.manufacturer_ids = array.array('l')
+        self.for_sale = array.array('b')
+        self.weights = array.array('d')
+        self.manual_delivery_time = array.array('b')
+
+    def __getstate__(self):
+        # arrays are pickled as strings of their items
+        return dict((name, getattr(self, name).tostring()
+                           if name != 'version' else self.version)
+                    for name in self.__slots__)
+
+    def __setstate__(self, state):
+        self.__init__(state['version'])
+        for name in self.__slots__[1:]:
+            getattr(self, name).fromstring(state[name])
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, version):
+        """Returns the table of all products, which is loaded with one query
+        for the products and one for their categories.
+        """
+        attributes = cls(version)
+
+        first_categories = {}
+        for product_id, category_id in Category.objects\
+                .values_list('products', 'id'):
+            # categories are in their default order like get_category uses
+            if product_id is not None:
+                first_categories.setdefault(product_id, category_id)
+
+        rows = Product.objects.order_by('id')\
+                              .values_list('id', 'sub_type', 'parent',
+                                           'manufacturer', 'for_sale',
+                                           'active_for_sale', 'weight',
+                                           'active_dimensions',
+                                           'manual_delivery_time',
+                                           'parent__manufacturer',
+                                           'parent__for_sale',
+                                           'parent__weight',
+                                           'parent__manual_delivery_time')
+        for id, sub_type, parent_id, manufacturer_id, for_sale, \
+                active_for_sale, weight, active_dimensions, manual, \
+                parent_manufacturer_id, parent_for_sale, parent_weight, \
+                parent_manual in rows.iterator():
+            category_id = first_categories.get(id)
+            if sub_type == VARIANT:
+                category_id = first_categories.get(parent_id)
+                manufacturer_id = parent_manufacturer_id
+                if active_for_sale == CHOICES_STANDARD:
+                    for_sale = parent_for_sale
+                else:
+                    for_sale = active_for_sale == CHOICES_YES
+                if not active_dimensions:
+                    weight = parent_weight
+                manual = manual or parent_manual
+
+            attributes.ids.append(id)
+            attributes.category_ids.append(category_id or 0)
+            attributes.manufacturer_ids.append(manufacturer_id or 0)
+            attributes.for_sale.append(bool(for_sale))
+            attributes.weights.append(weight or 0.)
+            attributes.manual_delivery_time.append(bool(manual))
+        return attributes
+
+    def get(self, product_id):
+        """Returns the ``ProductRow`` of the product or None if the product
+        is not in the table.
+        """
+        i = bisect.bisect_left(self.ids, product_id)
+        if i == len(self.ids) or self.ids[i] != product_id:
+            return None
+        return ProductRow(self.category_ids[i] or None,
+                          self.manufacturer_ids[i] or None,
+                          bool(self.for_sale[i]),
+                          self.weights[i],
+                          bool(self.manual_delivery_time[i]))
+
+
+def get_attributes_version_key():
+    return "%s-criterion-product-attributes-version" % (
+               settings.CACHE_MIDDLEWARE_KEY_PREFIX)
+
+
+def get_attributes_cache_key(version):
+    return "%s-criterion-product-attributes-%s" % (
+               settings.CACHE_MIDDLEWARE_KEY_PREFIX, version)
+
+
+def get_product_attributes(request=None):
+    """Returns the attributes table of all products or None with
+    ``CRITERION_PRODUCT_ATTRIBUTES = False``.
+
+    The table is kept in the process and in the cache, so other processes
+    do not load it from the database. It is built again, when the version
+    was changed by ``invalidate_product_attributes`` in any process. The
+    version is checked once per request.
+    """
+    global _attributes
+    if not PRODUCT_ATTRIBUTES:
+        return None
+    if request is not None and ATTRIBUTES_ATTR in request.__dict__:
+        return request.__dict__[ATTRIBUTES_ATTR]
+
+    version = get_version(get_attributes_version_key())
+    attributes = _attributes
+    if attributes is None or attributes.version != version:
+        with _attributes_lock:
+            attributes = _attributes
+            if attributes is None or attributes.version != version:
+                cache_key = get_attributes_cache_key(version)
+                attributes = cache.get(cache_key)
+                if attributes is None:
+                    attributes = ProductAttributes.build(version)
+                    cache.set(cache_key, attributes)
+                _attributes = attributes
+
+    if request is not None:
+        request.__dict__[ATTRIBUTES_ATTR] = attributes
+    return attributes
+
+
+def get_product_rows(request, products):
+    """Returns dict of product id to the ``ProductRow`` of the product.
+
+    Rows are taken from the attributes table, products, which are not in
+    the table yet, are resolved with their parents and categories loaded
+    with one query.
+    """
+    attributes = get_product_attributes(request)
+    rows = {}
+    missing = []
+    for product in products:
+        row = attributes.get(product.id) if attributes is not None else None
+        if row is None:
+            missing.append(product)
+        else:
+            rows[product.id] = row
+
+    if missing:
+        prefetch_product_categories(missing)
+        for product in missing:
+            category = get_product_category(product)
+            owner = product.parent if product.is_variant() else product
+            rows[product.id] = ProductRow(
+                category.id if category is not None else None,
+                owner.manufacturer_id,
+                bool(product.get_for_sale()),
+                product.get_weight() or 0.,
+                product.manual_delivery_time or owner.manual_delivery_time)
+    return rows
+
+
+def get_product_row(request, product):
+    return get_product_rows(request, [product])[product.id]
+
+
+def get_changed_fields(old, product):
+    """Returns the set of fields of the saved product, which are different
+    from the ``old`` dict of field name to value.
+    """
+    changed = set()
+    for name, value in old.items():
+        field = Product._meta.get_field(name)
+        if getattr(product, field.attname) != value:
+            changed.add(name)
+    return changed
+
+
+def invalidate_product_attributes():
+    cache.set(get_attributes_version_key(), uuid.uuid4().hex)
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+# synthetic catalog and timings of the criteria
+import datetime
+import random
+import time
+
+from django import get_version
+from django.contrib.auth.models import AnonymousUser, Group, User
+from django.contrib.sessions.backends.base import SessionBase
+from django.db import connection, reset_queries, transaction
+from django.db.models.fields import FieldDoesNotExist
+from django.test.client import RequestFactory
+
+from lfs.cart.models import Cart, CartItem
+from lfs.catalog.models import Category, Product
+from lfs.criteria.models import CriteriaObjects
+from lfs.criteria.settings import GREATER_THAN, IS, IS_VALID
+from lfs.discounts.models import Discount
+from lfs.manufacturer.models import Manufacturer
+from lfs.order.models import Order, OrderItem
+from lfs.order.settings import CLOSED, SUBMITTED
+from lfs.shipping.models import ShippingMethod
+
+from lfs_criterion_extra.models import (CartAmountCriterion,
+                                        ClockCriterion,
+                                        CompositionCategory,
+                                        CriterionRegistrator,
+                                        DiscountCriterion,
+                                        MultipleValueCriterion,
+                                        NumberCriterion,
+                                        OrderCompositionCriterion,
+                                        OrderStatistics)
+from lfs_criterion_extra.monkey import save_criteria
+from lfs_criterion_extra.rendering import render_criteria
+
+
+BATCH_SIZE = 500
+# related objects of every multiple value criterion
+VALUES_PER_CRITERION = 10
+
+
+def percentile(values, percent):
+    """Returns the percentile of the sorted values (nearest rank).
+    """
+    if not values:
+        return None
+    index = int(round(percent / 100. * len(values) + 0.5)) - 1
+    return values[max(0, min(index, len(values) - 1))]
+
+
+class Benchmark(object):
+    """Seeds a synthetic catalog, order histories and carts and times
+    every criterion of ``lfs_criterion_extra.models`` in cart and product
+    mode, ``as_html`` and ``save_criteria``.
+
+    The data is written to the current database, so run it within a test
+    database (see ``criterion_benchmark`` command).
+    """
+
+    def __init__(self, products=10000, category_depth=3,
+                 category_children=5, manufacturers=50, customers=100,
+                 orders=1000, cart_sizes=(1, 10, 100), iterations=20,
+                 seed=0, log=None):
+        self.products = products
+        self.category_depth = category_depth
+        self.category_children = category_children
+        self.manufacturers = manufacturers
+        self.customers = customers
+        self.orders = orders
+        self.cart_sizes = [size for size in cart_sizes if size <= products]
+        self.iterations = iterations
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.log = log or (lambda message: None)
+
+    def run(self):
+        """Returns the results as dict, which may be dumped as json.
+        """
+        use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+        try:
+            self.seed_data()
+            results = []
+            results.extend(self.time_is_valid())
+            results.extend(self.time_as_html())
+            results.extend(self.time_save_criteria())
+        finally:
+            connection.use_debug_cursor = use_debug_cursor
+            reset_queries()
+
+        return {
+            "meta": {
+                "created": datetime.datetime.now().isoformat(),
+                "django": get_version(),
+                "database": connection.vendor,
+                "products": self.products,
+                "categories": len(self.category_ids),
+                "category_depth": self.category_depth,
+                "manufacturers": self.manufacturers,
+                "customers": self.customers,
+                "orders": self.orders,
+                "cart_sizes": self.cart_sizes,
+                "iterations": self.iterations,
+                "seed": self.seed,
+            },
+            "results": results,
+        }
+
+    # Data
+    def seed_data(self):
+        self.log("seeding catalog")
+        self.seed_catalog()
+        self.log("seeding orders")
+        self.seed_orders()
+        self.log("seeding carts")
+        self.seed_carts()
+        self.log("creating criteria")
+        self.criteria = self.create_criteria()
+
+    def seed_catalog(self):
+        Manufacturer.objects.bulk_create(
+            [Manufacturer(name="m%s" % i) for i in range(self.manufacturers)],
+            batch_size=BATCH_SIZE)
+        manufacturer_ids = list(Manufacturer.objects.values_list('id',
+                                                                 flat=True))
+
+        self.category_ids = []
+        parent_ids = [None]
+        for level in range(self.category_depth):
+            categories = []
+            for i, parent_id in enumerate(parent_ids):
+                for j in range(self.category_children):
+                    slug = "c%s-%s-%s" % (level, i, j)
+                    categories.append(Category(name=slug, slug=slug,
+                                               parent_id=parent_id))
+            Category.objects.bulk_create(categories, batch_size=BATCH_SIZE)
+            parent_ids = list(Category.objects.filter(
+                                  slug__startswith="c%s-" % level)
+                                      .values_list('id', flat=True))
+            self.category_ids.extend(parent_ids)
+        self.leaf_category_ids = parent_ids
+
+        products = []
+        for i in range(self.products):
+            price = self.random.uniform(1, 1000)
+            products.append(Product(
+                name="p%s" % i, slug="p%s" % i, sku="p%s" % i, active=True,
+                # bulk_create does not call Product.save
+                price=price, effective_price=price,
+                weight=self.random.uniform(0, 50),
+                manufacturer_id=self.random.choice(manufacturer_ids)
+                    if manufacturer_ids else None))
+        Product.objects.bulk_create(products, batch_size=BATCH_SIZE)
+        self.product_ids = list(Product.objects.values_list('id', flat=True))
+
+        if self.leaf_category_ids:
+            through = Category.products.through
+            through.objects.bulk_create([
+                through(category_id=self.random.choice(self.leaf_category_ids),
+                        product_id=product_id)
+                for product_id in self.product_ids], batch_size=BATCH_SIZE)
+
+        Group.objects.bulk_create([Group(name="g%s" % i) for i in range(10)])
+        User.objects.bulk_create([User(username="u%s" % i) for i in range(10)])
+
+    def seed_orders(self):
+        sessions = (["benchmark-cart-%s" % size for size in self.cart_sizes] +
+                    ["benchmark-customer-%s" % i
+                     for i in range(self.customers)])
+        Order.objects.bulk_create([
+            Order(session=self.random.choice(sessions),
+                  state=CLOSED if self.random.random() < 0.8 else SUBMITTED,
+                  price=self.random.uniform(10, 1000))
+            for i in range(self.orders)], batch_size=BATCH_SIZE)
+
+        items = []
+        for order_id in Order.objects.values_list('id', flat=True):
+            for product_id in self.random.sample(
+                    self.product_ids, min(self.random.randint(1, 5),
+                                          len(self.product_ids))):
+                items.append(OrderItem(order_id=order_id,
+                                       product_id=product_id,
+                                       product_amount=1))
+        OrderItem.objects.bulk_create(items, batch_size=BATCH_SIZE)
+        OrderStatistics.objects.rebuild(batch_size=BATCH_SIZE)
+
+    def seed_carts(self):
+        self.carts = {}
+        for size in self.cart_sizes:
+            cart = Cart.objects.create(session="benchmark-cart-%s" % size)
+            CartItem.objects.bulk_create([
+                CartItem(cart=cart, product_id=product_id,
+                         amount=self.random.randint(1, 3))
+                for product_id in self.random.sample(self.product_ids, size)],
+                batch_size=BATCH_SIZE)
+            self.carts[size] = cart
+
+    def get_request(self, size, method='get', data=None):
+        """Returns a new request of the customer of the cart with given size.
+        """
+        request = getattr(RequestFactory(), method)('/', data or {})
+        request.session = SessionBase("benchmark-cart-%s" % size)
+        request.user = AnonymousUser()
+        return request
+
+    def create_criteria(self):
+        """Returns one criterion of every type of ``models.py``.
+        """
+        criteria = []
+        for content_type, criterion_type in sorted(
+                CriterionRegistrator.types.items()):
+            if criterion_type.__module__ == 'lfs_criterion_extra.models':
+                criteria.append(self.create_criterion(criterion_type))
+        return criteria
+
+    def create_criterion(self, criterion_type):
+        if issubclass(criterion_type, DiscountCriterion):
+            return self.create_discount_criterion()
+
+        criterion = criterion_type()
+        try:
+            criterion._meta.get_field('operator')
+        except FieldDoesNotExist:
+            pass
+        else:
+            if issubclass(criterion_type, NumberCriterion):
+                criterion.operator = GREATER_THAN
+            else:
+                criterion.operator = IS
+
+        if issubclass(criterion_type, NumberCriterion):
+            if not issubclass(criterion_type, ClockCriterion):
+                criterion.value = 0
+            criterion.save()
+
+        elif issubclass(criterion_type, OrderCompositionCriterion):
+            criterion.save()
+            for category_id in self.random.sample(self.leaf_category_ids,
+                    min(2, len(self.leaf_category_ids))):
+                CompositionCategory.objects.create(criterion=criterion,
+                                                   category_id=category_id)
+
+        elif issubclass(criterion_type, MultipleValueCriterion):
+            criterion.save()
+            model = criterion._meta.get_field(criterion.value_attr).rel.to
+            ids = list(model.objects.values_list('id', flat=True)[:1000])
+            criterion.value = self.random.sample(
+                ids, min(VALUES_PER_CRITERION, len(ids)))
+
+        else:
+            criterion.save()
+        return criterion
+
+    def create_discount_criterion(self):
+        owner = Discount.objects.create(name="benchmark", value=1)
+        criterion = DiscountCriterion.objects.create(operator=IS_VALID)
+        CriteriaObjects.objects.create(content=owner, criterion=criterion)
+        for i in range(3):
+            discount = Discount.objects.create(name="d%s" % i, value=1)
+            amount = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                                        amount=i)
+            CriteriaObjects.objects.create(content=discount, criterion=amount)
+            criterion.discounts.add(discount)
+        return criterion
+
+    # Timings
+    def measure(self, name, func, setup=None, **params):
+        """Calls func with the arguments returned by setup once to warm up
+        caches and then ``iterations`` times. Returns dict of latency
+        percentiles and query counts.
+        """
+        result = {"name": name}
+        result.update(params)
+
+        samples = []
+        try:
+            for i in range(self.iterations + 1):
+                args = setup() if setup is not None else ()
+                reset_queries()
+                start = time.time()
+                func(*args)
+                seconds = time.time() - start
+                if i:
+                    samples.append((seconds, len(connection.queries)))
+        except Exception as e:
+            transaction.rollback_unless_managed()
+            result["error"] = "%s: %s" % (e.__class__.__name__, e)
+            return result
+
+        times = sorted(seconds * 1000 for seconds, queries in samples)
+        queries = [queries for seconds, queries in samples]
+        result.update({
+            "iterations": len(samples),
+            "p50_ms": percentile(times, 50),
+            "p90_ms": percentile(times, 90),
+            "p99_ms": percentile(times, 99),
+            "max_ms": times[-1] if times else None,
+            "mean_queries": float(sum(queries)) / len(queries)
+                if queries else None,
+            "max_queries": max(queries) if queries else None,
+        })
+        return result
+
+    def time_is_valid(self):
+        results = []
+        for size in self.cart_sizes:
+            product = self.carts[size].items()[0].product
+            for criterion in self.criteria:
+                self.log("is_valid %s, cart of %s" % (criterion.content_type,
+                                                      size))
+                for mode, mode_product in (("cart", None),
+                                           ("product", product)):
+                    results.append(self.measure(
+                        "is_valid", criterion.is_valid,
+                        lambda: (self.get_request(size), mode_product),
+                        criterion=criterion.content_type,
+                        mode=mode, cart_size=size))
+        return results
+
+    def time_as_html(self):
+        results = []
+        size = self.cart_sizes[0] if self.cart_sizes else 0
+        for criterion in self.criteria:
+            self.log("as_html %s" % criterion.content_type)
+            results.append(self.measure(
+                "as_html", criterion.as_html,
+                lambda: (self.get_request(size), 1),
+                criterion=criterion.content_type))
+
+        # the criteria tab of an object with all benchmark criteria
+        shipping_method = ShippingMethod.objects.create(name="tab")
+        for position, criterion in enumerate(self.criteria):
+            CriteriaObjects.objects.create(content=shipping_method,
+                                           criterion=criterion,
+                                           position=position)
+        self.log("render_criteria")
+        results.append(self.measure(
+            "render_criteria", render_criteria,
+            lambda: (self.get_request(size), shipping_method),
+            criteria=len(self.criteria)))
+        return results
+
+    def get_criteria_data(self, ids):
+        """Returns the request body, which saves the benchmark criteria with
+        given form ids.
+        """
+        data = {}
+        for position, (criterion, id) in enumerate(zip(self.criteria, ids)):
+            if isinstance(criterion, OrderCompositionCriterion):
+                continue
+            data["type-%s" % id] = criterion.content_type
+            data["operator-%s" % id] = criterion.operator or ""
+            data["position-%s" % id] = position
+            if isinstance(criterion, MultipleValueCriterion):
+                data["value-%s" % id] = [str(pk)
+                                         for pk in criterion.get_value_ids()]
+            elif isinstance(criterion, ClockCriterion):
+                data["value-%s" % id] = unicode(criterion.value)
+            elif isinstance(criterion, DiscountCriterion):
+                data["value-%s" % id] = [
+                    str(pk) for pk in criterion.discounts.values_list(
+                                          'pk', flat=True)]
+            else:
+                data["value-%s" % id] = "0"
+        return data
+
+    def time_save_criteria(self):
+        self.log("save_criteria")
+        size = self.cart_sizes[0] if self.cart_sizes else 0
+
+        # new criteria replace the old ones on every save
+        shipping_method = ShippingMethod.objects.create(name="replace")
+
+        def get_new_data():
+            now = int(time.time() * 1000000)
+            return self.get_criteria_data(["ex%s%s" % (now, i)
+                                           for i in range(len(self.criteria))])
+
+        results = [self.measure(
+            "save_criteria", save_criteria,
+            lambda: (self.get_request(size, 'post', get_new_data()),
+                     shipping_method),
+            scenario="replace", criteria=len(self.criteria))]
+
+        # the benchmark criteria are saved without changes
+        shipping_method = ShippingMethod.objects.create(name="unchanged")
+        for position, criterion in enumerate(self.criteria):
+            if not isinstance(criterion, OrderCompositionCriterion):
+                CriteriaObjects.objects.create(content=shipping_method,
+                                               criterion=criterion,
+                                               position=position)
+        # form ids like lfs criteria use, the ids of the criteria of
+        # different types are equal
+        data = self.get_criteria_data(["%s%s" % (criterion.content_type,
+                                                 criterion.pk)
+                                       for criterion in self.criteria])
+        results.append(self.measure(
+            "save_criteria", save_criteria,
+            lambda: (self.get_request(size, 'post', data), shipping_method),
+            scenario="unchanged", criteria=len(self.criteria)))
+        return results
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# sets of ids packed into bits for criteria with huge value lists
+import zlib
+
+
+# bitmap bytes per id, up to which ids are packed into a bitmap; sparse ids
+# take less memory in a frozenset
+BITMAP_BYTES_PER_ID = 8
+
+
+class IdBitmap(object):
+    """Immutable set of non-negative integer ids, one bit per id from the
+    smallest to the largest id.
+
+    Membership is a bit test, ``isdisjoint`` tests the bits of the (small)
+    other set. Bitmaps are pickled zlib compressed, so they take little
+    space in the cache.
+    """
+    __slots__ = ('base', 'bits', 'count')
+
+    def __init__(self, ids=()):
+        ids = sorted(set(ids))
+        self.count = len(ids)
+        # the first bit is aligned to a byte
+        self.base = ids[0] & ~7 if ids else 0
+        bits = bytearray(((ids[-1] - self.base) >> 3) + 1 if ids else 0)
+        for id in ids:
+            offset = id - self.base
+            bits[offset >> 3] |= 1 << (offset & 7)
+        self.bits = bits
+
+    def __getstate__(self):
+        return (self.base, self.count, zlib.compress(bytes(self.bits)))
+
+    def __setstate__(self, state):
+        self.base, self.count, bits = state
+        self.bits = bytearray(zlib.decompress(bits))
+
+    def __contains__(self, id):
+        offset = id - self.base
+        if offset < 0:
+            return False
+        i = offset >> 3
+        return i < len(self.bits) and bool(self.bits[i] & (1 << (offset & 7)))
+
+    def __iter__(self):
+        for i, byte in enumerate(self.bits):
+            if byte:
+                for bit in range(8):
+                    if byte & (1 << bit):
+                        yield self.base + (i << 3) + bit
+
+    def __len__(self):
+        return self.count
+
+    def __eq__(self, other):
+        if isinstance(other, IdBitmap):
+            return self.base == other.base and self.bits == other.bits
+        if isinstance(other, (set, frozenset)):
+            return len(other) == self.count and all(id in self
+                                                    for id in other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        result = self.__eq__(other)
+        if result is NotImplemented:
+            return result
+        return not result
+
+    def __hash__(self):
+        return hash((self.base, bytes(self.bits)))
+
+    def __repr__(self):
+        return "IdBitmap(%s ids from %s)" % (self.count, self.base)
+
+    def isdisjoint(self, ids):
+        for id in ids:
+            if id in self:
+                return False
+        return True
+
+
+def get_id_set(ids):
+    """Returns the given ids as ``IdBitmap`` or, if they are too sparse for
+    a bitmap, as frozenset.
+    """
+    ids = frozenset(ids)
+    if not ids:
+        return ids
+    size = (max(ids) - (min(ids) & ~7)) >> 3
+    if size > BITMAP_BYTES_PER_ID * len(ids):
+        return ids
+    return IdBitmap(ids)
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+# cart snapshot shared by the cart-based criteria
+from django.db.models.query import prefetch_related_objects
+from django.utils.functional import cached_property
+
+from lfs.cart.models import CartItem
+from lfs.cart.utils import get_cart
+from lfs.core.signals import cart_changed
+
+from lfs_criterion_extra.categories import get_category_tree_ids
+
+
+SNAPSHOT_ATTR = '_criterion_cart_snapshot'
+
+
+class CartSnapshot(object):
+    """In-memory copy of the cart items of the current request.
+
+    Items are loaded once together with their products (and parents for
+    variants), manufacturers and categories. Every cart criterion reads
+    from the snapshot instead of querying ``cart.items()`` again. Totals
+    (amount, weight, product ids, category amounts and manufacturers) are
+    read from the ``CartAggregate`` of the cart without loading the items.
+    """
+
+    def __init__(self, cart):
+        self.cart = cart
+        self.cart_id = cart.id if cart is not None else None
+        # values computed by criteria from the snapshot
+        self.memo = {}
+
+    @cached_property
+    def items(self):
+        if self.cart is None:
+            return []
+        # the same items as ``Cart.get_items`` returns
+        items = CartItem.objects.filter(cart=self.cart, product__active=True)
+        items = items.select_related('product',
+                                     'product__manufacturer',
+                                     'product__parent',
+                                     'product__parent__manufacturer')
+        items = items.prefetch_related('product__categories',
+                                       'product__parent__categories')
+        return list(items)
+
+    @cached_property
+    def aggregate(self):
+        from lfs_criterion_extra.models import CartAggregate
+        if self.cart is None:
+            return CartAggregate()
+        return CartAggregate.objects.get_for_cart(self.cart)
+
+    def is_empty(self):
+        if 'items' in self.__dict__:
+            return not self.items
+        return not self.aggregate.item_count
+
+    @cached_property
+    def products(self):
+        """Returns the distinct products of the cart.
+        """
+        products = []
+        seen = set()
+        for item in self.items:
+            if item.product_id not in seen:
+                seen.add(item.product_id)
+                products.append(item.product)
+        return products
+
+    @cached_property
+    def product_ids(self):
+        return frozenset(self.product_amounts)
+
+    @cached_property
+    def product_amounts(self):
+        """Returns dict of product id to the amount of the product in cart.
+        """
+        return self.aggregate.product_amounts
+
+    @cached_property
+    def categories(self):
+        """Returns the set of first categories (see
+        ``Product.get_category``) of the products in the cart.
+        """
+        categories = set()
+        for product in self.products:
+            categories.add(get_product_category(product))
+        categories.discard(None)
+        return categories
+
+    @cached_property
+    def category_ids(self):
+        return frozenset(category.id for category in self.categories)
+
+    @cached_property
+    def category_tree_ids(self):
+        """Returns ids of the categories of the cart and all their parents.
+        """
+        return frozenset(get_category_tree_ids(self.category_ids))
+
+    @cached_property
+    def category_amounts(self):
+        """Returns dict of category id to the amount of the cart items in
+        this category. Variants are counted in categories of their parent.
+        """
+        return self.aggregate.category_amounts
+
+    @cached_property
+    def manufacturers(self):
+        manufacturers = set()
+        for product in self.products:
+            manufacturers.add(product.get_manufacturer())
+        manufacturers.discard(None)
+        return manufacturers
+
+    @cached_property
+    def manufacturer_ids(self):
+        return self.aggregate.manufacturer_ids
+
+    @cached_property
+    def amount(self):
+        return self.aggregate.amount
+
+    @cached_property
+    def max_weight(self):
+        return self.aggregate.max_weight
+
+    @cached_property
+    def total_weight(self):
+        return self.aggregate.total_weight
+
+    @cached_property
+    def for_sale(self):
+        return any(product.get_for_sale() for product in self.products)
+
+    @cached_property
+    def manual_delivery_time(self):
+        return any(product.manual_delivery_time for product in self.products)
+
+
+def get_product_category(product):
+    """Returns the first category of the product like
+    ``Product.get_category`` does, but uses prefetched categories.
+    """
+    if product.is_variant():
+        product = product.parent
+    categories = product.categories.all()
+    for category in categories:
+        return category
+    return None
+
+
+def prefetch_product_parents(products):
+    """Loads the parents of the given variants with one query.
+    """
+    variants = [product for product in products
+                if product.parent_id is not None]
+    if not variants:
+        return
+
+    cache_name = variants[0]._meta.get_field('parent').get_cache_name()
+    variants = [product for product in variants
+                if not hasattr(product, cache_name)]
+    parents = type(variants[0]).objects.in_bulk(
+                  set(product.parent_id for product in variants)) \
+              if variants else {}
+    for product in variants:
+        if product.parent_id in parents:
+            setattr(product, cache_name, parents[product.parent_id])
+
+
+def prefetch_product_categories(products):
+    """Loads the categories of the given products (of the parents for
+    variants) with one query, so ``get_product_category`` does not query
+    per product.
+    """
+    prefetch_product_parents(products)
+    parents = []
+    for product in products:
+        if product.is_variant():
+            product = product.parent
+        prefetched = getattr(product, '_prefetched_objects_cache', {})
+        if 'categories' not in prefetched:
+            parents.append(product)
+    prefetch_related_objects(parents, ['categories'])
+
+
+def get_cart_snapshot(request):
+    """Returns the cart snapshot of the current request.
+
+    The snapshot is created on first access and dropped when the cart
+    changes (see ``cart_changed_listener``).
+    """
+    cart = get_cart(request)
+    cart_id = cart.id if cart is not None else None
+
+    snapshot = getattr(request, SNAPSHOT_ATTR, None)
+    if snapshot is None or snapshot.cart_id != cart_id:
+        snapshot = CartSnapshot(cart)
+        setattr(request, SNAPSHOT_ATTR, snapshot)
+    return snapshot
+
+
+def clear_cart_snapshot(request):
+    if hasattr(request, SNAPSHOT_ATTR):
+        delattr(request, SNAPSHOT_ATTR)
+
+
+def cart_changed_listener(sender, **kwargs):
+    request = kwargs.get('request')
+    if request is not None:
+        clear_cart_snapshot(request)
+cart_changed.connect(cart_changed_listener)
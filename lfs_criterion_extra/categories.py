@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+# precomputed index of the category tree
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from lfs.catalog.models import Category
+
+
+_category_tree = {}
+
+
+def get_category_tree_version_key():
+    return "%s-criterion-category-tree-version" % (
+               settings.CACHE_MIDDLEWARE_KEY_PREFIX)
+
+
+def get_category_ancestors():
+    """Returns dict of category id to frozenset of ids of the category
+    and all its parents.
+
+    The index is built with one query and kept in the process. It is rebuilt
+    after ``invalidate_category_tree`` was called in any process.
+    """
+    version_key = get_category_tree_version_key()
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex)
+        version = cache.get(version_key)
+
+    if _category_tree.get('version') == version:
+        return _category_tree['ancestors']
+
+    parents = dict(Category.objects.values_list('id', 'parent'))
+    ancestors = {}
+    for id in parents:
+        path = []
+        parent = id
+        while parent is not None and parent not in ancestors:
+            if parent in path:
+                # broken tree, stop at the loop
+                break
+            path.append(parent)
+            parent = parents.get(parent)
+
+        known = ancestors.get(parent, frozenset())
+        for category_id in reversed(path):
+            known = known.union([category_id])
+            ancestors[category_id] = known
+
+    _category_tree['version'] = version
+    _category_tree['ancestors'] = ancestors
+    return ancestors
+
+
+def get_category_tree_ids(category_ids):
+    """Returns set of ids of the given categories and all their parents.
+    """
+    ancestors = get_category_ancestors()
+    tree_ids = set()
+    for id in category_ids:
+        tree_ids.update(ancestors.get(id, (id,)))
+    return tree_ids
+
+
+def invalidate_category_tree():
+    _category_tree.clear()
+    cache.set(get_category_tree_version_key(), uuid.uuid4().hex)
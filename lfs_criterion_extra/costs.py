@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# evaluation order of the criteria by cost and rejection rate
+import random
+import threading
+
+from django.conf import settings
+
+
+# static cost classes of the criteria, see ``Criterion.cost``
+COST_REQUEST = 1    # request and user only
+COST_CART = 2       # cart snapshot
+COST_QUERY = 3      # own queries
+COST_RECURSIVE = 4  # criteria of other objects
+
+COST_ORDERING = getattr(settings, 'CRITERION_COST_ORDERING', False)
+COST_SAMPLE_RATE = getattr(settings, 'CRITERION_COST_SAMPLE_RATE', 0.01)
+# samples of a criterion type, which are needed to use measured values
+COST_MIN_SAMPLES = 20
+
+# criterion type to [samples, seconds, rejections]
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_cost_class(criterion_type):
+    return getattr(criterion_type, 'cost', COST_QUERY)
+
+
+def should_sample():
+    return random.random() < COST_SAMPLE_RATE
+
+
+def add_sample(criterion_type, seconds, rejected):
+    with _stats_lock:
+        stats = _stats.setdefault(criterion_type, [0, 0., 0])
+        stats[0] += 1
+        stats[1] += seconds
+        if rejected:
+            stats[2] += 1
+
+
+def get_stats():
+    """Returns dict of criterion type to (samples, mean seconds, rejection
+    rate).
+    """
+    with _stats_lock:
+        return dict((criterion_type, (samples, seconds / samples,
+                                      float(rejections) / samples))
+                    for criterion_type, (samples, seconds, rejections)
+                    in _stats.items() if samples)
+
+
+def clear_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def get_cost_key(criterion_type, stats=None):
+    """Returns the sort key of the criterion type.
+
+    Criteria are ordered by their static cost class and, within the class,
+    by measured seconds per rejection: cheap criteria, which reject often,
+    come first. Types with less than ``COST_MIN_SAMPLES`` samples go first
+    within the class.
+    """
+    if stats is None:
+        stats = get_stats()
+    score = 0.
+    if criterion_type in stats:
+        samples, seconds, rejection_rate = stats[criterion_type]
+        if samples >= COST_MIN_SAMPLES:
+            score = seconds / max(rejection_rate, 1. / samples)
+    return (get_cost_class(criterion_type), score)
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# dependencies between discounts via DiscountCriterion
+from django.contrib.contenttypes.models import ContentType
+from django.core.exceptions import ValidationError
+from django.utils.translation import ugettext_lazy as _
+
+import lfs.criteria.utils
+from lfs.criteria.models.criteria_objects import CriteriaObjects
+from lfs.discounts.models import Discount
+
+from lfs_criterion_extra.models import DiscountCriterion
+
+
+MEMO_ATTR = '_criterion_discounts'
+
+
+def get_discount_graph():
+    """Returns dict of discount id to set of ids of discounts, which are
+    checked by discount criteria of this discount.
+    """
+    criteria_objects = CriteriaObjects.objects.filter(
+        content_type=ContentType.objects.get_for_model(Discount),
+        criterion_type=ContentType.objects.get_for_model(DiscountCriterion))
+    owners = dict((criterion_id, discount_id)
+                  for discount_id, criterion_id
+                  in criteria_objects.values_list('content_id',
+                                                  'criterion_id'))
+
+    graph = {}
+    relations = DiscountCriterion.discounts.through.objects.filter(
+                    discountcriterion__in=owners.keys())
+    for criterion_id, discount_id in relations.values_list('discountcriterion',
+                                                           'discount'):
+        graph.setdefault(owners[criterion_id], set()).add(discount_id)
+    return graph
+
+
+def find_cycle(graph, start):
+    """Returns list of discount ids of a dependency cycle, which is
+    reachable from the start discount, or None.
+    """
+    path = []
+    on_path = set()
+    done = set()
+
+    def visit(id):
+        path.append(id)
+        on_path.add(id)
+        for dependency in graph.get(id, ()):
+            if dependency in on_path:
+                return path[path.index(dependency):] + [dependency]
+            if dependency not in done:
+                cycle = visit(dependency)
+                if cycle:
+                    return cycle
+        path.pop()
+        on_path.discard(id)
+        done.add(id)
+        return None
+
+    return visit(start)
+
+
+def check_discount_dependencies(discount, discount_ids):
+    """Raises ValidationError if the discount, which criteria check the
+    discounts with given ids, would depend on itself.
+    """
+    graph = get_discount_graph()
+    graph[discount.id] = set(int(id) for id in discount_ids)
+
+    cycle = find_cycle(graph, discount.id)
+    if cycle:
+        names = dict(Discount.objects.filter(id__in=cycle)
+                                     .values_list('id', 'name'))
+        raise ValidationError(
+            _(u"Discount criteria have a cycle: %s") %
+                u" -> ".join(names.get(id, unicode(id)) for id in cycle))
+
+
+def sort_discounts(discounts, graph=None):
+    """Returns the discounts ordered such that every discount follows the
+    discounts it depends on. Discounts within a cycle keep their order at
+    the end.
+    """
+    if graph is None:
+        graph = get_discount_graph()
+
+    discounts = list(discounts)
+    ids = set(discount.id for discount in discounts)
+    dependencies = dict((discount.id, graph.get(discount.id, set()) & ids)
+                        for discount in discounts)
+
+    result = []
+    sorted_ids = set()
+    while len(result) < len(discounts):
+        ready = [discount for discount in discounts
+                 if discount.id not in sorted_ids and
+                    dependencies[discount.id] <= sorted_ids]
+        if not ready:
+            break
+        result.extend(ready)
+        sorted_ids.update(discount.id for discount in ready)
+
+    result.extend(discount for discount in discounts
+                  if discount.id not in sorted_ids)
+    return result
+
+
+def is_discount_valid(request, discount, product=None):
+    """Returns True if the discount is valid.
+
+    Results are memoized on the request per discount and product, so every
+    discount is computed once per request however many discount criteria
+    refer to it. A discount, which depends on itself, is not valid.
+    """
+    memo = request.__dict__.setdefault(MEMO_ATTR, {})
+    key = (discount.id, product.id if product is not None else None)
+    if key not in memo:
+        # guard against cycles, which were saved before the check
+        memo[key] = False
+        memo[key] = lfs.criteria.utils.is_valid(request, discount, product)
+    return memo[key]
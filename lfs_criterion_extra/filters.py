@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# objects with criteria filtered by their criteria in the database
+import operator
+
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+
+import lfs.criteria.utils
+from lfs.criteria.models.criteria_objects import CriteriaObjects
+
+from lfs_criterion_extra.models import CriterionRegistrator
+
+
+def get_compiled_types():
+    """Returns the registered criterion types, which provide ``get_q``.
+    """
+    return [criterion_type
+            for content_type, criterion_type
+            in sorted(CriterionRegistrator.types.items())
+            if getattr(criterion_type, 'get_q', None) is not None]
+
+
+def exclude_invalid(request, queryset):
+    """Returns the queryset of objects with criteria (e.g. discounts)
+    without objects, which have a criterion, which is not valid for the
+    request without product.
+
+    Only criteria, which provide ``get_q``, are checked, all of them within
+    one query. Other criteria of the remaining objects are not evaluated.
+    """
+    invalid = []
+    for criterion_type in get_compiled_types():
+        # negated on the ids, excluding by the Q itself would lose criteria
+        # with null operator
+        valid = criterion_type.objects.filter(criterion_type.get_q(request))
+        invalid.append(Q(criterion_type=ContentType.objects.get_for_model(
+                                            criterion_type)) &
+                       ~Q(criterion_id__in=valid.values('pk')))
+    if not invalid:
+        return queryset
+
+    content_type = ContentType.objects.get_for_model(queryset.model)
+    rejected = CriteriaObjects.objects.filter(content_type=content_type)\
+                                      .filter(reduce(operator.or_, invalid))
+    return queryset.exclude(pk__in=rejected.values('content_id'))
+
+
+def get_valid_objects(request, queryset):
+    """Returns list of the valid objects of the queryset for the request
+    without product, like ``lfs.criteria.utils.is_valid`` of every object.
+
+    Objects are filtered by the compiled criteria in the database first, the
+    criteria of the remaining objects, which can not be compiled, are
+    evaluated in python.
+    """
+    candidates = list(exclude_invalid(request, queryset))
+    if not candidates:
+        return []
+
+    content_type = ContentType.objects.get_for_model(queryset.model)
+    compiled = [ContentType.objects.get_for_model(criterion_type).id
+                for criterion_type in get_compiled_types()]
+    uncompiled = set(CriteriaObjects.objects.filter(
+                         content_type=content_type,
+                         content_id__in=[object.pk for object in candidates])
+                     .exclude(criterion_type__in=compiled)
+                     .values_list('content_id', flat=True))
+
+    valid = lfs.criteria.utils.is_valid_batch(
+                request, [object for object in candidates
+                          if object.pk in uncompiled])
+    return [object for object in candidates
+            if object.pk not in uncompiled or valid[object]]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+# group memberships of the current user shared by the group criteria
+from django.conf import settings
+from django.core.cache import cache
+
+
+GROUPS_ATTR = '_criterion_user_group_ids'
+# keep group ids of the users in the cache between requests
+USER_GROUPS_CACHE = getattr(settings, 'CRITERION_USER_GROUPS_CACHE', True)
+
+
+def get_user_groups_cache_key(user_id):
+    return "%s-criterion-user-groups-%s" % (
+               settings.CACHE_MIDDLEWARE_KEY_PREFIX, user_id)
+
+
+def get_user_group_ids(request):
+    """Returns frozenset of ids of the groups of the current user.
+
+    The set is resolved once per request and, with
+    ``CRITERION_USER_GROUPS_CACHE``, kept in the cache until the groups of
+    the user change. Anonymous users have no groups.
+    """
+    group_ids = request.__dict__.get(GROUPS_ATTR)
+    if group_ids is not None:
+        return group_ids
+
+    user = request.user
+    if user.is_anonymous():
+        group_ids = frozenset()
+    else:
+        cache_key = get_user_groups_cache_key(user.id)
+        group_ids = cache.get(cache_key) if USER_GROUPS_CACHE else None
+        if group_ids is None:
+            group_ids = frozenset(user.groups.values_list('id', flat=True))
+            if USER_GROUPS_CACHE:
+                cache.set(cache_key, group_ids)
+
+    request.__dict__[GROUPS_ATTR] = group_ids
+    return group_ids
+
+
+def invalidate_user_groups(user_ids):
+    cache.delete_many([get_user_groups_cache_key(user_id)
+                       for user_id in user_ids])
+
@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+# timing and query counts of the criteria
+import logging
+import socket
+import threading
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection
+from django.utils.importlib import import_module
+
+
+INSTRUMENTATION = getattr(settings, 'CRITERION_INSTRUMENTATION', False)
+SINKS = getattr(settings, 'CRITERION_INSTRUMENTATION_SINKS',
+                ('lfs_criterion_extra.instrumentation.LoggingSink',))
+# upper bounds of the histogram buckets in milliseconds
+HISTOGRAM_BUCKETS = (1, 5, 10, 50, 100, 500, 1000)
+
+logger = logging.getLogger('lfs_criterion_extra.instrumentation')
+
+_local = threading.local()
+_sinks = []
+
+
+class Measurement(object):
+    """Single call of ``is_valid`` or ``as_html`` of a criterion.
+
+    Time, queries and cache hits include nested criteria, e.g. criteria of
+    the discounts checked by a discount criterion.
+    """
+    __slots__ = ('content_type', 'criterion_id', 'method', 'seconds',
+                 'queries', 'cache_hits', 'cache_misses')
+
+    def __init__(self, content_type, criterion_id, method):
+        self.content_type = content_type
+        self.criterion_id = criterion_id
+        self.method = method
+        self.seconds = 0.
+        self.queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+
+class Histogram(object):
+    """Aggregated measurements of a criterion method.
+    """
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.
+        self.max_seconds = 0.
+        self.queries = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        # the last bucket counts calls above all bounds
+        self.buckets = [0] * (len(HISTOGRAM_BUCKETS) + 1)
+
+    def add(self, measurement):
+        self.calls += 1
+        self.seconds += measurement.seconds
+        self.max_seconds = max(self.max_seconds, measurement.seconds)
+        self.queries += measurement.queries
+        self.cache_hits += measurement.cache_hits
+        self.cache_misses += measurement.cache_misses
+
+        milliseconds = measurement.seconds * 1000
+        for i, bound in enumerate(HISTOGRAM_BUCKETS):
+            if milliseconds <= bound:
+                break
+        else:
+            i = len(HISTOGRAM_BUCKETS)
+        self.buckets[i] += 1
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.max_seconds = max(self.max_seconds, other.max_seconds)
+        self.queries += other.queries
+        self.cache_hits += other.cache_hits
+        self.cache_misses += other.cache_misses
+        self.buckets = [a + b for a, b in zip(self.buckets, other.buckets)]
+
+
+class Sink(object):
+    """Receives the measurements.
+    """
+
+    def record(self, measurement):
+        raise NotImplementedError()
+
+
+class LoggingSink(Sink):
+
+    def record(self, measurement):
+        logger.info("%s #%s %s: %.2f ms, %s queries, %s/%s cache hits",
+                    measurement.content_type, measurement.criterion_id,
+                    measurement.method, measurement.seconds * 1000,
+                    measurement.queries, measurement.cache_hits,
+                    measurement.cache_hits + measurement.cache_misses)
+
+
+class StatsdSink(Sink):
+    """Sends timers and histograms per criterion type to statsd via UDP.
+    """
+
+    def __init__(self):
+        self.address = (getattr(settings, 'CRITERION_STATSD_HOST',
+                                'localhost'),
+                        getattr(settings, 'CRITERION_STATSD_PORT', 8125))
+        self.prefix = getattr(settings, 'CRITERION_STATSD_PREFIX',
+                              'lfs.criterion')
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, measurement):
+        name = "%s.%s.%s" % (self.prefix, measurement.content_type,
+                             measurement.method)
+        data = "\n".join([
+            "%s.time:%d|ms" % (name, measurement.seconds * 1000),
+            "%s.queries:%d|h" % (name, measurement.queries),
+            "%s.cache_hits:%d|c" % (name, measurement.cache_hits),
+            "%s.cache_misses:%d|c" % (name, measurement.cache_misses),
+        ])
+        try:
+            self.socket.sendto(data, self.address)
+        except socket.error:
+            pass
+
+
+class MemorySink(Sink):
+    """Aggregates the measurements in the process, e.g. for tests.
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def record(self, measurement):
+        key = (measurement.content_type, measurement.criterion_id,
+               measurement.method)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.add(measurement)
+
+    def clear(self):
+        with self.lock:
+            self.histograms = {}
+
+
+class CacheSink(MemorySink):
+    """Aggregates the measurements in the process and merges them into the
+    cache from time to time, so ``criterion_offenders`` command can read
+    them.
+    """
+    flush_interval = 10
+
+    def __init__(self):
+        super(CacheSink, self).__init__()
+        self.flushed = time.time()
+
+    def record(self, measurement):
+        super(CacheSink, self).record(measurement)
+        if time.time() - self.flushed > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            histograms = self.histograms
+            self.histograms = {}
+            self.flushed = time.time()
+        merge_cached_histograms(histograms)
+
+
+def get_histograms_cache_key():
+    return "%s-criterion-instrumentation" % (
+               settings.CACHE_MIDDLEWARE_KEY_PREFIX)
+
+
+def get_cached_histograms():
+    """Returns dict of (content type, criterion id, method) to histogram,
+    which were flushed by ``CacheSink``.
+    """
+    return cache.get(get_histograms_cache_key()) or {}
+
+
+def merge_cached_histograms(histograms):
+    # concurrent flushes may lose some measurements
+    cached = get_cached_histograms()
+    for key, histogram in histograms.items():
+        if key in cached:
+            cached[key].merge(histogram)
+        else:
+            cached[key] = histogram
+    cache.set(get_histograms_cache_key(), cached, 7 * 24 * 60 * 60)
+
+
+def clear_cached_histograms():
+    cache.delete(get_histograms_cache_key())
+
+
+def get_sinks():
+    if not _sinks:
+        for path in SINKS:
+            module, name = path.rsplit('.', 1)
+            _sinks.append(getattr(import_module(module), name)())
+    return _sinks
+
+
+def record_cache(hit):
+    """Counts a cache lookup of the criterion, which is measured now.
+    """
+    stack = getattr(_local, 'stack', None)
+    if stack:
+        if hit:
+            stack[-1].cache_hits += 1
+        else:
+            stack[-1].cache_misses += 1
+
+
+def measure(criterion, method, func, *args, **kwargs):
+    """Calls func and records its time, queries and cache lookups as
+    measurement of the method of the criterion.
+    """
+    stack = _local.__dict__.setdefault('stack', [])
+    measurement = Measurement(criterion.content_type, criterion.pk, method)
+    stack.append(measurement)
+
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    queries = len(connection.queries)
+    start = time.time()
+    try:
+        return func(criterion, *args, **kwargs)
+    finally:
+        measurement.seconds = time.time() - start
+        measurement.queries = len(connection.queries) - queries
+        connection.use_debug_cursor = use_debug_cursor
+        stack.pop()
+        if stack:
+            stack[-1].cache_hits += measurement.cache_hits
+            stack[-1].cache_misses += measurement.cache_misses
+
+        for sink in get_sinks():
+            try:
+                sink.record(measurement)
+            except Exception:
+                logger.exception("criterion instrumentation sink failed")
+
+
+def instrumented(method, func):
+    """Returns func wrapped with ``measure``.
+    """
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        return measure(self, method, func, *args, **kwargs)
+    wrapper.instrumented = True
+    wrapper.func = func
+    return wrapper
+
+
+def instrument(criterion_type):
+    """Wraps ``is_valid``, ``is_valid_many`` and ``as_html`` of the criterion
+    type with ``measure``. Methods, which the type does not define, are
+    skipped.
+    """
+    for method in ('is_valid', 'is_valid_many', 'as_html'):
+        func = getattr(criterion_type, method, None)
+        if func is None:
+            # e.g. is_valid_many of the criteria of lfs
+            continue
+        func = func.im_func
+        if not getattr(func, 'instrumented', False):
+            setattr(criterion_type, method, instrumented(method, func))
+
+
+def uninstrument(criterion_type):
+    for method in ('is_valid', 'is_valid_many', 'as_html'):
+        func = getattr(criterion_type, method, None)
+        if func is None:
+            continue
+        func = func.im_func
+        if getattr(func, 'instrumented', False):
+            setattr(criterion_type, method, func.func)
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+# cache invalidation of the criteria
+from django.contrib.auth.models import Group, User
+from django.core.cache import cache
+from django.db.models.signals import (m2m_changed, post_delete, post_save,
+                                      pre_delete, pre_save)
+
+from lfs.cart.models import CartItem
+from lfs.catalog.models import Category, Product
+from lfs.core.signals import cart_changed, category_changed
+from lfs.criteria.models import CriteriaObjects
+from lfs.discounts.models import Discount
+from lfs.order.models import Order, OrderItem
+
+from lfs_criterion_extra.attributes import (ATTRIBUTE_FIELDS,
+                                           get_changed_fields,
+                                           invalidate_product_attributes)
+from lfs_criterion_extra.categories import invalidate_category_tree
+from lfs_criterion_extra.discounts import MEMO_ATTR as DISCOUNTS_MEMO_ATTR
+from lfs_criterion_extra.groups import invalidate_user_groups
+from lfs_criterion_extra.managers import (AGGREGATE_PRODUCT_FIELDS,
+                                          CART_ITEM_FIELDS, ORDER_FIELDS,
+                                          get_cart_item_values)
+from lfs_criterion_extra.models import (CartAggregate,
+                                        CompositionCategory,
+                                        CriterionRegistrator,
+                                        MultipleValueCriterion,
+                                        OrderStatistics)
+from lfs_criterion_extra.plans import invalidate_plans
+from lfs_criterion_extra.results import (invalidate_cart_results,
+                                         invalidate_results)
+
+
+# Criteria
+def criterion_changed_listener(sender, instance, **kwargs):
+    instance.clear_value_ids()
+
+
+def criterion_value_changed_listener(sender, instance, action, reverse, model,
+                                     pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            instance.clear_value_ids()
+        return
+
+    # the criteria were changed from the side of the related object
+    if action == 'pre_clear':
+        pk_set = model.objects.filter(**{model.value_attr: instance})\
+                              .values_list('id', flat=True)
+    elif action not in ('post_add', 'post_remove'):
+        return
+
+    for id in pk_set:
+        cache.delete(model.get_value_ids_cache_key(id))
+
+
+def connect_criterion_listeners(criterion_class):
+    """Connects cache invalidation listeners of the given criterion class.
+    """
+    if not issubclass(criterion_class, MultipleValueCriterion):
+        return
+
+    post_save.connect(criterion_changed_listener, sender=criterion_class)
+    post_delete.connect(criterion_changed_listener, sender=criterion_class)
+
+    through = getattr(criterion_class, criterion_class.value_attr).through
+    m2m_changed.connect(criterion_value_changed_listener, sender=through)
+
+
+for criterion_class in CriterionRegistrator.types.values():
+    connect_criterion_listeners(criterion_class)
+
+
+# Plans
+def plans_changed_listener(sender, **kwargs):
+    invalidate_plans()
+    invalidate_results()
+
+
+def connect_plan_listeners(model):
+    """Drops compiled plans on any change of the model and its many to many
+    relations.
+    """
+    post_save.connect(plans_changed_listener, sender=model)
+    post_delete.connect(plans_changed_listener, sender=model)
+    for field in model._meta.many_to_many:
+        m2m_changed.connect(plans_changed_listener, sender=field.rel.through)
+
+
+for model in CriterionRegistrator.types.values():
+    connect_plan_listeners(model)
+connect_plan_listeners(CompositionCategory)
+connect_plan_listeners(CriteriaObjects)
+connect_plan_listeners(Discount)
+
+
+# Cart
+def cart_changed_listener(sender, **kwargs):
+    request = kwargs.get('request')
+    if request is not None:
+        request.__dict__.pop(DISCOUNTS_MEMO_ATTR, None)
+    if sender is not None:
+        invalidate_cart_results(sender.id)
+cart_changed.connect(cart_changed_listener)
+
+
+def cart_item_changed_listener(sender, instance, **kwargs):
+    invalidate_cart_results(instance.cart_id)
+post_save.connect(cart_item_changed_listener, sender=CartItem)
+post_delete.connect(cart_item_changed_listener, sender=CartItem)
+
+
+def cart_item_pre_save_listener(sender, instance, **kwargs):
+    old = None
+    if instance.pk is not None:
+        for old in CartItem.objects.filter(pk=instance.pk)\
+                                   .values(*CART_ITEM_FIELDS):
+            break
+    instance._criterion_old_values = old
+pre_save.connect(cart_item_pre_save_listener, sender=CartItem)
+
+
+def cart_item_post_save_listener(sender, instance, **kwargs):
+    old = instance.__dict__.pop('_criterion_old_values', None)
+    CartAggregate.objects.item_changed(old, get_cart_item_values(instance))
+post_save.connect(cart_item_post_save_listener, sender=CartItem)
+
+
+def cart_item_deleted_listener(sender, instance, **kwargs):
+    CartAggregate.objects.item_changed(get_cart_item_values(instance), None)
+post_delete.connect(cart_item_deleted_listener, sender=CartItem)
+
+
+# Product
+# fields of products in carts, which results of the criteria and cart
+# aggregates depend on
+PRODUCT_FIELDS = tuple(set(ATTRIBUTE_FIELDS + AGGREGATE_PRODUCT_FIELDS))
+
+
+def product_changed_listener(sender, **kwargs):
+    # weight, manufacturer, etc. of products in carts
+    invalidate_results()
+    invalidate_product_attributes()
+post_delete.connect(product_changed_listener, sender=Product)
+m2m_changed.connect(product_changed_listener,
+                    sender=Category.products.through)
+
+
+def product_pre_save_listener(sender, instance, **kwargs):
+    old = None
+    if instance.pk is not None:
+        for old in Product.objects.filter(pk=instance.pk)\
+                                  .values(*PRODUCT_FIELDS):
+            break
+    instance._criterion_old_values = old
+pre_save.connect(product_pre_save_listener, sender=Product)
+
+
+def product_saved_listener(sender, instance, **kwargs):
+    old = instance.__dict__.pop('_criterion_old_values', None)
+    if old is None:
+        # new products are in no cart, rows of products, which are not in
+        # the attributes table, are read from the products
+        return
+
+    # stock, prices, etc. are changed without invalidation
+    changed = get_changed_fields(old, instance)
+    if changed:
+        invalidate_results()
+    if changed.intersection(ATTRIBUTE_FIELDS):
+        invalidate_product_attributes()
+    if changed.intersection(AGGREGATE_PRODUCT_FIELDS):
+        CartAggregate.objects.products_changed([instance.pk])
+post_save.connect(product_saved_listener, sender=Product)
+
+
+def product_categories_listener(sender, instance, action, reverse, pk_set,
+                                **kwargs):
+    if reverse:
+        # categories of the product were changed
+        if action.startswith('post_'):
+            CartAggregate.objects.products_changed([instance.pk])
+        return
+
+    # products of the category were changed
+    if action == 'pre_clear':
+        pk_set = instance.products.values_list('id', flat=True)
+    elif action not in ('post_add', 'post_remove'):
+        return
+    CartAggregate.objects.products_changed(list(pk_set))
+m2m_changed.connect(product_categories_listener,
+                    sender=Category.products.through)
+
+
+# Category
+def category_changed_listener(sender, **kwargs):
+    invalidate_category_tree()
+    invalidate_results()
+    # first categories of the products
+    invalidate_product_attributes()
+post_save.connect(category_changed_listener, sender=Category)
+post_delete.connect(category_changed_listener, sender=Category)
+category_changed.connect(category_changed_listener)
+
+
+# Order
+def order_pre_save_listener(sender, instance, **kwargs):
+    old = None
+    if instance.pk is not None:
+        for old in Order.objects.filter(pk=instance.pk).values(*ORDER_FIELDS):
+            break
+    instance._criterion_old_values = old
+pre_save.connect(order_pre_save_listener, sender=Order)
+
+
+def order_post_save_listener(sender, instance, **kwargs):
+    old = instance.__dict__.pop('_criterion_old_values', None)
+    OrderStatistics.objects.order_changed(instance, old)
+post_save.connect(order_post_save_listener, sender=Order)
+
+
+def order_pre_delete_listener(sender, instance, **kwargs):
+    OrderStatistics.objects.order_deleted(instance)
+pre_delete.connect(order_pre_delete_listener, sender=Order)
+
+
+def order_item_saved_listener(sender, instance, created, **kwargs):
+    if created:
+        OrderStatistics.objects.item_added(instance)
+post_save.connect(order_item_saved_listener, sender=OrderItem)
+
+
+# Groups
+def user_groups_changed_listener(sender, instance, action, reverse, pk_set,
+                                 **kwargs):
+    if not reverse:
+        # groups of the user were changed
+        if action.startswith('post_'):
+            invalidate_user_groups([instance.pk])
+        return
+
+    # users of the group were changed
+    if action == 'pre_clear':
+        pk_set = instance.user_set.values_list('id', flat=True)
+    elif action not in ('post_add', 'post_remove'):
+        return
+    invalidate_user_groups(pk_set)
+m2m_changed.connect(user_groups_changed_listener, sender=User.groups.through)
+
+
+def group_deleted_listener(sender, instance, **kwargs):
+    invalidate_user_groups(instance.user_set.values_list('id', flat=True))
+pre_delete.connect(group_deleted_listener, sender=Group)
@@ -0,0 +1,82 @@
+# python imports
+import sys
+import uuid
+from optparse import make_option
+
+# django imports
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import simplejson
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Times the criteria with a synthetic catalog in a new test '
+            'database and prints the results as json')
+    option_list = BaseCommand.option_list + (
+        make_option('--products', type='int', default=10000),
+        make_option('--category-depth', type='int', default=3),
+        make_option('--category-children', type='int', default=5),
+        make_option('--manufacturers', type='int', default=50),
+        make_option('--customers', type='int', default=100),
+        make_option('--orders', type='int', default=1000),
+        make_option('--cart-sizes', default='1,10,100',
+                    help='Comma separated numbers of cart items'),
+        make_option('--iterations', type='int', default=20),
+        make_option('--seed', type='int', default=0),
+        make_option('--output', help='File of the json results'),
+        make_option('--noinput', action='store_false', dest='interactive',
+                    default=True,
+                    help='Do not ask before an old test database is '
+                         'destroyed'),
+    )
+
+    def handle(self, *args, **options):
+        # models are imported after the app cache was loaded
+        from lfs_criterion_extra.benchmark import Benchmark
+
+        verbosity = int(options.get('verbosity', 1))
+
+        def log(message):
+            if verbosity > 1:
+                sys.stderr.write("%s\n" % message)
+
+        benchmark = Benchmark(
+            products=options['products'],
+            category_depth=options['category_depth'],
+            category_children=options['category_children'],
+            manufacturers=options['manufacturers'],
+            customers=options['customers'],
+            orders=options['orders'],
+            cart_sizes=[int(size)
+                        for size in options['cart_sizes'].split(',')],
+            iterations=options['iterations'],
+            seed=options['seed'],
+            log=log)
+
+        # the data is seeded into a test database and cached values get
+        # their own keys
+        old_name = connection.settings_dict['NAME']
+        key_prefix = settings.CACHE_MIDDLEWARE_KEY_PREFIX
+        connection.creation.create_test_db(
+            verbosity=max(verbosity - 1, 0),
+            autoclobber=not options['interactive'])
+        settings.CACHE_MIDDLEWARE_KEY_PREFIX = "%s-benchmark-%s" % (
+            key_prefix, uuid.uuid4().hex)
+        try:
+            result = benchmark.run()
+        finally:
+            settings.CACHE_MIDDLEWARE_KEY_PREFIX = key_prefix
+            connection.creation.destroy_test_db(
+                old_name, verbosity=max(verbosity - 1, 0))
+
+        output = simplejson.dumps(result, indent=2)
+        if options.get('output'):
+            f = open(options['output'], 'w')
+            try:
+                f.write(output)
+            finally:
+                f.close()
+        else:
+            self.stdout.write(output + "\n")
@@ -0,0 +1,62 @@
+# python imports
+from optparse import make_option
+
+# django imports
+from django.core.management.base import BaseCommand, CommandError
+
+# lfs_criterion_extra imports
+from lfs_criterion_extra.instrumentation import (HISTOGRAM_BUCKETS,
+                                                 clear_cached_histograms,
+                                                 get_cached_histograms)
+
+
+SORT_KEYS = {
+    'time': lambda histogram: histogram.seconds,
+    'mean': lambda histogram: histogram.seconds / histogram.calls,
+    'max': lambda histogram: histogram.max_seconds,
+    'queries': lambda histogram: histogram.queries,
+    'calls': lambda histogram: histogram.calls,
+}
+
+
+class Command(BaseCommand):
+    args = ''
+    help = ('Prints criteria, which took most time, as recorded by '
+            'lfs_criterion_extra.instrumentation.CacheSink')
+    option_list = BaseCommand.option_list + (
+        make_option('--sort', default='time',
+                    help='One of %s' % ', '.join(sorted(SORT_KEYS))),
+        make_option('--limit', type='int', default=20),
+        make_option('--reset', action='store_true', default=False,
+                    help='Delete recorded measurements after printing'),
+    )
+
+    def handle(self, *args, **options):
+        sort_key = SORT_KEYS.get(options['sort'])
+        if sort_key is None:
+            raise CommandError('Unknown sort %s' % options['sort'])
+
+        histograms = get_cached_histograms().items()
+        histograms.sort(key=lambda item: sort_key(item[1]),
+                        reverse=True)
+
+        buckets = ['<=%sms' % bound for bound in HISTOGRAM_BUCKETS] + ['more']
+        self.stdout.write("%-24s %8s %-8s %8s %10s %8s %8s %8s %8s  %s\n" % (
+            'type', 'id', 'method', 'calls', 'total ms', 'mean ms', 'max ms',
+            'queries', 'hits', ' '.join(buckets)))
+        for (content_type, criterion_id, method), histogram \
+                in histograms[:options['limit']]:
+            lookups = histogram.cache_hits + histogram.cache_misses
+            self.stdout.write(
+                "%-24s %8s %-8s %8d %10.1f %8.2f %8.2f %8.2f %8s  %s\n" % (
+                content_type, criterion_id, method, histogram.calls,
+                histogram.seconds * 1000,
+                histogram.seconds * 1000 / histogram.calls,
+                histogram.max_seconds * 1000,
+                float(histogram.queries) / histogram.calls,
+                "%d%%" % (100 * histogram.cache_hits / lookups)
+                    if lookups else '-',
+                ' '.join(str(count) for count in histogram.buckets)))
+
+        if options['reset']:
+            clear_cached_histograms()
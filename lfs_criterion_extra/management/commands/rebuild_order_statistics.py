@@ -0,0 +1,13 @@
+# django imports
+from django.core.management.base import BaseCommand
+
+
+class Command(BaseCommand):
+    args = ''
+    help = 'Rebuilds closed orders statistics of OrderCount and OrderSumm criteria'
+
+    def handle(self, *args, **options):
+        # models are imported after the app cache was loaded
+        from lfs_criterion_extra.models import OrderStatistics
+        count = OrderStatistics.objects.rebuild()
+        self.stdout.write("%s statistics rows created\n" % count)
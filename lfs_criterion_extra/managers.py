@@ -0,0 +1,361 @@
+# -*- coding: utf-8 -*-
+from django.db import models, transaction
+from django.db.models import F, Q
+
+from lfs.cart.models import CartItem
+from lfs.catalog.models import Category, Product
+from lfs.catalog.settings import VARIANT
+from lfs.order.models import Order, OrderItem
+from lfs.order.settings import CLOSED
+
+
+STATISTICS_ATTR = '_criterion_order_statistics'
+ORDER_FIELDS = ('state', 'price', 'user', 'session')
+CART_ITEM_FIELDS = ('cart', 'product', 'amount')
+# product fields, which cart aggregates depend on
+AGGREGATE_PRODUCT_FIELDS = ('sub_type', 'parent', 'manufacturer', 'weight',
+                            'active')
+
+
+def get_order_values(order):
+    """Returns the order fields, which statistics depend on.
+    """
+    return {
+        'state': order.state,
+        'price': order.price,
+        'user': order.user_id,
+        'session': order.session,
+    }
+
+
+def get_customer(user_id, session):
+    """Returns the customer lookup of the statistics.
+
+    Orders of a user are counted for the user, anonymous orders for the
+    session, so the session of an anonymous customer does not count the
+    orders, which the customer placed logged in.
+    """
+    if user_id is not None:
+        return {'user_id': user_id, 'session': ''}
+    return {'user_id': None, 'session': session}
+
+
+def add_statistics(statistics, row):
+    """Returns the statistics with the values of the row added or the row
+    if statistics is None.
+
+    unique_together does not hold for rows without user or product, so
+    concurrent orders may create more rows of a customer and product.
+    """
+    if statistics is None:
+        return row
+    statistics.order_count += row.order_count
+    statistics.order_summ += row.order_summ
+    return statistics
+
+
+class OrderStatisticsManager(models.Manager):
+    """Reads and updates closed orders statistics of the customers.
+    """
+
+    def get_for_request(self, request, product=None):
+        """Returns the statistics of the current customer and the product.
+
+        Statistics are memoized on the request. If the customer has no closed
+        orders an unsaved statistics with zero values is returned.
+        """
+        product_id = product.id if product is not None else None
+        memo = request.__dict__.setdefault(STATISTICS_ATTR, {})
+        if product_id in memo:
+            return memo[product_id]
+
+        if request.user.is_authenticated():
+            customer = get_customer(request.user.id, '')
+        else:
+            customer = get_customer(None, request.session.session_key)
+
+        statistics = None
+        for row in self.filter(product=product_id, **customer):
+            statistics = add_statistics(statistics, row)
+        if statistics is None:
+            statistics = self.model(product_id=product_id, **customer)
+
+        memo[product_id] = statistics
+        return statistics
+
+    def get_many_for_request(self, request, products):
+        """Returns dict of product id to the statistics of the current
+        customer and the product like ``get_for_request`` does, but loads
+        the statistics of all products with one query.
+        """
+        memo = request.__dict__.setdefault(STATISTICS_ATTR, {})
+        missing = set(product.id for product in products
+                      if product.id not in memo)
+        if missing:
+            if request.user.is_authenticated():
+                customer = get_customer(request.user.id, '')
+            else:
+                customer = get_customer(None, request.session.session_key)
+
+            found = {}
+            for row in self.filter(product__in=missing, **customer):
+                found[row.product_id] = add_statistics(
+                    found.get(row.product_id), row)
+            memo.update(found)
+            for product_id in missing - set(memo):
+                memo[product_id] = self.model(product_id=product_id,
+                                              **customer)
+
+        return dict((product.id, memo[product.id]) for product in products)
+
+    def order_changed(self, order, old=None):
+        """Updates statistics after the order was saved.
+
+        ``old`` are the order values (see ``get_order_values``) before the
+        order was saved or None for the new order.
+        """
+        new = get_order_values(order)
+        if old == new:
+            return
+
+        old_closed = old is not None and old['state'] == CLOSED
+        new_closed = new['state'] == CLOSED
+        if not old_closed and not new_closed:
+            return
+
+        product_ids = self.get_product_ids(order)
+        if old_closed:
+            self.add_order(old, product_ids, -1)
+        if new_closed:
+            self.add_order(new, product_ids, 1)
+
+    def order_deleted(self, order):
+        """Updates statistics before the order is deleted.
+        """
+        if order.state == CLOSED:
+            self.add_order(get_order_values(order),
+                           self.get_product_ids(order), -1)
+
+    def item_added(self, item):
+        """Updates statistics of the products after the item was added to a
+        closed order.
+
+        Orders are counted with the products of their items when they are
+        closed, items of an order saved as closed are added later.
+        """
+        if item.product_id is None:
+            return
+        for values in Order.objects.filter(pk=item.order_id, state=CLOSED)\
+                                   .values(*ORDER_FIELDS):
+            break
+        else:
+            return
+
+        items = OrderItem.objects.filter(order=item.order_id,
+                                         product=item.product_id)
+        if not items.exclude(pk=item.pk).exists():
+            self.add_order(values, [item.product_id], total=False)
+
+    def add_order(self, values, product_ids, sign=1, total=True):
+        """Adds (or substracts with negative sign) the order with given values
+        and products to the statistics of its customer.
+
+        With ``total=False`` only the statistics of the products are updated.
+        """
+        customer = get_customer(values['user'], values['session'])
+        product_ids = list(product_ids)
+        if total:
+            product_ids.insert(0, None)
+        for product_id in product_ids:
+            try:
+                statistics, created = self.get_or_create(
+                    product_id=product_id, **customer)
+            except self.model.MultipleObjectsReturned:
+                # duplicates are summed on reading, one of them is updated
+                statistics = self.filter(product=product_id, **customer)\
+                                 .order_by('pk')[0]
+            self.filter(pk=statistics.pk).update(
+                order_count=F('order_count') + sign,
+                order_summ=F('order_summ') + sign * values['price'])
+
+    def get_product_ids(self, order):
+        items = OrderItem.objects.filter(order=order, product__isnull=False)
+        return set(items.values_list('product', flat=True))
+
+    @transaction.commit_on_success
+    def rebuild(self, batch_size=1000):
+        """Rebuilds statistics of all closed orders.
+        """
+        statistics = {}
+
+        def add(user_id, session, product_id, price):
+            customer = get_customer(user_id, session)
+            key = (customer['user_id'], customer['session'], product_id)
+            values = statistics.setdefault(key, [0, 0.])
+            values[0] += 1
+            values[1] += price
+
+        orders = Order.objects.filter(state=CLOSED)\
+                              .values_list('user', 'session', 'price')
+        for user_id, session, price in orders.iterator():
+            add(user_id, session, None, price)
+
+        items = OrderItem.objects.filter(order__state=CLOSED,
+                                         product__isnull=False)\
+                                 .values_list('order', 'order__user',
+                                              'order__session',
+                                              'order__price', 'product')\
+                                 .distinct()
+        for order_id, user_id, session, price, product_id in items.iterator():
+            add(user_id, session, product_id, price)
+
+        self.all().delete()
+        self.bulk_create([self.model(user_id=user_id,
+                                     session=session,
+                                     product_id=product_id,
+                                     order_count=order_count,
+                                     order_summ=order_summ)
+                          for (user_id, session, product_id),
+                              (order_count, order_summ)
+                          in statistics.iteritems()],
+                         batch_size=batch_size)
+        return len(statistics)
+
+
+def get_cart_item_values(item):
+    """Returns the cart item fields, which cart aggregates depend on.
+    """
+    return {
+        'cart': item.cart_id,
+        'product': item.product_id,
+        'amount': item.amount,
+    }
+
+
+def get_products_info(product_ids):
+    """Returns dict of product id to (weight, manufacturer id, category ids)
+    of the given active products.
+
+    Variants have the manufacturer and the categories of their parent like
+    ``Product.get_manufacturer`` does.
+    """
+    rows = Product.objects.filter(id__in=product_ids, active=True)\
+                          .values_list('id', 'sub_type', 'weight',
+                                       'manufacturer', 'parent',
+                                       'parent__manufacturer')
+    owners = {}
+    info = {}
+    for id, sub_type, weight, manufacturer_id, parent_id, \
+            parent_manufacturer_id in rows:
+        if sub_type == VARIANT:
+            owners[id] = parent_id
+            manufacturer_id = parent_manufacturer_id
+        else:
+            owners[id] = id
+        info[id] = (weight or 0., manufacturer_id, [])
+
+    categories = {}
+    for product_id, category_id in Category.products.through.objects\
+            .filter(product__in=set(owners.values()))\
+            .values_list('product', 'category'):
+        categories.setdefault(product_id, []).append(category_id)
+    for id, owner_id in owners.items():
+        info[id][2].extend(categories.get(owner_id, ()))
+    return info
+
+
+class CartAggregateManager(models.Manager):
+    """Reads and updates the aggregates of the carts.
+    """
+
+    def get_for_cart(self, cart):
+        """Returns the aggregate of the cart, which is built from the cart
+        items on first access.
+
+        An empty row is committed first and built under its lock, so items
+        saved meanwhile are either read by the build or added to the built
+        row by ``item_changed``, which waits for the lock.
+        """
+        try:
+            aggregate = self.get(cart=cart)
+        except self.model.DoesNotExist:
+            aggregate = self.create_empty(cart)
+        if not aggregate.built:
+            aggregate = self.build_locked(cart)
+        return aggregate
+
+    @transaction.commit_on_success
+    def create_empty(self, cart):
+        # the row may be created by a concurrent request
+        aggregate, created = self.get_or_create(cart=cart)
+        return aggregate
+
+    @transaction.commit_on_success
+    def build_locked(self, cart):
+        aggregate = self.select_for_update().get(cart=cart)
+        if not aggregate.built:
+            built = self.build(cart)
+            built.pk = aggregate.pk
+            built.built = True
+            self.filter(pk=aggregate.pk).update(
+                built=True, **built.get_aggregate_values())
+            aggregate = built
+        return aggregate
+
+    def build(self, cart):
+        """Returns a new unsaved aggregate of the items of the cart.
+        """
+        aggregate = self.model(cart=cart)
+        items = CartItem.objects.filter(cart=cart)\
+                                .values_list('product', 'amount')
+        info = get_products_info(set(product_id
+                                     for product_id, amount in items))
+        for product_id, amount in items:
+            if product_id in info:
+                aggregate.add_item(product_id, amount, info[product_id])
+        return aggregate
+
+    @transaction.commit_on_success
+    def item_changed(self, old=None, new=None):
+        """Updates the aggregates after a cart item was saved or deleted.
+
+        ``old`` are the item values (see ``get_cart_item_values``) before the
+        change or None for the new item, ``new`` are the values after the
+        change or None for the deleted item. Carts without built aggregate
+        are left alone, their aggregate is built from the items on first
+        access.
+        """
+        if old == new:
+            return
+
+        changes = {}
+        if old is not None:
+            changes.setdefault(old['cart'], []).append((old, -1))
+        if new is not None:
+            changes.setdefault(new['cart'], []).append((new, 1))
+
+        aggregates = list(self.select_for_update()
+                              .filter(cart__in=changes.keys(), built=True))
+        if not aggregates:
+            return
+
+        info = get_products_info(set(values['product']
+                                     for values in (old, new)
+                                     if values is not None))
+        for aggregate in aggregates:
+            for item, sign in changes[aggregate.cart_id]:
+                if item['product'] in info:
+                    aggregate.add_item(item['product'], item['amount'],
+                                       info[item['product']], sign)
+            # the row is updated only, it may have been deleted with the
+            # cart
+            self.filter(pk=aggregate.pk).update(
+                **aggregate.get_aggregate_values())
+
+    def products_changed(self, product_ids):
+        """Drops the aggregates of the carts with the given products (or
+        their variants), which are built again on next access.
+        """
+        self.filter(Q(cart__cartitem__product__in=product_ids) |
+                    Q(cart__cartitem__product__parent__in=product_ids))\
+            .delete()
@@ -6,17 +6,21 @@ import time
 import datetime
 from django import forms
 from django.contrib.auth.models import User, Group
+from django.conf import settings
 from django.contrib.contenttypes import generic
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.exceptions import ValidationError
 from django.db import models
-from django.db.models import Max, Sum
+from django.db.models import Q
+from django.db.models.fields import FieldDoesNotExist
 from django.forms.formsets import formset_factory
-from django.template.loader import render_to_string
-from django.template import RequestContext
+from django.utils import simplejson
+from django.utils.dates import WEEKDAYS
 from django.utils.translation import ugettext_lazy as _
 
+from lfs.cart.models import Cart
 from lfs.catalog.models import Category, Product
-from lfs.cart.utils import get_cart
 from lfs.criteria.models.criteria_objects import CriteriaObjects
 from lfs.criteria.settings import EQUAL
 from lfs.criteria.settings import LESS_THAN
@@ -27,8 +31,22 @@ from lfs.criteria.settings import SELECT_OPERATORS
 from lfs.criteria.settings import IS, IS_NOT, IS_VALID, IS_NOT_VALID
 from lfs.discounts.models import Discount
 from lfs.manufacturer.models import Manufacturer
-from lfs.order.models import Order
-from lfs.order.settings import CLOSED
+
+from lfs_criterion_extra.attributes import (get_product_row,
+                                           get_product_rows)
+from lfs_criterion_extra.bitmaps import get_id_set
+from lfs_criterion_extra.cart import get_cart_snapshot
+from lfs_criterion_extra.categories import (get_category_ancestors,
+                                           get_category_tree_ids)
+from lfs_criterion_extra.costs import (COST_CART, COST_QUERY, COST_RECURSIVE,
+                                       COST_REQUEST)
+from lfs_criterion_extra.groups import get_user_group_ids
+from lfs_criterion_extra.instrumentation import record_cache
+from lfs_criterion_extra.managers import (CartAggregateManager,
+                                          OrderStatisticsManager)
+from lfs_criterion_extra.rendering import CriteriaRenderer
+from lfs_criterion_extra.results import (DEPENDS_CART, DEPENDS_CLOCK,
+                                         DEPENDS_ORDERS, DEPENDS_USER)
 
 try:
     from lfs.criteria.models.criteria import (Criterion,
@@ -42,6 +60,8 @@ except ImportError:
 
 IS_AUTHENTICATED = 20
 IS_ANONYMOUS = 21
+IS_WITH_SUBCATEGORIES = 22
+IS_NOT_WITH_SUBCATEGORIES = 23
 
 USER_OPERATORS = (
     (IS, _(u"Is")),
@@ -55,18 +75,125 @@ CHOICE_OPERATORS = (
     (IS_NOT, _(u"Is not")),
 )
 
+CATEGORY_OPERATORS = CHOICE_OPERATORS + (
+    (IS_WITH_SUBCATEGORIES, _(u"Is (with subcategories)")),
+    (IS_NOT_WITH_SUBCATEGORIES, _(u"Is not (with subcategories)")),
+)
+
 VALID_CHOICE_OPERATORS = (
     (IS_VALID, _(u"Is valid")),
     (IS_NOT_VALID, _(u"Is not valid")),
 )
 
 
+def get_nothing_q():
+    """Returns Q, which matches no criterion.
+    """
+    return Q(pk__isnull=True)
+
+
+def get_number_q(value_attr, value):
+    """Returns Q of the number criteria, which ``test_value(value)`` is
+    True for.
+    """
+    return (Q(operator=LESS_THAN, **{'%s__gt' % value_attr: value}) |
+            Q(operator=LESS_THAN_EQUAL, **{'%s__gte' % value_attr: value}) |
+            Q(operator=GREATER_THAN, **{'%s__lt' % value_attr: value}) |
+            Q(operator=GREATER_THAN_EQUAL,
+              **{'%s__lte' % value_attr: value}) |
+            Q(operator=EQUAL, **{value_attr: value}))
+
+
+def get_choice_q(positive, matched):
+    """Returns Q of the choice criteria, which are valid: criteria with
+    positive operators if their values are matched, others if not.
+    """
+    return (positive & matched) | (~positive & ~matched)
+
+
+class MultipleValueCriterion(Criterion):
+    """Base class for criteria with a many to many value.
+
+    Primary keys of the related objects are compiled into a frozenset, which
+    is cached on the instance and within the cache framework. The cached set
+    is dropped by the listeners on any change of the criterion.
+
+    If ``search_values`` is defined, the admin form renders only selected
+    values and searches others via ``criterion_values`` view.
+    """
+    multiple_value = True
+    search_values = None
+    # compile primary keys into a bitmap (see ``bitmaps.IdBitmap``) instead
+    # of a frozenset, for huge lists of related objects
+    value_ids_bitmap = False
+
+    class Meta:
+        abstract = True
+
+    def get_value_ids(self):
+        """Returns frozenset of primary keys of the related objects.
+        """
+        value_ids = self.__dict__.get('_value_ids')
+        if value_ids is not None:
+            record_cache(True)
+            return value_ids
+
+        cache_key = self.get_value_ids_cache_key(self.id)
+        value_ids = cache.get(cache_key)
+        record_cache(value_ids is not None)
+        if value_ids is None:
+            prefetched = getattr(self, '_prefetched_objects_cache', {})
+            if self.value_attr in prefetched:
+                value_ids = frozenset(obj.pk
+                                      for obj in prefetched[self.value_attr])
+            else:
+                value_ids = frozenset(self.value.values_list('pk', flat=True))
+            if self.value_ids_bitmap:
+                value_ids = get_id_set(value_ids)
+            cache.set(cache_key, value_ids)
+
+        self._value_ids = value_ids
+        return value_ids
+
+    def clear_value_ids(self):
+        self.__dict__.pop('_value_ids', None)
+        cache.delete(self.get_value_ids_cache_key(self.id))
+
+    def get_selected_values(self, name_attr):
+        """Returns list of (id, name) of the related objects, which are
+        taken from the prefetched objects if they were loaded in batch.
+        """
+        prefetched = getattr(self, '_prefetched_objects_cache', {})
+        if self.value_attr in prefetched:
+            return [(obj.pk, getattr(obj, name_attr))
+                    for obj in prefetched[self.value_attr]]
+        return list(self.value.values_list('pk', name_attr))
+
+    @classmethod
+    def get_value_ids_cache_key(cls, id):
+        return "%s-criterion-value-ids-%s-%s" % (
+                   settings.CACHE_MIDDLEWARE_KEY_PREFIX, cls.content_type, id)
+
+    @classmethod
+    def get_value_q(cls, ids):
+        """Returns Q of the criteria, which have any of the related objects
+        with given ids.
+        """
+        if not ids:
+            return get_nothing_q()
+        criteria = cls.objects.filter(**{'%s__in' % cls.value_attr:
+                                         list(ids)})
+        return Q(pk__in=criteria.values('pk'))
+
+
 class OrderCountCriterion(NumberCriterion):
     """A criterion for the cart price.
     """
     order_count = models.IntegerField(_(u"Order сount"), default=0)
     value_attr = 'order_count'
     content_type = u"order_count"
+    cost = COST_QUERY
+    depends_on = (DEPENDS_USER, DEPENDS_ORDERS)
     name = _(u"Order count")
 
     def is_valid(self, request, product=None):
@@ -75,80 +202,92 @@ class OrderCountCriterion(NumberCriterion):
         If product is given the order_count is taken from the all orders with this product and user,
         overwise all orders from this user.
         """
-        filters = {}
-        if product is not None:
-            filters['items__product'] = product
-        if request.user.is_authenticated():
-            filters['user'] = request.user
-        else:
-            filters['session'] = request.session.session_key
-
         #count only closed orders
-        filters['state'] = CLOSED
+        statistics = OrderStatistics.objects.get_for_request(request, product)
+        return self.test_value(statistics.order_count)
 
-        order_count = Order.objects.filter(**filters).count()
+    def is_valid_many(self, request, products):
+        statistics = OrderStatistics.objects.get_many_for_request(request,
+                                                                  products)
+        return dict((product_id, self.test_value(s.order_count))
+                    for product_id, s in statistics.items())
 
-        return self.test_value(order_count)
+    @classmethod
+    def get_q(cls, request):
+        statistics = OrderStatistics.objects.get_for_request(request)
+        return get_number_q(cls.value_attr, statistics.order_count)
 
 
-class GroupCriterion(Criterion):
+class GroupCriterion(MultipleValueCriterion):
     """A criterion for user content objects
     """
+    operator = models.PositiveIntegerField(_(u"Operator"),
+                                           blank=True, null=True,
+                                           choices=CHOICE_OPERATORS)
     groups = models.ManyToManyField(Group)
     value_attr = 'groups'
-    multiple_value = True
+    prefetch_fields = ('groups',)
 
     content_type = u"group"
+    cost = COST_REQUEST
+    depends_on = (DEPENDS_USER,)
+    uses_product = False
     name = _(u"Group")
 
     def is_valid(self, request, product=None):
         """Returns True if the criterion is valid.
         """
-        user = request.user
-        if user.is_anonymous():
-             return False
+        result = not self.get_value_ids().isdisjoint(
+                                                get_user_group_ids(request))
 
-        user_groups = user.groups.all().values('id')
-        groups = self.groups.filter(id__in=user_groups)
-        return groups.exists()
+        # criteria saved without operator check "is"
+        if self.operator == IS_NOT:
+            return not result
+        else:
+            return result
 
-    def as_html(self, request, position):
+    @classmethod
+    def get_q(cls, request):
+        return get_choice_q(Q(operator__isnull=True) | Q(operator=IS),
+                            cls.get_value_q(get_user_group_ids(request)))
+
+    def as_html(self, request, position, renderer=None):
         """Renders the criterion as html in order to be displayed within several
         forms.
         """
-        users = []
-        selected_groups = self.groups.all()
-        for g in Group.objects.all():
-            if g in selected_groups:
-                selected = True
-            else:
-                selected = False
+        if renderer is None:
+            renderer = CriteriaRenderer(request)
+        groups = renderer.get_options('groups', lambda: list(
+                     Group.objects.values_list('id', 'name')))
 
+        users = []
+        selected_groups = self.get_value_ids()
+        for id, name in groups:
             users.append({
-                "id" : g.id,
-                "name" : g.name,
-                "selected" : selected,
+                "id" : id,
+                "name" : name,
+                "selected" : id in selected_groups,
             })
 
-        return render_to_string("manage/criteria/group_criterion.html", RequestContext(request, {
+        return renderer.render("manage/criteria/group_criterion.html", {
             "id" : "ex%s" % self.id,
             "operator" : self.operator,
             "groups" : users,
             "position" : position,
             "content_type" : self.content_type,
             "types" : CriterionRegistrator.items(),
-        }))
+        })
 
 
-class CategoryCriterion(Criterion):
+class CategoryCriterion(MultipleValueCriterion):
     """A criterion for the shipping category.
     """
     operator = models.PositiveIntegerField(_(u"Operator"),
                                            blank=True, null=True,
-                                           choices=CHOICE_OPERATORS)
+                                           choices=CATEGORY_OPERATORS)
     categories = models.ManyToManyField(Category, verbose_name=_(u"Category"))
     value_attr = 'categories'
-    multiple_value = True
+    prefetch_fields = ('categories',)
 
     def __unicode__(self):
         values = []
@@ -160,51 +299,104 @@ class CategoryCriterion(Criterion):
                               u", ".join(values))
 
     content_type = u"category"
+    cost = COST_CART
+    depends_on = (DEPENDS_CART,)
     name = _(u"Category")
 
     def is_valid(self, request, product=None):
         """Returns True if the criterion is valid.
+
+        With subcategories operators the categories of the products are
+        valid if they are under any of the saved categories.
         """
+        subcategories = self.operator in (IS_WITH_SUBCATEGORIES,
+                                          IS_NOT_WITH_SUBCATEGORIES)
         if product:
-            result = product.get_category() in self.categories.all()
+            category_id = get_product_row(request, product).category_id
+            if category_id is None:
+                category_ids = set()
+            elif subcategories:
+                category_ids = get_category_tree_ids([category_id])
+            else:
+                category_ids = set([category_id])
         else:
-            cart = get_cart(request)
-            if cart is None or not cart.items().exists():
+            cart = get_cart_snapshot(request)
+            if cart.is_empty():
                 return False
 
-            categories = set()
-            for item in cart.items():
-                categories.add(item.product.get_category())
+            if subcategories:
+                category_ids = cart.category_tree_ids
+            else:
+                category_ids = cart.category_ids
 
-            result = bool(categories.intersection(self.categories.all()))
+        result = not self.get_value_ids().isdisjoint(category_ids)
 
-        if self.operator == IS:
+        if self.operator in (IS, IS_WITH_SUBCATEGORIES):
             return result
         else:
             return not result
 
-    def as_html(self, request, position):
+    def is_valid_many(self, request, products):
+        """Returns dict of product id to True if the criterion is valid for
+        the product. Categories of the products are read from the product
+        attributes table.
+        """
+        rows = get_product_rows(request, products)
+        subcategories = self.operator in (IS_WITH_SUBCATEGORIES,
+                                          IS_NOT_WITH_SUBCATEGORIES)
+        value_ids = self.get_value_ids()
+        negate = self.operator not in (IS, IS_WITH_SUBCATEGORIES)
+        if subcategories:
+            ancestors = get_category_ancestors()
+
+        result = {}
+        for product in products:
+            category_id = rows[product.id].category_id
+            if category_id is None:
+                valid = False
+            elif subcategories:
+                valid = not value_ids.isdisjoint(
+                                ancestors.get(category_id, (category_id,)))
+            else:
+                valid = category_id in value_ids
+            result[product.id] = valid != negate
+        return result
+
+    @classmethod
+    def get_q(cls, request):
+        cart = get_cart_snapshot(request)
+        if cart.is_empty():
+            return get_nothing_q()
+
+        matched = cls.get_value_q(cart.category_ids)
+        matched_tree = cls.get_value_q(cart.category_tree_ids)
+        return ((Q(operator=IS) & matched) |
+                (Q(operator=IS_WITH_SUBCATEGORIES) & matched_tree) |
+                (Q(operator=IS_NOT_WITH_SUBCATEGORIES) & ~matched_tree) |
+                (~Q(operator__in=[IS, IS_WITH_SUBCATEGORIES,
+                                  IS_NOT_WITH_SUBCATEGORIES]) & ~matched))
+
+    def as_html(self, request, position, renderer=None):
         """Renders the criterion as html in order
         to be displayed within several forms.
         """
+        if renderer is None:
+            renderer = CriteriaRenderer(request)
+        all_categories = renderer.get_options('categories', lambda: list(
+                             Category.objects.values_list('id', 'name',
+                                                          'level')))
 
         categories = []
-        self_categories = self.categories.all()
-        for category in Category.objects.all():
-            if category in self_categories:
-                selected = True
-            else:
-                selected = False
-
+        self_categories = self.get_value_ids()
+        for id, name, level in all_categories:
             categories.append({
-                "id": category.id,
-                "name": category.name,
-                "selected": selected,
-                "level": category.level,
+                "id": id,
+                "name": name,
+                "selected": id in self_categories,
+                "level": level,
             })
 
-        return render_to_string("manage/criteria/category_criterion.html",
-          RequestContext(request, {
+        return renderer.render("manage/criteria/category_criterion.html", {
             "id": "ex%s" % self.id,
             "operator": self.operator,
             "value": self.value,
@@ -212,10 +404,10 @@ class CategoryCriterion(Criterion):
             "categories": categories,
             "content_type": self.content_type,
             "types": CriterionRegistrator.items(),
-        }))
+        })
 
 
-class ProductCriterion(Criterion):
+class ProductCriterion(MultipleValueCriterion):
     """A criterion for the shipping category.
     """
     operator = models.PositiveIntegerField(_(u"Operator"),
@@ -223,7 +415,9 @@ class ProductCriterion(Criterion):
                                            choices=CHOICE_OPERATORS)
     products = models.ManyToManyField(Product, verbose_name=_(u"Product"))
     value_attr = 'products'
-    multiple_value = True
+    # lists of thousands of products are compiled into a bitmap without
+    # loading the products
+    value_ids_bitmap = True
 
     def __unicode__(self):
         values = []
@@ -235,49 +429,68 @@ class ProductCriterion(Criterion):
                               u", ".join(values))
 
     content_type = u"product"
+    cost = COST_CART
+    depends_on = (DEPENDS_CART,)
     name = _(u"Product")
 
     def is_valid(self, request, product=None):
         """Returns True if the criterion is valid.
         """
         if product:
-            result = product in self.products.all()
+            result = product.id in self.get_value_ids()
         else:
-            cart = get_cart(request)
-            if cart is None or not cart.items().exists():
+            cart = get_cart_snapshot(request)
+            if cart.is_empty():
                 return False
 
-            products = set(item.product for item in cart.items()
-                           if item.product)
-
-            result = bool(products.intersection(self.products.all()))
+            result = not self.get_value_ids().isdisjoint(cart.product_ids)
 
         if self.operator == IS:
             return result
         else:
             return not result
 
-    def as_html(self, request, position):
+    def is_valid_many(self, request, products):
+        value_ids = self.get_value_ids()
+        negate = self.operator != IS
+        return dict((product.id, (product.id in value_ids) != negate)
+                    for product in products)
+
+    @classmethod
+    def get_q(cls, request):
+        cart = get_cart_snapshot(request)
+        if cart.is_empty():
+            return get_nothing_q()
+        return get_choice_q(Q(operator=IS), cls.get_value_q(cart.product_ids))
+
+    def as_html(self, request, position, renderer=None):
         """Renders the criterion as html in order
         to be displayed within several forms.
         """
+        if renderer is None:
+            renderer = CriteriaRenderer(request)
 
-        products = Product.objects.all()
-        self_products = self.products.all()
-
-        for product in products:
-            product.selected = product in self_products
-
-        return render_to_string("manage/criteria/product_criterion.html",
-          RequestContext(request, {
+        # only selected products are rendered, others are searched via
+        # criterion_values view
+        return renderer.render("manage/criteria/product_criterion.html", {
             "id": "ex%s" % self.id,
             "operator": self.operator,
             "value": self.value,
             "position": position,
-            "products": products,
+            "values": self.get_selected_values('name'),
             "content_type": self.content_type,
             "types": CriterionRegistrator.items(),
-        }))
+        })
+
+    @classmethod
+    def search_values(cls, term):
+        """Returns (id, name) of the products, which match the term.
+        """
+        products = Product.objects.all()
+        if term:
+            products = products.filter(Q(name__icontains=term) |
+                                       Q(sku__icontains=term))
+        return products.order_by('name').values_list('id', 'name')
 
 
 class OrderCompositionCriterion(Criterion):
@@ -292,6 +505,7 @@ class OrderCompositionCriterion(Criterion):
                                         verbose_name=_(u"Category"))
     value_attr = 'categories'
     multiple_value = True
+    prefetch_fields = ('compositions',)
 
     criteria_objects = generic.GenericRelation(CriteriaObjects,
         object_id_field="criterion_id", content_type_field="criterion_type")
@@ -306,6 +520,9 @@ class OrderCompositionCriterion(Criterion):
                               u", ".join(values))
 
     content_type = u"composition_category"
+    cost = COST_CART
+    depends_on = (DEPENDS_CART,)
+    uses_product = False
     name = _(u"Composition")
 
     def is_valid(self, request, product=None):
@@ -313,17 +530,13 @@ class OrderCompositionCriterion(Criterion):
         """
         #content_object = self.criteria_objects.filter()[0].content
         result = True
-        cart = get_cart(request)
-        if cart is None or not cart.items().exists():
+        cart = get_cart_snapshot(request)
+        if cart.is_empty():
             return False
-        compositions = CompositionCategory.objects.filter(criterion=self)
-
-        for composition in compositions:
-            amount = 0
-            for item in cart.items().filter(
-                                product__categories=composition.category):
-                amount += item.amount
-            if amount < composition.amount:
+
+        amounts = cart.category_amounts
+        for composition in self.compositions.all():
+            if amounts.get(composition.category_id, 0) < composition.amount:
                 result = False
                 break
 
@@ -332,18 +545,26 @@ class OrderCompositionCriterion(Criterion):
         else:
             return not result
 
-    def as_html(self, request, position):
+    def as_html(self, request, position, renderer=None):
         """Renders the criterion as html in order
         to be displayed within several forms.
         """
+        if renderer is None:
+            renderer = CriteriaRenderer(request)
 
-        compositions = CompositionCategory.objects.filter(criterion=self)\
-                                                  .values('amount',
-                                                          'category')
+        compositions = [{"amount": composition.amount,
+                         "category": composition.category_id}
+                        for composition in self.compositions.all()]
         formset = CompositionCategoryFormSet(initial=compositions)
+        # the categories of all forms are loaded once
+        for form in formset.forms:
+            field = form.fields['category']
+            field.choices = renderer.get_options(
+                                'composition_categories',
+                                lambda: list(field.choices))
 
         template = "manage/criteria/composition_category_criterion.html"
-        return render_to_string(template, RequestContext(request, {
+        return renderer.render(template, {
             "id": "ex%s" % self.id,
             "operator": self.operator,
             "position": position,
@@ -351,12 +572,14 @@ class OrderCompositionCriterion(Criterion):
             "formset": formset,
             "content_type": self.content_type,
             "types": CriterionRegistrator.items(),
-        }))
+        })
 
     @classmethod
-    def create(cls, operator, value, request=None):
-
-        c = cls.objects.create()
+    def get_posted_compositions(cls, request):
+        """Returns list of (category id, amount) of the compositions passed
+        via request body.
+        """
+        compositions = []
         if request.method == 'POST' and 'form-0-amount' in request.POST:
             formset = CompositionCategoryFormSet(request.POST)
             for form in formset.forms:
@@ -365,10 +588,36 @@ class OrderCompositionCriterion(Criterion):
                         continue
                     if form.cleaned_data['DELETE']:
                         continue
-                    form.instance.criterion = c
-                    form.save()
+                    compositions.append((form.cleaned_data['category'].id,
+                                         form.cleaned_data['amount']))
+        return compositions
+
+    def set_compositions(self, compositions):
+        self.compositions.all().delete()
+        CompositionCategory.objects.bulk_create([
+            CompositionCategory(criterion=self,
+                                category_id=category_id,
+                                amount=amount)
+            for category_id, amount in compositions])
+
+    @classmethod
+    def create(cls, operator, value, request=None):
+
+        c = cls.objects.create()
+        c.set_compositions(cls.get_posted_compositions(request))
         return c
 
+    def update(self, operator, value, request=None):
+        """Replaces the compositions of the criterion, if they were changed.
+        """
+        compositions = self.get_posted_compositions(request)
+        old = [(composition.category_id, composition.amount)
+               for composition in self.compositions.all()]
+        if sorted(old) == sorted(compositions):
+            return False
+        self.set_compositions(compositions)
+        return True
+
 
 class CompositionCategory(models.Model):
 
@@ -402,6 +651,7 @@ class DiscountCriterion(Criterion):
     discounts = models.ManyToManyField(Discount, verbose_name=_(u"Discount"))
     value_attr = 'discounts'
     multiple_value = True
+    prefetch_fields = ('discounts',)
 
     criteria_objects = generic.GenericRelation(CriteriaObjects,
         object_id_field="criterion_id", content_type_field="criterion_type")
@@ -416,60 +666,75 @@ class DiscountCriterion(Criterion):
                               u", ".join(values))
 
     content_type = u"discounts"
+    cost = COST_RECURSIVE
     name = _(u"Discount")
 
+    def is_discount_criterion(self):
+        """Returns True if the criterion belongs to a discount.
+        """
+        if '_is_discount' not in self.__dict__:
+            content_type = ContentType.objects.get_for_model(Discount)
+            self._is_discount = self.criteria_objects.filter(
+                                    content_type=content_type).exists()
+        return self._is_discount
+
     def is_valid(self, request, product=None):
         """Returns True if the criterion is valid.
         """
-        from lfs.criteria.utils import is_valid
-        content_object = self.criteria_objects.filter()[0].content
-        if isinstance(content_object, Discount):
-            is_discount = True
-        else:
-            is_discount = False
+        from lfs_criterion_extra.discounts import is_discount_valid
+        is_discount = self.is_discount_criterion()
 
         if is_discount and self.operator == IS_VALID:
             for d in self.discounts.all():
-                if not d.active:
+                if not getattr(d, 'active', True):
                     continue
-                if not is_valid(request, d, product):
+                if not is_discount_valid(request, d, product):
                     return False
             return True
         elif is_discount and self.operator == IS_NOT_VALID:
             for d in self.discounts.all():
-                if not d.active:
+                if not getattr(d, 'active', True):
                     continue
-                if is_valid(request, d, product):
+                if is_discount_valid(request, d, product):
                     return False
             return True
 
         else:
             return False
 
-    def as_html(self, request, position):
+    def as_html(self, request, position, renderer=None):
         """Renders the criterion as html in order
         to be displayed within several forms.
         """
-        cr_objects = self.criteria_objects.all()
-        self_discounts = self.discounts.all()
+        if renderer is None:
+            renderer = CriteriaRenderer(request)
+
+        owner = renderer.owner
+        if owner is None:
+            cr_objects = self.criteria_objects.all()
+            if cr_objects.exists():
+                owner = cr_objects[0].content
+
+        def get_discounts():
+            discounts = Discount.objects.all()
+            # discounts of older lfs versions have no position
+            if 'position' in Discount._meta.get_all_field_names():
+                discounts = discounts.order_by('position')
+            return list(discounts.values_list('id', 'name'))
+        all_discounts = renderer.get_options('discounts', get_discounts)
+
+        self_discounts = set(d.id for d in self.discounts.all())
         discounts = []
-        all_discounts = Discount.objects.all().order_by('position')
-        if cr_objects.exists():
-            content_object = cr_objects[0].content
-            all_discounts = all_discounts.exclude(id=content_object.id)
-        for d in all_discounts:
-            if d in self_discounts:
-                selected = True
-            else:
-                selected = False
+        for id, name in all_discounts:
+            if isinstance(owner, Discount) and owner.id == id:
+                continue
             discounts.append({
-                "id": d.id,
-                "name": d.name,
-                "selected": selected,
+                "id": id,
+                "name": name,
+                "selected": id in self_discounts,
             })
 
-        return render_to_string("manage/criteria/discounts_criterion.html",
-                                RequestContext(request, {
+        return renderer.render("manage/criteria/discounts_criterion.html", {
             "id": "ex%s" % self.id,
             "operator": self.operator,
             "value": self.value,
@@ -477,7 +742,7 @@ class DiscountCriterion(Criterion):
             "discounts": discounts,
             "content_type": self.content_type,
             "types": CriterionRegistrator.items(),
-        }))
+        })
 
 
 class OrderSummCriterion(NumberCriterion):
@@ -485,26 +750,32 @@ class OrderSummCriterion(NumberCriterion):
     order_summ = models.IntegerField(_(u"Order summ"), default=0)
     value_attr = 'order_summ'
     content_type = u"order_summ"
+    cost = COST_QUERY
+    depends_on = (DEPENDS_USER, DEPENDS_ORDERS)
     name = _(u"Order summ")
 
     def is_valid(self, request, product=None):
+        """Returns True if the criterion is valid.
 
-        if product is not None:
-            filters = {'items__product': product}
-        else:
-            filters = {}
+        If product is given the order_summ is taken from the closed orders
+        with this product and user, overwise all closed orders of this user.
+        """
+        statistics = OrderStatistics.objects.get_for_request(request, product)
+        return self.test_value(statistics.order_summ)
 
-        if request.user.is_authenticated():
-            filters['user'] = request.user
-        else:
-            filters['session'] = request.session.session_key
+    def is_valid_many(self, request, products):
+        statistics = OrderStatistics.objects.get_many_for_request(request,
+                                                                  products)
+        return dict((product_id, self.test_value(s.order_summ))
+                    for product_id, s in statistics.items())
 
-        order_summ = Order.objects.filter(**filters)\
-                          .aggregate(sum_price=Sum('price'))['sum_price']
-        return self.test_value(order_summ)
+    @classmethod
+    def get_q(cls, request):
+        statistics = OrderStatistics.objects.get_for_request(request)
+        return get_number_q(cls.value_attr, statistics.order_summ)
 
 
-class ManufacturerCriterion(Criterion):
+class ManufacturerCriterion(MultipleValueCriterion):
     """A criterion for the shipping category.
     """
     operator = models.PositiveIntegerField(_(u"Operator"),
@@ -514,7 +785,7 @@ class ManufacturerCriterion(Criterion):
                                            verbose_name=_(u"Manufacturer"))
 
     value_attr = 'manufacturers'
-    multiple_value = True
+    prefetch_fields = ('manufacturers',)
 
     def __unicode__(self):
         values = []
@@ -526,51 +797,74 @@ class ManufacturerCriterion(Criterion):
                               u", ".join(values))
 
     content_type = u"manufacturer"
+    cost = COST_CART
+    depends_on = (DEPENDS_CART,)
     name = _(u"Manufacturer")
 
     def is_valid(self, request, product=None):
         """Returns True if the criterion is valid.
         """
         if product:
-            mnf = product.get_manufacturer()
-            result = mnf in self.manufacturers.all()
+            manufacturer_id = get_product_row(request, product).manufacturer_id
+            result = (manufacturer_id is not None and
+                      manufacturer_id in self.get_value_ids())
         else:
-            cart = get_cart(request)
-            if cart is None or not cart.items().exists():
+            cart = get_cart_snapshot(request)
+            if cart.is_empty():
                 return False
 
-            manufacturers = set()
-            for item in cart.items():
-                manufacturers.add(item.product.get_manufacturer())
-
-            result = bool(manufacturers.intersection(self.manufacturers.all()))
+            result = not self.get_value_ids().isdisjoint(
+                                                     cart.manufacturer_ids)
 
         if self.operator == IS:
             return result
         else:
             return not result
 
-    def as_html(self, request, position):
+    def is_valid_many(self, request, products):
+        """Returns dict of product id to True if the criterion is valid for
+        the product. Manufacturers of the products are read from the product
+        attributes table.
+        """
+        rows = get_product_rows(request, products)
+        value_ids = self.get_value_ids()
+        negate = self.operator != IS
+
+        result = {}
+        for product in products:
+            manufacturer_id = rows[product.id].manufacturer_id
+            result[product.id] = (manufacturer_id is not None and
+                                  manufacturer_id in value_ids) != negate
+        return result
+
+    @classmethod
+    def get_q(cls, request):
+        cart = get_cart_snapshot(request)
+        if cart.is_empty():
+            return get_nothing_q()
+        return get_choice_q(Q(operator=IS),
+                            cls.get_value_q(cart.manufacturer_ids))
+
+    def as_html(self, request, position, renderer=None):
         """Renders the criterion as html in order
         to be displayed within several forms.
         """
+        if renderer is None:
+            renderer = CriteriaRenderer(request)
+        all_manufacturers = renderer.get_options('manufacturers', lambda: list(
+                                Manufacturer.objects.order_by('name')
+                                            .values_list('id', 'name')))
 
         manufacturers = []
-        self_manufacturers = self.manufacturers.all()
-        for manufacturer in Manufacturer.objects.all().order_by('name'):
-            if manufacturer in self_manufacturers:
-                selected = True
-            else:
-                selected = False
-
+        self_manufacturers = self.get_value_ids()
+        for id, name in all_manufacturers:
             manufacturers.append({
-                "id": manufacturer.id,
-                "name": manufacturer.name,
-                "selected": selected,
+                "id": id,
+                "name": name,
+                "selected": id in self_manufacturers,
             })
 
-        return render_to_string("manage/criteria/manufacturer_criterion.html",
-                                RequestContext(request, {
+        return renderer.render("manage/criteria/manufacturer_criterion.html", {
             "id": "ex%s" % self.id,
             "operator": self.operator,
             "value": self.value,
@@ -578,10 +872,82 @@ class ManufacturerCriterion(Criterion):
             "manufacturers": manufacturers,
             "content_type": self.content_type,
             "types": CriterionRegistrator.items(),
-        }))
+        })
+
+
+def get_midnights(now, days):
+    """Returns the starts of the given number of days following now.
+    """
+    midnight = datetime.datetime.combine(now.date(), datetime.time())
+    return [midnight + datetime.timedelta(days=day)
+            for day in range(1, days + 1)]
+
+
+class ClockCriterion(NumberCriterion):
+    """Base class for criteria, which compare a value of the current time.
+
+    The result changes only at known instants, so ``get_next_flip`` tells
+    until when the result stays the same and plans look the clock criteria
+    up in their schedule (see ``lfs_criterion_extra.schedule``).
+    """
+    cost = COST_REQUEST
+    depends_on = (DEPENDS_CLOCK,)
+    uses_product = False
+
+    class Meta:
+        abstract = True
 
+    def is_valid(self, request, product=None):
+        return self.is_valid_at(datetime.datetime.now())
 
-class TimeCriterion(NumberCriterion):
+    def is_valid_at(self, now):
+        """Returns True if the criterion is valid at the given datetime.
+        """
+        return bool(self.test_value(self.get_clock_value(now)))
+
+    @classmethod
+    def get_q(cls, request):
+        return get_number_q(cls.value_attr,
+                            cls.get_clock_value(datetime.datetime.now()))
+
+    @classmethod
+    def get_clock_value(cls, now):
+        """Returns the value of the datetime, which is compared with the
+        value of the criterion.
+        """
+        raise NotImplementedError()
+
+    def get_boundaries(self, now):
+        """Returns ascending instants after now, at which the result may
+        change. The result between them is constant and the instants cover
+        a whole period of the clock value, if the result repeats.
+        """
+        raise NotImplementedError()
+
+    def get_next_flip(self, now):
+        """Returns the first instant after now, at which the result of
+        ``is_valid_at`` changes, or None if it never changes.
+        """
+        valid = self.is_valid_at(now)
+        for instant in self.get_boundaries(now):
+            if self.is_valid_at(instant) != valid:
+                return instant
+        return None
+
+
+def clean_form_value(criterion_type, form_field, value):
+    """Converts the value passed via request body with the form field.
+    Raises ValidationError for empty or invalid values, so the criteria are
+    not saved.
+    """
+    try:
+        return form_field.clean(value)
+    except ValidationError as e:
+        raise ValidationError([u"%s: %s" % (criterion_type.name, message)
+                               for message in e.messages])
+
+
+class TimeCriterion(ClockCriterion):
 
     time = models.TimeField(_(u"Time"), default=datetime.time(0, 0))
     value_attr = 'time'
@@ -590,17 +956,69 @@ class TimeCriterion(NumberCriterion):
     widget = forms.TimeInput
 
     @classmethod
-    def create(self, operator, value, request=None):
+    def clean_value(cls, value):
+        return clean_form_value(cls, forms.TimeField(), value)
 
-        value = forms.TimeField().to_python(value)
+    @classmethod
+    def get_clock_value(cls, now):
+        return now.time()
 
-        c = self.objects.create(operator=operator)
-        c.value = value
-        c.save()
-        return c
+    def get_boundaries(self, now):
+        # the time is passed at the value and right after it (for less than
+        # equal and greater than) and wraps at midnight
+        instants = get_midnights(now, 1)
+        for day in (now.date(), now.date() + datetime.timedelta(days=1)):
+            instant = datetime.datetime.combine(day, self.time)
+            instants.extend([instant,
+                             instant + datetime.timedelta(microseconds=1)])
+        return sorted(instant for instant in instants if instant > now)
 
-    def is_valid(self, request, product=None):
-        return self.test_value(datetime.datetime.now().time())
+
+class DateCriterion(ClockCriterion):
+
+    date = models.DateField(_(u"Date"), default=datetime.date.today)
+    value_attr = 'date'
+    content_type = u"date"
+    name = _(u"Date")
+    widget = forms.DateInput
+
+    @classmethod
+    def clean_value(cls, value):
+        return clean_form_value(cls, forms.DateField(), value)
+
+    @classmethod
+    def get_clock_value(cls, now):
+        return now.date()
+
+    def get_boundaries(self, now):
+        instant = datetime.datetime.combine(self.date, datetime.time())
+        return [instant for instant
+                in (instant, instant + datetime.timedelta(days=1))
+                if instant > now]
+
+
+class WeekdayCriterion(ClockCriterion):
+
+    weekday = models.PositiveSmallIntegerField(
+                  _(u"Weekday"), default=0, choices=sorted(WEEKDAYS.items()))
+    value_attr = 'weekday'
+    content_type = u"weekday"
+    name = _(u"Weekday")
+    widget = forms.Select(choices=sorted(WEEKDAYS.items()))
+
+    @classmethod
+    def clean_value(cls, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return 0
+
+    @classmethod
+    def get_clock_value(cls, now):
+        return now.weekday()
+
+    def get_boundaries(self, now):
+        return get_midnights(now, 7)
 
 
 class CartAmountCriterion(NumberCriterion):
@@ -608,16 +1026,23 @@ class CartAmountCriterion(NumberCriterion):
     amount = models.IntegerField(_(u"Сart amount"), default=0)
     value_attr = u'amount'
     content_type = u"amount"
+    cost = COST_CART
+    depends_on = (DEPENDS_CART,)
+    uses_product = False
     name = _(u"Cart amount")
 
     def is_valid(self, request, product=None):
-        cart = get_cart(request)
-        if not cart or not cart.items():
+        cart = get_cart_snapshot(request)
+        if cart.is_empty():
             return False
-        amount = 0
-        for item in cart.items():
-            amount += item.amount
-        return self.test_value(amount)
+        return self.test_value(cart.amount)
+
+    @classmethod
+    def get_q(cls, request):
+        cart = get_cart_snapshot(request)
+        if cart.is_empty():
+            return get_nothing_q()
+        return get_number_q(cls.value_attr, cart.amount)
 
 
 class MaxWeightCriterion(NumberCriterion):
@@ -625,21 +1050,32 @@ class MaxWeightCriterion(NumberCriterion):
     max_weight = models.IntegerField(_(u"Max weight"), default=0.)
     value_attr = u'max_weight'
     content_type = u"max_weight"
+    cost = COST_CART
+    depends_on = (DEPENDS_CART,)
     name = _(u"Max weight")
 
     def is_valid(self, request, product=None):
 
         if product:
-            return self.test_value(product.weight)
+            return self.test_value(get_product_row(request, product).weight)
 
-        cart = get_cart(request)
-        if not cart or not cart.items():
+        cart = get_cart_snapshot(request)
+        if cart.is_empty():
             return False
 
-        max_weight = cart.items()\
-                         .aggregate(max_weight=Max('product__weight'))
-        max_weight = max_weight['max_weight']
-        return self.test_value(max_weight)
+        return self.test_value(cart.max_weight)
+
+    def is_valid_many(self, request, products):
+        rows = get_product_rows(request, products)
+        return dict((product.id, self.test_value(rows[product.id].weight))
+                    for product in products)
+
+    @classmethod
+    def get_q(cls, request):
+        cart = get_cart_snapshot(request)
+        if cart.is_empty():
+            return get_nothing_q()
+        return get_number_q(cls.value_attr, cart.max_weight)
 
 
 class ForSaleCriterion(Criterion):
@@ -650,26 +1086,40 @@ class ForSaleCriterion(Criterion):
     for_sale = models.BooleanField(verbose_name=_(u"For sale"), default=True)
     value_attr = 'for_sale'
     content_type = 'for_sale'
+    cost = COST_CART
+    depends_on = (DEPENDS_CART,)
     name = _(u"For sale")
 
     def is_valid(self, request, product=None):
         """Returns True if the criterion is valid.
         """
         if product:
-            result = product.get_for_sale()
+            result = get_product_row(request, product).for_sale
         else:
-            cart = get_cart(request)
-            if cart is None or not cart.items().exists():
+            cart = get_cart_snapshot(request)
+            if cart.is_empty():
                 return False
 
-            result = any(item.product.get_for_sale()
-                         for item in cart.items())
+            result = cart.for_sale
 
         if self.operator == IS:
             return result
         else:
             return not result
 
+    def is_valid_many(self, request, products):
+        rows = get_product_rows(request, products)
+        negate = self.operator != IS
+        return dict((product.id, rows[product.id].for_sale != negate)
+                    for product in products)
+
+    @classmethod
+    def get_q(cls, request):
+        cart = get_cart_snapshot(request)
+        if cart.is_empty():
+            return get_nothing_q()
+        return Q(operator=IS) if cart.for_sale else ~Q(operator=IS)
+
 
 class ManualDeliveryTimeCriterion(Criterion):
 
@@ -681,28 +1131,45 @@ class ManualDeliveryTimeCriterion(Criterion):
                                default=True)
     value_attr = 'manual_delivery_time'
     content_type = 'manual_delivery_time'
+    cost = COST_CART
+    depends_on = (DEPENDS_CART,)
     name = _(u"Manual delivery time")
 
     def is_valid(self, request, product=None):
         """Returns True if the criterion is valid.
         """
         if product:
-            result = product.manual_delivery_time
+            result = get_product_row(request, product).manual_delivery_time
         else:
-            cart = get_cart(request)
-            if cart is None or not cart.items().exists():
+            cart = get_cart_snapshot(request)
+            if cart.is_empty():
                 return False
 
-            result = any(item.product.manual_delivery_time
-                         for item in cart.items())
+            result = cart.manual_delivery_time
 
         if self.operator == IS:
             return result
         else:
             return not result
 
+    def is_valid_many(self, request, products):
+        rows = get_product_rows(request, products)
+        negate = self.operator != IS
+        return dict((product.id,
+                     rows[product.id].manual_delivery_time != negate)
+                    for product in products)
 
-class FullUserCriterion(Criterion):
+    @classmethod
+    def get_q(cls, request):
+        cart = get_cart_snapshot(request)
+        if cart.is_empty():
+            return get_nothing_q()
+        if cart.manual_delivery_time:
+            return Q(operator=IS)
+        return ~Q(operator=IS)
+
+
+class FullUserCriterion(MultipleValueCriterion):
     """A criterion for user content objects
     """
 
@@ -711,9 +1178,12 @@ class FullUserCriterion(Criterion):
                                            choices=USER_OPERATORS)
     users = models.ManyToManyField(User)
     value_attr = 'users'
-    multiple_value = True
+    prefetch_fields = ('users',)
 
     content_type = u"full_user"
+    cost = COST_REQUEST
+    depends_on = (DEPENDS_USER,)
+    uses_product = False
     name = _(u"User (advanced)")
 
     def is_valid(self, request, product=None):
@@ -726,34 +1196,37 @@ class FullUserCriterion(Criterion):
         elif operator == IS_ANONYMOUS:
             return user.is_anonymous()
         else:
-            result = user in self.users.all()
+            result = user.id in self.get_value_ids()
             return result if operator == IS else not result
 
-    def as_html(self, request, position):
+    def as_html(self, request, position, renderer=None):
         """Renders the criterion as html in order to be displayed
            within several forms.
         """
-        users = []
-        selected_users = self.users.all()
-        # TODO check permission manage shop
-        for user in User.objects.filter(is_active=True):
-            selected = user in selected_users
+        if renderer is None:
+            renderer = CriteriaRenderer(request)
 
-            users.append({
-                "id": user.id,
-                "username": user.username,
-                "selected": selected,
-            })
-
-        return render_to_string("manage/criteria/full_user_criterion.html",
-          RequestContext(request, {
+        # only selected users are rendered, others are searched via
+        # criterion_values view
+        return renderer.render("manage/criteria/full_user_criterion.html", {
             "id": "ex%s" % self.id,
             "operator": self.operator,
-            "users": users,
+            "values": self.get_selected_values('username'),
             "position": position,
             "content_type": self.content_type,
             "types": CriterionRegistrator.items(),
-        }))
+        })
+
+    @classmethod
+    def search_values(cls, term):
+        """Returns (id, username) of the active users, which match the term.
+        """
+        # TODO check permission manage shop
+        users = User.objects.filter(is_active=True)
+        if term:
+            users = users.filter(Q(username__icontains=term) |
+                                 Q(email__icontains=term))
+        return users.order_by('username').values_list('id', 'username')
 
     @classmethod
     def create(cls, operator, value, request=None):
@@ -770,23 +1243,220 @@ class ProfitCriterion(NumberCriterion):
     profit = models.FloatField(_(u"Profit"), default=0.)
     value_attr = u'profit'
     content_type = u"profit"
+    cost = COST_QUERY
     name = _(u"Profit")
 
     def is_valid(self, request, product=None):
+        """Returns True if the criterion is valid.
 
+        Profit of the cart is weighted by the amounts of the products and
+        computed once per cart snapshot.
+        """
         if product is not None:
-            products = [product]
+            profit = self.get_profit([product], {product.id: 1})
         else:
-            cart = get_cart(request)
-            if cart is None or not cart.items().exists():
+            cart = get_cart_snapshot(request)
+            if cart.is_empty():
                 return False
-            product_ids = list(cart.items().values_list('product', flat=True))
-            products = Product.objects.filter(id__in=product_ids)
+            if 'profit' not in cart.memo:
+                cart.memo['profit'] = self.get_profit(cart.products,
+                                                      cart.product_amounts)
+            profit = cart.memo['profit']
+
+        return self.test_value(profit)
 
-        profit = 0.
+    def is_valid_many(self, request, products):
+        self.prefetch_local_products(products)
+        return super(ProfitCriterion, self).is_valid_many(request, products)
+
+    @classmethod
+    def get_profit(cls, products, amounts):
+        """Returns profit of the products weighted by the given dict of
+        product id to amount.
+        """
+        cls.prefetch_local_products(products)
+
+        prices = [product.get_price() for product in products]
+        d_prices = [product.localproduct.get_best_distributor_price()
+                    for product in products]
+        weights = [amounts.get(product.id, 0) for product in products]
+
+        return sum((price - d_price) * weight
+                   for price, d_price, weight in zip(prices, d_prices, weights))
+
+    @classmethod
+    def prefetch_local_products(cls, products):
+        """Loads ``localproduct`` of all the products with one query.
+        """
+        try:
+            related = Product._meta.get_field_by_name('localproduct')[0]
+        except FieldDoesNotExist:
+            return
+
+        cache_name = related.get_cache_name()
+        products = [product for product in products
+                    if not hasattr(product, cache_name)]
+        if not products:
+            return
+
+        lookup = '%s__in' % related.field.name
+        local_products = related.model.objects.filter(
+                             **{lookup: [product.id for product in products]})
+        local_products = dict((getattr(local, related.field.attname), local)
+                              for local in local_products)
         for product in products:
-            price = product.get_price()
-            d_price = product.localproduct.get_best_distributor_price()
-            profit += (price - d_price)
+            if product.id in local_products:
+                setattr(product, cache_name, local_products[product.id])
 
-        return self.test_value(profit)
+
+class OrderStatistics(models.Model):
+    """Closed orders statistics of a customer.
+
+    A customer is the user of the order or the session for anonymous orders.
+    The row without product holds statistics of all orders of the customer,
+    rows with product hold statistics of the orders with this product.
+
+    The rows are updated by the listeners, when order is closed, and may be
+    rebuilt with the ``rebuild_order_statistics`` command.
+    """
+    user = models.ForeignKey(User, verbose_name=_(u"User"),
+                             blank=True, null=True)
+    session = models.CharField(_(u"Session"), blank=True, max_length=100,
+                               db_index=True)
+    product = models.ForeignKey(Product, verbose_name=_(u"Product"),
+                                blank=True, null=True)
+    order_count = models.IntegerField(_(u"Order сount"), default=0)
+    order_summ = models.FloatField(_(u"Order summ"), default=0.)
+
+    objects = OrderStatisticsManager()
+
+    class Meta:
+        unique_together = ('user', 'session', 'product')
+
+    def __unicode__(self):
+        return u"%s %s %s: %s %s" % (self.user, self.session, self.product,
+                                     self.order_count, self.order_summ)
+
+
+# decimal digits of the amounts summed in cart aggregates
+AMOUNT_DIGITS = 6
+
+
+class CartAggregate(models.Model):
+    """Totals of the items of a cart, which the cart criteria read instead
+    of the items (see ``CartSnapshot``).
+
+    The aggregate is built from the items on first access and then updated
+    incrementally by the listeners, when a cart item is added, changed or
+    removed. Aggregates of carts with a changed product are dropped. Items
+    of inactive products are not counted.
+    """
+    cart = models.OneToOneField(Cart, verbose_name=_(u"Cart"),
+                                related_name="criterion_aggregate")
+    item_count = models.IntegerField(_(u"Item count"), default=0)
+    amount = models.FloatField(_(u"Amount"), default=0.)
+    total_weight = models.FloatField(_(u"Total weight"), default=0.)
+    max_weight = models.FloatField(_(u"Max weight"), blank=True, null=True)
+    # json maps of product id to [items, amount, weight], of category id
+    # to amount and of manufacturer id to the number of products
+    product_data = models.TextField(_(u"Products"), default="{}")
+    category_data = models.TextField(_(u"Categories"), default="{}")
+    manufacturer_data = models.TextField(_(u"Manufacturers"), default="{}")
+    # False while the empty row waits to be built from the items, see
+    # ``CartAggregateManager.get_for_cart``
+    built = models.BooleanField(_(u"Built"), default=False)
+
+    objects = CartAggregateManager()
+
+    def __unicode__(self):
+        return u"%s: %s" % (self.cart_id, self.amount)
+
+    def get_map(self, name):
+        """Returns the decoded json map of the field with given name, which
+        is encoded again by ``get_aggregate_values``.
+        """
+        cache_name = '_%s_map' % name
+        if cache_name not in self.__dict__:
+            self.__dict__[cache_name] = dict(
+                (int(key), value) for key, value
+                in simplejson.loads(getattr(self, name)).items())
+        return self.__dict__[cache_name]
+
+    @property
+    def product_amounts(self):
+        return dict((product_id, values[1]) for product_id, values
+                    in self.get_map('product_data').items())
+
+    @property
+    def category_amounts(self):
+        return self.get_map('category_data')
+
+    @property
+    def manufacturer_ids(self):
+        return frozenset(self.get_map('manufacturer_data'))
+
+    def add_item(self, product_id, amount, info, sign=1):
+        """Adds (or substracts with negative sign) the cart item with given
+        product and amount. ``info`` is (weight, manufacturer id, category
+        ids) of the product, see ``managers.get_products_info``.
+        """
+        amount = sign * (amount or 0)
+        weight, manufacturer_id, category_ids = info
+
+        self.item_count += sign
+        # amounts are floats, sums are rounded so no residue is left after
+        # an amount was added and substracted again
+        self.amount = round(self.amount + amount, AMOUNT_DIGITS)
+        self.total_weight = round(self.total_weight + amount * weight,
+                                  AMOUNT_DIGITS)
+
+        categories = self.get_map('category_data')
+        for category_id in category_ids:
+            categories[category_id] = round(
+                categories.get(category_id, 0) + amount, AMOUNT_DIGITS)
+            if not categories[category_id]:
+                del categories[category_id]
+
+        products = self.get_map('product_data')
+        items, product_amount = products.get(product_id, (0, 0))[:2]
+        items += sign
+        if items > 0:
+            products[product_id] = (
+                items, round(product_amount + amount, AMOUNT_DIGITS), weight)
+        else:
+            products.pop(product_id, None)
+
+        # the product was added to the cart or removed from it
+        if (items == 1 and sign > 0) or items <= 0:
+            manufacturers = self.get_map('manufacturer_data')
+            if manufacturer_id is not None:
+                count = manufacturers.get(manufacturer_id, 0) + sign
+                if count > 0:
+                    manufacturers[manufacturer_id] = count
+                else:
+                    manufacturers.pop(manufacturer_id, None)
+
+            if sign > 0:
+                self.max_weight = max(self.max_weight, weight)
+            elif weight >= self.max_weight:
+                self.max_weight = max([values[2] for values
+                                       in products.values()] or [None])
+
+    def get_aggregate_values(self):
+        """Returns the field values of the aggregate.
+        """
+        values = dict((name, getattr(self, name))
+                      for name in ('item_count', 'amount', 'total_weight',
+                                   'max_weight'))
+        for name in ('product_data', 'category_data', 'manufacturer_data'):
+            values[name] = simplejson.dumps(self.get_map(name))
+        return values
+
+    def save(self, *args, **kwargs):
+        for name, value in self.get_aggregate_values().items():
+            setattr(self, name, value)
+        super(CartAggregate, self).save(*args, **kwargs)
+
+
+# connect cache invalidation listeners
+import listeners
@@ -1,14 +1,21 @@
 # python imports
+from collections import namedtuple
 from datetime import datetime
+from functools import wraps
 
 # django imports
 from django.contrib.auth.decorators import permission_required
-from django.db import models
+from django.contrib.contenttypes.models import ContentType
+from django.db import models, transaction
 from django.db.models.base import ModelBase
-from django.http import HttpResponse
+from django.db.models.fields import FieldDoesNotExist
+from django.core.paginator import InvalidPage, Paginator
+from django.http import Http404, HttpResponse
 from django.forms import TextInput
 from django.template import RequestContext
 from django.template.loader import render_to_string
+from django.utils import simplejson
+from django.utils.functional import lazy
 from django.utils.translation import ugettext_lazy as _
 
 #lfs imports
@@ -32,15 +39,33 @@ from lfs.criteria.settings import GREATER_THAN
 from lfs.criteria.settings import GREATER_THAN_EQUAL
 from lfs.criteria.settings import NUMBER_OPERATORS
 
+from lfs_criterion_extra.costs import (COST_CART, COST_QUERY, COST_RECURSIVE,
+                                       COST_REQUEST)
+from lfs_criterion_extra.instrumentation import INSTRUMENTATION, instrument
+from lfs_criterion_extra.rendering import CriteriaRenderer, render_criteria
+
 #imports for patching
 import lfs.criteria.utils
+import lfs.discounts.utils
+import lfs.manage.discounts.views
+import lfs.manage.shipping_methods.views
 import lfs.manage.views.criteria
+import lfs.manage.views.payment
+import lfs.payment.utils
+import lfs.shipping.utils
 
 
 # patching models
+CriterionType = namedtuple('CriterionType', ['id', 'name'])
+
+
 class CriterionRegistrator(ModelBase):
 
     types = dict()
+    # registered types sorted by id, see ``items``
+    _items = ()
+    # incremented on every registration
+    version = 0
 
     def __new__(cls, name, bases, attrs):
         abstract = getattr(attrs.get('Meta'), 'abstract', False)
@@ -52,32 +77,63 @@ class CriterionRegistrator(ModelBase):
 
     @classmethod
     def register(cls, new_class):
-        if new_class.content_type is None:
+        # lfs criteria have content_type and name properties
+        criterion = new_class()
+        if criterion.content_type is None:
             logger.error('registering None criterion type %s' % new_class)
-        cls.types[new_class().content_type] = new_class
+        cls.types[criterion.content_type] = new_class
+
+        items = [item for item in cls._items
+                 if item.id != criterion.content_type]
+        items.append(CriterionType(criterion.content_type,
+                                   lazy(lambda: unicode(criterion.name),
+                                        unicode)()))
+        cls._items = tuple(sorted(items, key=lambda item: item.id))
+        cls.version += 1
+
+        if INSTRUMENTATION:
+            instrument(new_class)
 
     @classmethod
     def items(cls):
-        return [{'id': item().content_type,
-                 'name': item().name} for item in cls.types.values()]
+        """Returns the registered types as tuple of (id, name).
+
+        Names are translated lazily.
+        """
+        return cls._items
 
 
 CriterionRegistrator.register(CountryCriterion)
+CountryCriterion.cost = COST_QUERY
 CountryCriterion.multiple_value = True
+CountryCriterion.prefetch_fields = ('countries',)
 CriterionRegistrator.register(CombinedLengthAndGirthCriterion)
+CombinedLengthAndGirthCriterion.cost = COST_QUERY
 CriterionRegistrator.register(CartPriceCriterion)
+CartPriceCriterion.cost = COST_QUERY
 CriterionRegistrator.register(DistanceCriterion)
+DistanceCriterion.cost = COST_QUERY
 CriterionRegistrator.register(HeightCriterion)
+HeightCriterion.cost = COST_QUERY
 CriterionRegistrator.register(LengthCriterion)
+LengthCriterion.cost = COST_QUERY
 CriterionRegistrator.register(PaymentMethodCriterion)
+PaymentMethodCriterion.cost = COST_RECURSIVE
 PaymentMethodCriterion.multiple_value = True
+PaymentMethodCriterion.prefetch_fields = ('payment_methods',)
 CriterionRegistrator.register(ShippingMethodCriterion)
+ShippingMethodCriterion.cost = COST_RECURSIVE
 ShippingMethodCriterion.multiple_value = True
+ShippingMethodCriterion.prefetch_fields = ('shipping_methods',)
 CriterionRegistrator.register(UserCriterion)
+UserCriterion.cost = COST_REQUEST
 UserCriterion.multiple_value = True
+UserCriterion.prefetch_fields = ('users',)
 UserCriterion.operator = None  # XXX error in django lfs 0.7
 CriterionRegistrator.register(WidthCriterion)
+WidthCriterion.cost = COST_QUERY
 CriterionRegistrator.register(WeightCriterion)
+WeightCriterion.cost = COST_QUERY
 #print CriterionRegistrator.types
 
 
@@ -106,15 +162,39 @@ class Criterion(models.Model, BaseCriterion):
 
     multiple_value = False
 
+    # related fields, which are prefetched when criteria are loaded in batch
+    prefetch_fields = ()
+
+    # static cost class, see ``lfs_criterion_extra.costs``
+    cost = COST_QUERY
+
+    # False if the result does not depend on the product passed to is_valid
+    uses_product = True
+
+    # inputs, which the result without product depends on, None if unknown.
+    # Results of criteria, which depend on the cart only, are cached between
+    # requests, see ``lfs_criterion_extra.results``
+    depends_on = None
+
+    # classmethod (request) returning Q of the criteria of this type, which
+    # are valid for the request without product, see
+    # ``lfs_criterion_extra.filters``
+    get_q = None
+
     operator = None
     name = None
     content_type = None
     widget = TextInput
 
-    def as_html(self, request, position):
+    def as_html(self, request, position, renderer=None):
         """Renders the criterion as html in order to displayed it within several
         forms.
+
+        The rows of all criteria of an object share the renderer, see
+        ``lfs_criterion_extra.rendering``.
         """
+        if renderer is None:
+            renderer = CriteriaRenderer(request)
         template = "manage/criteria/%s_criterion.html" % self.content_type
 
         widget = getattr(self, 'widget', TextInput)
@@ -126,7 +206,7 @@ class Criterion(models.Model, BaseCriterion):
         else:
            cid = "ex%s" % self.id
 
-        return render_to_string(template, RequestContext(request, {
+        return renderer.render(template, {
             "id" : cid,
             "operator" : self.operator,
             "widget_value" : widget.render(name='value-%s' % cid,
@@ -136,24 +216,44 @@ class Criterion(models.Model, BaseCriterion):
             "position" : position,
             "content_type" : self.content_type,
             "types" : CriterionRegistrator.items(),
-        }))
+        })
 
     def is_valid(self, request, product=None):
         raise NotImplementedError()
 
+    def is_valid_many(self, request, products):
+        """Returns dict of product id to the result of ``is_valid`` for the
+        product.
+
+        Criteria, which can check many products at once (with set operations
+        or one query), override this. Others are called per product.
+        """
+        if not self.uses_product:
+            return dict.fromkeys([product.id for product in products],
+                                 self.is_valid(request))
+        return dict((product.id, self.is_valid(request, product))
+                    for product in products)
+
     @classmethod
-    def create(cls, operator, value, request=None):
-        if not cls.multiple_value:
-            try:
-                value = float(value)
-            except (TypeError, ValueError):
-                value = 0.0
+    def clean_value(cls, value):
+        """Converts the value passed via request body.
+        """
+        return clean_criterion_value(cls, value)
 
+    @classmethod
+    def create(cls, operator, value, request=None):
         c = cls.objects.create(operator=operator)
-        c.value = value
+        c.value = cls.clean_value(value)
         c.save()
         return c
 
+    def update(self, operator, value, request=None):
+        """Updates the existing criterion with the operator and value passed
+        via request body. Returns True if the criterion was changed.
+        """
+        return update_criterion_value(self, self.value_attr, operator,
+                                      self.clean_value(value))
+
 
 class NumberCriterion(Criterion):
 
@@ -206,23 +306,301 @@ change_criterion_form.patched = True
 lfs.manage.views.criteria.change_criterion_form = change_criterion_form
 
 
+CRITERION_VALUES_PAGE_SIZE = 20
+
+
+@permission_required("core.manage_shop")
+def criterion_values(request):
+    """Returns a page of values, which match the search term, for the
+    multiple value criterion of the given type (via query string).
+
+    This is called via an AJAX request from the criterion forms, which
+    render only selected values. The result is json:
+    {"values": [[id, name], ...], "has_next": true}
+    """
+    type = request.GET.get("type")
+    criterion_type = CriterionRegistrator.types.get(type)
+    if getattr(criterion_type, 'search_values', None) is None:
+        raise Http404
+
+    values = criterion_type.search_values(request.GET.get("term", ""))
+    paginator = Paginator(values, CRITERION_VALUES_PAGE_SIZE)
+    try:
+        page = paginator.page(request.GET.get("page", 1))
+    except InvalidPage:
+        raise Http404
+
+    result = simplejson.dumps({
+        "values": list(page.object_list),
+        "has_next": page.has_next(),
+    })
+    return HttpResponse(result, mimetype="application/json")
+lfs.manage.views.criteria.criterion_values = criterion_values
+
+
+# criteria tabs rendered with one renderer, see render_criteria
+@permission_required("core.manage_shop", login_url="/login/")
+def shipping_method_criteria(request, shipping_method_id,
+    template_name="manage/shipping_methods/shipping_method_criteria.html"):
+    """Returns the criteria of the shipping method with passed id as HTML.
+    """
+    from lfs.shipping.models import ShippingMethod
+    shipping_method = ShippingMethod.objects.get(pk=shipping_method_id)
+    return render_to_string(template_name, RequestContext(request, {
+        "shipping_method": shipping_method,
+        "criteria": render_criteria(request, shipping_method),
+    }))
+shipping_method_criteria.patched = True
+lfs.manage.shipping_methods.views.shipping_method_criteria = \
+    shipping_method_criteria
+
+
+@permission_required("core.manage_shop", login_url="/login/")
+def payment_method_criteria(request, payment_method_id,
+    template_name="manage/payment/payment_method_criteria.html"):
+    """Returns the criteria of the payment method with passed id as HTML.
+    """
+    from lfs.payment.models import PaymentMethod
+    payment_method = PaymentMethod.objects.get(pk=payment_method_id)
+    return render_to_string(template_name, RequestContext(request, {
+        "payment_method": payment_method,
+        "criteria": render_criteria(request, payment_method),
+    }))
+payment_method_criteria.patched = True
+lfs.manage.views.payment.payment_method_criteria = payment_method_criteria
+
+
+@permission_required("core.manage_shop", login_url="/login/")
+def discount_criteria(request, id,
+                      template_name="manage/discounts/criteria.html"):
+    """Returns the criteria of the discount with passed id as HTML.
+    """
+    from lfs.discounts.models import Discount
+    discount = Discount.objects.get(pk=id)
+    return render_to_string(template_name, RequestContext(request, {
+        "discount": discount,
+        "criteria": render_criteria(request, discount),
+    }))
+discount_criteria.patched = True
+lfs.manage.discounts.views.discount_criteria = discount_criteria
+
+
+@permission_required("core.manage_shop", login_url="/login/")
+def save_discount_criteria(request, id):
+    """Saves the criteria for the discount with given id. The criteria
+    are passed via request body.
+
+    Criteria with invalid values or which would make the discount depend on
+    itself are not saved, the reason is returned as message.
+    """
+    from django.core.exceptions import ValidationError
+    from lfs.core.utils import LazyEncoder
+    from lfs.core.utils import lfs_get_object_or_404
+    from lfs.discounts.models import Discount
+    discount = lfs_get_object_or_404(Discount, pk=id)
+    try:
+        lfs.criteria.utils.save_criteria(request, discount)
+    except ValidationError as e:
+        message = u" ".join(e.messages)
+    else:
+        message = _(u"Modifications have been changed.")
+
+    html = [["#criteria", discount_criteria(request, id)]]
+
+    result = simplejson.dumps({
+        "html": html,
+        "message": message,
+    }, cls=LazyEncoder)
+
+    return HttpResponse(result)
+save_discount_criteria.patched = True
+lfs.manage.discounts.views.save_discount_criteria = save_discount_criteria
+
+
+def report_criteria_errors(view):
+    """Returns the view saving criteria, which returns the message of the
+    ValidationError raised by ``save_criteria`` instead of failing. The
+    criteria are not saved.
+    """
+    from django.core.exceptions import ValidationError
+    from lfs.core.utils import LazyEncoder
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except ValidationError as e:
+            result = simplejson.dumps({
+                "html": [],
+                "message": u" ".join(e.messages),
+            }, cls=LazyEncoder)
+            return HttpResponse(result)
+    wrapper.patched = True
+    return wrapper
+
+for module, name in (
+        (lfs.manage.shipping_methods.views, 'save_shipping_method_criteria'),
+        (lfs.manage.shipping_methods.views, 'save_shipping_price_criteria'),
+        (lfs.manage.views.payment, 'save_payment_method_criteria'),
+        (lfs.manage.views.payment, 'save_payment_price_criteria')):
+    setattr(module, name, report_criteria_errors(getattr(module, name)))
+
+
 # patching utils
+
+# value fields of the lfs criteria, which have no create method
+OLD_CRITERIA_FIELDS = {
+    "country": "countries",
+    "payment_method": "payment_methods",
+    "shipping_method": "shipping_methods",
+    "user": "users",
+    "combinedlengthandgirth": "clag",
+    "price": "price",
+    "height": "height",
+    "length": "length",
+    "width": "width",
+    "weight": "weight",
+    "distance": "distance",
+}
+
+
+def clean_criterion_value(criterion_type, value):
+    """Converts the value of the criterion passed via request body.
+    """
+    if getattr(criterion_type, 'multiple_value', False):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def update_criterion_value(criterion, value_attr, operator, value):
+    """Sets operator and value of the existing criterion, if they differ.
+    Returns True if the criterion was changed.
+    """
+    changed = False
+    # many to many values are saved on assignment
+    needs_save = False
+    try:
+        field = criterion._meta.get_field('operator')
+    except FieldDoesNotExist:
+        pass
+    else:
+        if operator in (None, ''):
+            operator = None
+        else:
+            operator = field.to_python(operator)
+        if criterion.operator != operator:
+            criterion.operator = operator
+            changed = needs_save = True
+
+    if getattr(criterion, 'multiple_value', False):
+        if hasattr(criterion, 'get_value_ids'):
+            old_ids = set(unicode(pk) for pk in criterion.get_value_ids())
+        else:
+            old_ids = set(unicode(obj.pk)
+                          for obj in getattr(criterion, value_attr).all())
+        if old_ids != set(unicode(pk) for pk in value):
+            setattr(criterion, value_attr, value)
+            changed = True
+    elif getattr(criterion, value_attr) != value:
+        setattr(criterion, value_attr, value)
+        changed = needs_save = True
+
+    if needs_save:
+        criterion.save()
+    return changed
+
+
+def create_criterion(criterion_type, operator, value, request):
+    """Creates a criterion of the given type with the operator and value
+    passed via request body.
+    """
+    if hasattr(criterion_type, 'create'):
+        return criterion_type.create(operator, value, request)
+
+    # old criterions
+    c = criterion_type.objects.create(operator=operator)
+    setattr(c, OLD_CRITERIA_FIELDS[c.content_type],
+            clean_criterion_value(criterion_type, value))
+    c.save()
+    return c
+
+
+def update_criterion(criterion, operator, value, request):
+    """Updates the existing criterion in place. Returns True if the criterion
+    was changed or None if the criterion can't be updated.
+    """
+    if hasattr(criterion, 'update'):
+        return criterion.update(operator, value, request)
+
+    value_attr = OLD_CRITERIA_FIELDS.get(criterion.content_type)
+    if value_attr is None:
+        return None
+    return update_criterion_value(criterion, value_attr, operator,
+                                  clean_criterion_value(type(criterion), value))
+
+
+def get_criterion_pk(criterion_type, id):
+    """Returns the primary key of the existing criterion, which form fields
+    have the given id, or None for a new criterion.
+    """
+    for prefix in ("ex", criterion_type.content_type):
+        if id.startswith(prefix) and id[len(prefix):].isdigit():
+            return int(id[len(prefix):])
+    return None
+
+
 def save_criteria(request, object):
     """Saves the criteria for the given object. The criteria are passed via
     request body.
+
+    Passed criteria are compared with the existing ones. Criteria, which are
+    still there, are updated in place and keep their ids. Removed criteria
+    are deleted and new ones created in bulk.
     """
-    # First we delete all existing criteria objects for the given object.
-    for co in object.criteria_objects.all():
-        co.criterion.delete()
-        co.delete()
+    from lfs_criterion_extra.plans import invalidate_plans
+    from lfs_criterion_extra.results import invalidate_results
+    update_criteria(request, object)
+
+    # neither bulk_create nor update send signals. Versions are changed
+    # after the commit, versions changed by listeners within the
+    # transaction may have been used by concurrent requests to compile the
+    # old criteria
+    invalidate_plans()
+    invalidate_results()
+save_criteria.patched = True
+lfs.criteria.utils.save_criteria = save_criteria
 
 
-    # Then we add all passed criteria to the shipping method.
+@transaction.commit_on_success
+def update_criteria(request, object):
+    """Updates the criteria of the object within one transaction, see
+    ``save_criteria``.
+    """
+    from lfs.discounts.models import Discount
+    if isinstance(object, Discount):
+        # Discount must not depend on itself via discount criteria.
+        from lfs_criterion_extra.discounts import check_discount_dependencies
+        discount_ids = []
+        for key, type_ in request.POST.items():
+            if key.startswith("type") and type_ == "discounts":
+                id = key.split("-", 1)[-1]
+                discount_ids.extend(request.POST.getlist("value-%s" % id))
+        check_discount_dependencies(object, discount_ids)
+
+    existing = dict(((co.criterion_type_id, co.criterion_id), co)
+                    for co in object.criteria_objects.all())
+    criteria = get_criteria_by_key(existing.values())
+
+    kept = set()
+    new_criteria_objects = []
     for key, type_ in request.POST.items():
         if key.startswith("type"):
             try:
                 id = key.split("-")[1]
-            except KeyError:
+            except IndexError:
                 continue
 
             # Get the operator and value for the calculated id
@@ -233,69 +611,237 @@ def save_criteria(request, object):
                 value = request.POST.getlist("value-%s" % id)
             else:
                 value = request.POST.get("value-%s" % id)
+            position = request.POST.get("position-%s" % id)
 
-            if hasattr(criterion_type, 'create'):
-                c = criterion_type.create(operator, value, request)
-            else:
-                # old criterions
-                c = criterion_type.objects.create(operator=operator)
-                if type_ == "country":
-                    c.countries = value
-                elif type_ == "payment_method":
-                    c.payment_methods = value
-                elif type_ == "shipping_method":
-                    c.shipping_methods = value
-                elif type_ == "user":
-                    c.users = value
-                elif type_ == "combinedlengthandgirth":
-                    try:
-                        value = float(value)
-                    except (TypeError, ValueError):
-                        value = 0.0
-                    c.clag = value
-                elif type_ == "price":
-                    try:
-                        value = float(value)
-                    except (TypeError, ValueError):
-                        value = 0.0
-                    c.price = value
-                elif type_ == "height":
-                    try:
-                        value = float(value)
-                    except (TypeError, ValueError):
-                        value = 0.0
-                    c.height = value
-                elif type_ == "length":
-                    try:
-                        value = float(value)
-                    except (TypeError, ValueError):
-                        value = 0.0
-                    c.length = value
-                elif type_ == "width":
-                    try:
-                        value = float(value)
-                    except (TypeError, ValueError):
-                        value = 0.0
-                    c.width = value
-                elif type_ == "weight":
-                    try:
-                        value = float(value)
-                    except (TypeError, ValueError):
-                        value = 0.0
-                    c.weight = value
-                elif type_ == "distance":
-                    try:
-                        value = float(value)
-                    except (TypeError, ValueError):
-                        value = 0.0
-                    c.distance = value
-
-                c.save()
+            criterion_key = (
+                ContentType.objects.get_for_model(criterion_type).id,
+                get_criterion_pk(criterion_type, id))
+            co = existing.get(criterion_key)
+            c = criteria.get(criterion_key)
+            if (co is not None and c is not None and
+                    criterion_key not in kept and
+                    update_criterion(c, operator, value, request) is not None):
+                kept.add(criterion_key)
+                if unicode(co.position) != unicode(position):
+                    CriteriaObjects.objects.filter(pk=co.pk)\
+                                           .update(position=position)
+                continue
 
-            position = request.POST.get("position-%s" % id)
-            CriteriaObjects.objects.create(content=object,
-                                           criterion=c,
-                                           position=position)
+            c = create_criterion(criterion_type, operator, value, request)
+            new_criteria_objects.append(CriteriaObjects(content=object,
+                                                        criterion=c,
+                                                        position=position))
+
+    removed = [co for criterion_key, co in existing.items()
+               if criterion_key not in kept]
+    if removed:
+        CriteriaObjects.objects.filter(pk__in=[co.pk for co in removed])\
+                               .delete()
+        removed_ids = {}
+        for co in removed:
+            removed_ids.setdefault(co.criterion_type_id,
+                                   []).append(co.criterion_id)
+        for criterion_type_id, ids in removed_ids.items():
+            model = ContentType.objects.get_for_id(criterion_type_id)\
+                                       .model_class()
+            if model is not None:
+                model.objects.filter(pk__in=ids).delete()
+
+    CriteriaObjects.objects.bulk_create(new_criteria_objects)
+
+
+def get_valid_discounts(request, product=None):
+    """Returns all valid discounts as a list.
+
+    Discounts are evaluated in dependency order and each discount only
+    once, see ``lfs_criterion_extra.discounts``. Discounts outside of the
+    time window of their clock criteria are not evaluated at all. Without
+    product most discounts are rejected by their compiled criteria in the
+    database, see ``lfs_criterion_extra.filters``.
+    """
+    from lfs.discounts.models import Discount
+    from lfs_criterion_extra.discounts import (is_discount_valid,
+                                               sort_discounts)
+    from lfs_criterion_extra.filters import get_valid_objects
+    from lfs_criterion_extra.schedule import get_active_objects
+
+    if product is None:
+        valid_discounts = get_valid_objects(request, Discount.objects.all())
+    else:
+        all_discounts = list(Discount.objects.all())
+        active = set(discount.id
+                     for discount in get_active_objects(all_discounts))
+        valid = {}
+        for discount in sort_discounts(all_discounts):
+            valid[discount.id] = (discount.id in active and
+                                  is_discount_valid(request, discount,
+                                                    product))
+        valid_discounts = [discount for discount in all_discounts
+                           if valid[discount.id]]
+
+    discounts = []
+    for discount in valid_discounts:
+        discounts.append({
+            "id": discount.id,
+            "name": discount.name,
+            "sku": discount.sku,
+            "price_net": discount.get_price_net(request, product),
+            "price_gross": discount.get_price_gross(request, product),
+            "tax": discount.get_tax(request, product)
+        })
+
+    return discounts
+get_valid_discounts.patched = True
+lfs.discounts.utils.get_valid_discounts = get_valid_discounts
+
+
+# batched criteria evaluation
+def get_criteria_many(objects):
+    """Returns a dict of the given objects to the lists of their criteria
+    ordered by position.
+
+    The criteria of all objects are loaded with one query per content type
+    of the objects plus one query (and the prefetches) per criterion type.
+    """
+    criteria = dict((object, []) for object in objects)
 
-save_criteria.patched = True
-lfs.criteria.utils.save_criteria = save_criteria
+    owners = {}
+    for object in criteria:
+        content_type = ContentType.objects.get_for_model(object)
+        owners.setdefault(content_type.id, {})[object.pk] = object
+
+    criteria_objects = []
+    for content_type_id, objects_by_id in owners.items():
+        criteria_objects.extend(CriteriaObjects.objects.filter(
+                                    content_type=content_type_id,
+                                    content_id__in=objects_by_id.keys()))
+
+    criteria_by_id = get_criteria_by_key(criteria_objects)
+
+    criteria_objects.sort(key=lambda co: (co.position, co.id))
+    for co in criteria_objects:
+        criterion = criteria_by_id.get((co.criterion_type_id, co.criterion_id))
+        if criterion is None:
+            # criterion was deleted without its criteria object
+            continue
+        object = owners[co.content_type_id][co.content_id]
+        criteria[object].append(criterion)
+
+    return criteria
+
+
+def get_criteria_by_key(criteria_objects):
+    """Returns dict of (criterion type id, criterion id) to the criteria of
+    the given criteria objects.
+
+    Criteria are loaded with one query (and the prefetches) per criterion
+    type.
+    """
+    criterion_ids = {}
+    for co in criteria_objects:
+        criterion_ids.setdefault(co.criterion_type_id,
+                                 set()).add(co.criterion_id)
+
+    criteria_by_key = {}
+    for criterion_type_id, ids in criterion_ids.items():
+        model = ContentType.objects.get_for_id(criterion_type_id).model_class()
+        if model is None:
+            continue
+        queryset = model.objects.filter(pk__in=ids)
+        prefetch_fields = getattr(model, 'prefetch_fields', ())
+        if prefetch_fields:
+            queryset = queryset.prefetch_related(*prefetch_fields)
+        for criterion in queryset:
+            criteria_by_key[(criterion_type_id, criterion.pk)] = criterion
+    return criteria_by_key
+
+
+def is_valid(request, object, product=None):
+    """Returns True if the given object is valid. This is calculated via the
+    attached criteria.
+
+    The criteria are evaluated from the compiled plan of the object, see
+    ``lfs_criterion_extra.plans``.
+    """
+    from lfs_criterion_extra.plans import get_plan
+    return get_plan(object).is_valid(request, product)
+is_valid.patched = True
+lfs.criteria.utils.is_valid = is_valid
+
+
+def is_valid_batch(request, objects, product=None):
+    """Returns a dict of the given objects to True if the object is valid.
+
+    Like ``lfs.criteria.utils.is_valid``, but the plans of all objects
+    are looked up at once.
+    """
+    from lfs_criterion_extra.plans import get_plans
+    from lfs_criterion_extra.results import get_cart_results
+    plans = get_plans(objects)
+
+    # cached results of the cart-only criteria of all plans are looked up
+    # at once
+    cacheable = [evaluator for plan in plans.values()
+                 for evaluator in plan.get_cacheable_evaluators()]
+    if product is None and cacheable:
+        results = get_cart_results(request)
+        if results is not None:
+            results.load(cacheable)
+
+    result = {}
+    for object, plan in plans.items():
+        result[object] = plan.is_valid(request, product)
+    return result
+lfs.criteria.utils.is_valid_batch = is_valid_batch
+
+
+def is_valid_many(request, object, products):
+    """Returns dict of product id to True if the given object is valid for
+    the product, e.g. for shipping badges of a product listing.
+
+    Every criterion checks all products at once, see
+    ``Criterion.is_valid_many``.
+    """
+    from lfs_criterion_extra.plans import get_plan
+    return get_plan(object).is_valid_many(request, products)
+lfs.criteria.utils.is_valid_many = is_valid_many
+
+
+def get_first_valid(request, objects, product=None):
+    """Returns the first valid object of given objects.
+
+    Passed objects are objects which can have criteria. At the momemnt these are
+    shipping or payment methods.
+    """
+    from lfs_criterion_extra.plans import get_plans
+    objects = list(objects)
+    plans = get_plans(objects)
+    for object in objects:
+        if plans[object].is_valid(request, product):
+            return object
+    return None
+get_first_valid.patched = True
+lfs.criteria.utils.get_first_valid = get_first_valid
+
+
+def get_valid_shipping_methods(request, product=None):
+    """Returns a list of all valid shipping methods for the passed request.
+    """
+    from lfs.shipping.models import ShippingMethod
+    shipping_methods = list(ShippingMethod.objects.filter(active=True))
+    valid = is_valid_batch(request, shipping_methods, product)
+    return [sm for sm in shipping_methods if valid[sm]]
+get_valid_shipping_methods.patched = True
+lfs.shipping.utils.get_valid_shipping_methods = get_valid_shipping_methods
+
+
+def get_valid_payment_methods(request):
+    """Returns all valid payment methods (aka. selectable) for given request
+    as list.
+    """
+    from lfs.payment.models import PaymentMethod
+    payment_methods = list(PaymentMethod.objects.filter(active=True))
+    valid = is_valid_batch(request, payment_methods)
+    return [pm for pm in payment_methods if valid[pm]]
+get_valid_payment_methods.patched = True
+lfs.payment.utils.get_valid_payment_methods = get_valid_payment_methods
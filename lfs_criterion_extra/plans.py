@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# compiled criteria of the objects, which have criteria
+import datetime
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
+
+from lfs.discounts.models import Discount
+
+from lfs_criterion_extra import costs
+from lfs_criterion_extra.monkey import get_criteria_many
+from lfs_criterion_extra.results import get_cart_results, is_cacheable
+from lfs_criterion_extra.schedule import Schedule, is_clock_criterion
+
+
+PLAN_CACHE_SIZE = getattr(settings, 'CRITERION_PLAN_CACHE_SIZE', 1000)
+
+# process-local LRU of (content type id, object id) to (version, plan)
+_plans = OrderedDict()
+_plans_lock = threading.Lock()
+
+
+class CriterionEvaluator(object):
+    """Compiled criterion.
+
+    Holds the field values, the related objects of ``prefetch_fields`` and
+    the value ids of the criterion. The criterion instance is rebuilt from
+    them without queries when the evaluator is used first.
+    """
+    __slots__ = ('criterion_type', 'id', 'operator', 'value', 'value_ids',
+                 'fields', 'related', 'attrs', '_criterion')
+
+    def __init__(self, criterion, owner=None):
+        self.criterion_type = type(criterion)
+        self.id = criterion.pk
+        self.operator = getattr(criterion, 'operator', None)
+        self.fields = dict((field.attname, getattr(criterion, field.attname))
+                           for field in criterion._meta.fields)
+
+        self.related = {}
+        prefetched = getattr(criterion, '_prefetched_objects_cache', {})
+        for name in getattr(criterion, 'prefetch_fields', ()):
+            if name in prefetched:
+                self.related[name] = list(prefetched[name])
+
+        self.value_ids = None
+        self.value = None
+        value_attr = getattr(criterion, 'value_attr', None)
+        if hasattr(criterion, 'get_value_ids'):
+            self.value_ids = criterion.get_value_ids()
+        elif value_attr and not getattr(criterion, 'multiple_value', False):
+            self.value = getattr(criterion, value_attr)
+
+        self.attrs = {}
+        if hasattr(criterion, 'is_discount_criterion'):
+            self.attrs['_is_discount'] = isinstance(owner, Discount)
+        self._criterion = None
+
+    def __getstate__(self):
+        return dict((name, getattr(self, name))
+                    for name in self.__slots__ if name != '_criterion')
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._criterion = None
+
+    def get_criterion(self):
+        """Returns the criterion instance with its prefetched relations.
+        """
+        criterion = self._criterion
+        if criterion is None:
+            criterion = self.criterion_type(**self.fields)
+            prefetched = {}
+            for name, objects in self.related.items():
+                queryset = getattr(criterion, name).all()
+                queryset._result_cache = list(objects)
+                queryset._prefetch_done = True
+                prefetched[name] = queryset
+            criterion._prefetched_objects_cache = prefetched
+            if self.value_ids is not None:
+                criterion._value_ids = self.value_ids
+            criterion.__dict__.update(self.attrs)
+            self._criterion = criterion
+        return criterion
+
+    def is_valid(self, request, product=None, results=None):
+        """Returns the result of the criterion. Results of cart-only
+        criteria without product are taken from and added to the given
+        cart results.
+        """
+        if results is None or product is not None or \
+           not is_cacheable(self.criterion_type):
+            return self.get_criterion().is_valid(request, product)
+
+        valid = results.get(self)
+        if valid is None:
+            valid = self.get_criterion().is_valid(request)
+            if valid is not None:
+                results.set(self, valid)
+        return valid
+
+    def is_valid_many(self, request, products):
+        criterion = self.get_criterion()
+        is_valid_many = getattr(criterion, 'is_valid_many', None)
+        if is_valid_many is not None:
+            return is_valid_many(request, products)
+        # criteria of lfs and other apps are called per product
+        return dict((product.id, criterion.is_valid(request, product))
+                    for product in products)
+
+
+class CriterionPlan(object):
+    """Compiled criteria of an object ordered by position.
+
+    Clock criteria are not evaluated one by one, their results are looked
+    up in the schedule of the plan, which is built once per process and
+    horizon.
+    """
+    __slots__ = ('evaluators', '_schedule')
+
+    def __init__(self, evaluators):
+        self.evaluators = tuple(evaluators)
+        self._schedule = None
+
+    def __getstate__(self):
+        return {'evaluators': self.evaluators}
+
+    def __setstate__(self, state):
+        self.evaluators = state['evaluators']
+        self._schedule = None
+
+    def __len__(self):
+        return len(self.evaluators)
+
+    def is_valid(self, request, product=None):
+        """Returns True if all criteria are valid.
+
+        With ``CRITERION_COST_ORDERING`` setting criteria are evaluated in
+        order of their cost (see ``costs.get_cost_key``) instead of their
+        position. In some calls the criteria, which are evaluated, are
+        timed to measure their cost.
+        """
+        sample = costs.COST_ORDERING and costs.should_sample()
+        if not self.get_clock_state()[0]:
+            return False
+
+        results = None
+        cacheable = self.get_cacheable_evaluators()
+        if product is None and cacheable:
+            results = get_cart_results(request)
+            if results is not None:
+                results.load(cacheable)
+
+        for evaluator in self.get_ordered_evaluators():
+            if sample:
+                start = time.time()
+                valid = evaluator.is_valid(request, product, results)
+                costs.add_sample(evaluator.criterion_type,
+                                 time.time() - start, valid == False)
+            else:
+                valid = evaluator.is_valid(request, product, results)
+            if valid == False:
+                return False
+        return True
+
+    def is_valid_many(self, request, products):
+        """Returns dict of product id to True if all criteria are valid for
+        the product.
+
+        Every criterion checks the products, which are still valid, at once.
+        """
+        valid = list(products)
+        if not self.get_clock_state()[0]:
+            valid = []
+        for evaluator in self.get_ordered_evaluators():
+            if not valid:
+                break
+            results = evaluator.is_valid_many(request, valid)
+            valid = [product for product in valid
+                     if results[product.id] != False]
+
+        result = dict.fromkeys([product.id for product in products], False)
+        result.update(dict.fromkeys([product.id for product in valid], True))
+        return result
+
+    def get_ordered_evaluators(self):
+        """Returns the evaluators except clock criteria by position or by
+        cost with ``CRITERION_COST_ORDERING`` setting.
+        """
+        evaluators = [evaluator for evaluator in self.evaluators
+                      if not is_clock_criterion(evaluator.criterion_type)]
+        if not costs.COST_ORDERING:
+            return evaluators
+        stats = costs.get_stats()
+        return sorted(evaluators, key=lambda evaluator:
+                      costs.get_cost_key(evaluator.criterion_type, stats))
+
+    def get_cacheable_evaluators(self):
+        """Returns the evaluators of cart-only criteria, which results are
+        cached between requests, see ``lfs_criterion_extra.results``.
+        """
+        return [evaluator for evaluator in self.evaluators
+                if is_cacheable(evaluator.criterion_type)]
+
+    def get_clock_state(self, now=None):
+        """Returns (valid, until): True if all clock criteria are valid now
+        and the instant, until which this does not change (None for ever).
+        """
+        if now is None:
+            now = datetime.datetime.now()
+        schedule = self._schedule
+        if schedule is None or not schedule.covers(now):
+            criteria = [evaluator.get_criterion()
+                        for evaluator in self.evaluators
+                        if is_clock_criterion(evaluator.criterion_type)]
+            schedule = self._schedule = Schedule(criteria, now)
+        return schedule.lookup(now)
+
+    def get_next_flip(self, now=None):
+        """Returns the instant, at which the result of the clock criteria
+        changes next, e.g. as expiry of cached results, or None.
+        """
+        return self.get_clock_state(now)[1]
+
+
+def get_plan_version_key():
+    return "%s-criterion-plans-version" % settings.CACHE_MIDDLEWARE_KEY_PREFIX
+
+
+def get_plan_cache_key(content_type_id, object_id, version):
+    return "%s-criterion-plan-%s-%s-%s" % (
+               settings.CACHE_MIDDLEWARE_KEY_PREFIX,
+               content_type_id, object_id, version)
+
+
+def get_plan_version():
+    version_key = get_plan_version_key()
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex)
+        version = cache.get(version_key)
+    return version
+
+
+def compile_plans(objects):
+    """Returns dict of the given objects to their new compiled plans.
+    """
+    return dict((object, CriterionPlan(CriterionEvaluator(criterion, object)
+                                       for criterion in criteria))
+                for object, criteria in get_criteria_many(objects).items())
+
+
+def get_plans(objects):
+    """Returns dict of the given objects to their compiled plans.
+
+    Plans are looked up in the process-local LRU, then in the cache and
+    compiled from the database at last. All plans are dropped when
+    ``invalidate_plans`` was called in any process.
+    """
+    version = get_plan_version()
+    plans = {}
+    missing = {}
+    with _plans_lock:
+        for object in objects:
+            content_type = ContentType.objects.get_for_model(object)
+            key = (content_type.id, object.pk)
+            entry = _plans.pop(key, None)
+            if entry is not None and entry[0] == version:
+                _plans[key] = entry
+                plans[object] = entry[1]
+            else:
+                missing[get_plan_cache_key(content_type.id, object.pk,
+                                           version)] = (key, object)
+
+    if not missing:
+        return plans
+
+    found = {}
+    cached = cache.get_many(missing.keys())
+    for cache_key, (key, object) in missing.items():
+        if cache_key in cached:
+            found[key] = plans[object] = cached[cache_key]
+
+    compiled = compile_plans([object for cache_key, (key, object)
+                              in missing.items()
+                              if cache_key not in cached])
+    to_cache = {}
+    for cache_key, (key, object) in missing.items():
+        if object in compiled:
+            found[key] = plans[object] = to_cache[cache_key] = compiled[object]
+    if to_cache:
+        cache.set_many(to_cache)
+
+    with _plans_lock:
+        for key, plan in found.items():
+            _plans[key] = (version, plan)
+        while len(_plans) > PLAN_CACHE_SIZE:
+            _plans.popitem(last=False)
+
+    return plans
+
+
+def get_plan(object):
+    return get_plans([object])[object]
+
+
+def invalidate_plans():
+    with _plans_lock:
+        _plans.clear()
+    cache.set(get_plan_version_key(), uuid.uuid4().hex)
@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+# criteria rows of an object rendered with one context
+from django.template import RequestContext
+from django.template.loader import get_template
+
+
+class CriteriaRenderer(object):
+    """Renders the criterion rows of the management forms.
+
+    The ``RequestContext`` (and so the context processors) is built once,
+    templates are compiled once and option lists of the criteria, e.g. all
+    groups, are loaded once per renderer, see ``get_options``.
+    """
+
+    def __init__(self, request, owner=None):
+        self.request = request
+        # the object, which criteria are rendered, if known
+        self.owner = owner
+        self.context = RequestContext(request)
+        self.templates = {}
+        self.options = {}
+
+    def get_options(self, name, load):
+        """Returns the option list with given name, which is loaded with
+        the load function on first use.
+        """
+        if name not in self.options:
+            self.options[name] = load()
+        return self.options[name]
+
+    def render(self, template_name, values):
+        template = self.templates.get(template_name)
+        if template is None:
+            template = get_template(template_name)
+            self.templates[template_name] = template
+
+        self.context.update(values)
+        try:
+            return template.render(self.context)
+        finally:
+            self.context.pop()
+
+
+def render_criteria(request, object):
+    """Returns the html rows of the criteria of the object.
+
+    Criteria are loaded with their selected values in one query per
+    criterion type (see ``get_criteria_many``) and rendered with one
+    renderer. Criteria of lfs, which do not take a renderer, are rendered
+    as before.
+    """
+    from lfs_criterion_extra.models import Criterion
+    from lfs_criterion_extra.monkey import get_criteria_many
+
+    renderer = CriteriaRenderer(request, object)
+    rows = []
+    position = 0
+    for criterion in get_criteria_many([object])[object]:
+        position += 10
+        if isinstance(criterion, Criterion):
+            rows.append(criterion.as_html(request, position, renderer))
+        else:
+            rows.append(criterion.as_html(request, position))
+    return rows
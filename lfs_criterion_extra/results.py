@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+# results of the cart-only criteria kept in the cache between requests
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+
+from lfs.cart.utils import get_cart
+
+
+# inputs, which the result of a criterion depends on, see
+# ``Criterion.depends_on``
+DEPENDS_CART = 'cart'
+DEPENDS_USER = 'user'
+DEPENDS_CLOCK = 'clock'
+DEPENDS_ORDERS = 'orders'
+
+RESULT_CACHE = getattr(settings, 'CRITERION_RESULT_CACHE', False)
+# seconds, the cache backend evicts results earlier if it is full
+RESULT_CACHE_TIMEOUT = getattr(settings, 'CRITERION_RESULT_CACHE_TIMEOUT',
+                               60 * 60)
+
+RESULTS_ATTR = '_criterion_results'
+
+# changed with every invalidation in this process, so results of a request
+# are looked up again after criteria or carts were changed within it
+_generation = 0
+
+
+def is_cacheable(criterion_type):
+    """Returns True if the result of the criterion without product depends
+    on the cart only.
+    """
+    depends_on = getattr(criterion_type, 'depends_on', None)
+    return depends_on is not None and set(depends_on) == set([DEPENDS_CART])
+
+
+def get_version(version_key):
+    version = cache.get(version_key)
+    if version is None:
+        cache.add(version_key, uuid.uuid4().hex)
+        version = cache.get(version_key)
+    return version
+
+
+def get_results_version_key():
+    return "%s-criterion-results-version" % (
+               settings.CACHE_MIDDLEWARE_KEY_PREFIX)
+
+
+def get_cart_version_key(cart_id):
+    return "%s-criterion-cart-version-%s" % (
+               settings.CACHE_MIDDLEWARE_KEY_PREFIX, cart_id)
+
+
+class CartResults(object):
+    """Results of the cart-only criteria for the cart of the current request.
+
+    Results are keyed by the criterion and the version of the cart, which
+    changes with every change of the cart, and the version of all results,
+    which changes with the criteria, products and categories. Old results
+    are not deleted, they expire.
+    """
+
+    def __init__(self, cart_id):
+        self.cart_id = cart_id
+        self.generation = _generation
+        self.prefix = "%s-criterion-result-%s-%s-%s" % (
+                          settings.CACHE_MIDDLEWARE_KEY_PREFIX, cart_id,
+                          get_version(get_cart_version_key(cart_id)),
+                          get_version(get_results_version_key()))
+        # cache key to result of the criteria looked up in this request
+        self.results = {}
+
+    def get_key(self, evaluator):
+        return "%s-%s%s" % (self.prefix, evaluator.criterion_type.content_type,
+                            evaluator.id)
+
+    def load(self, evaluators):
+        """Looks up the results of the given evaluators with one cache
+        query.
+        """
+        keys = [self.get_key(evaluator) for evaluator in evaluators]
+        keys = [key for key in keys if key not in self.results]
+        if keys:
+            found = cache.get_many(keys)
+            for key in keys:
+                self.results[key] = found.get(key)
+
+    def get(self, evaluator):
+        """Returns the result of the evaluator or None if it is not known.
+        """
+        key = self.get_key(evaluator)
+        if key not in self.results:
+            self.results[key] = cache.get(key)
+        return self.results[key]
+
+    def set(self, evaluator, valid):
+        key = self.get_key(evaluator)
+        self.results[key] = valid
+        cache.set(key, valid, RESULT_CACHE_TIMEOUT)
+
+
+def get_cart_results(request):
+    """Returns the results of the cart of the current request or None if
+    results are not cached (no cart or ``CRITERION_RESULT_CACHE = False``).
+    """
+    if not RESULT_CACHE:
+        return None
+    cart = get_cart(request)
+    if cart is None:
+        return None
+
+    results = request.__dict__.get(RESULTS_ATTR)
+    if results is None or results.cart_id != cart.id or \
+       results.generation != _generation:
+        results = CartResults(cart.id)
+        request.__dict__[RESULTS_ATTR] = results
+    return results
+
+
+def invalidate_cart_results(cart_id):
+    global _generation
+    cache.set(get_cart_version_key(cart_id), uuid.uuid4().hex)
+    _generation += 1
+
+
+def invalidate_results():
+    global _generation
+    cache.set(get_results_version_key(), uuid.uuid4().hex)
+    _generation += 1
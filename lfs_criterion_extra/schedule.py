@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# validity intervals of the clock criteria of the objects
+import bisect
+import datetime
+
+from django.conf import settings
+
+
+# instants, which are looked ahead when a schedule is built
+SCHEDULE_HORIZON = datetime.timedelta(
+                       days=getattr(settings, 'CRITERION_SCHEDULE_DAYS', 8))
+
+
+def is_clock_criterion(criterion_type):
+    """Returns True if the result of the criterion depends on the clock only,
+    see ``lfs_criterion_extra.models.ClockCriterion``.
+    """
+    return hasattr(criterion_type, 'get_next_flip')
+
+
+class Schedule(object):
+    """Intervals, in which all given clock criteria are valid or not, from
+    the start up to the horizon.
+
+    Intervals are kept as sorted starts, so the result at an instant is a
+    bisection instead of evaluating the criteria.
+    """
+    __slots__ = ('start', 'end', 'starts', 'valid')
+
+    def __init__(self, criteria, start, horizon=SCHEDULE_HORIZON):
+        self.start = start
+        self.starts = []
+        self.valid = []
+
+        end = start + horizon
+        instant = start
+        while instant is not None and instant < end:
+            valid = all(criterion.is_valid_at(instant)
+                        for criterion in criteria)
+            if not self.valid or self.valid[-1] != valid:
+                self.starts.append(instant)
+                self.valid.append(valid)
+            flips = [criterion.get_next_flip(instant)
+                     for criterion in criteria]
+            flips = [flip for flip in flips if flip is not None]
+            instant = min(flips) if flips else None
+
+        # None if the result never changes after the last start
+        self.end = end if instant is not None else None
+
+    def covers(self, now):
+        return self.start <= now and (self.end is None or now < self.end)
+
+    def lookup(self, now):
+        """Returns (valid, until) at the given instant, which the schedule
+        covers.
+
+        ``until`` is the next instant, at which the result changes, the end
+        of the schedule, if the result changes later, or None if it never
+        changes.
+        """
+        i = bisect.bisect_right(self.starts, now) - 1
+        if i + 1 < len(self.starts):
+            until = self.starts[i + 1]
+        else:
+            until = self.end
+        return self.valid[i], until
+
+
+def get_active_objects(objects, now=None):
+    """Returns the given objects, which clock criteria are valid now, e.g.
+    the discounts, which are in their time window.
+
+    Other criteria of the objects are not evaluated.
+    """
+    from lfs_criterion_extra.plans import get_plans
+    if now is None:
+        now = datetime.datetime.now()
+    objects = list(objects)
+    plans = get_plans(objects)
+    return [object for object in objects
+            if plans[object].get_clock_state(now)[0]]
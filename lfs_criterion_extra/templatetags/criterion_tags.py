@@ -1,20 +1,42 @@
 # -*- coding: utf-8 -*-
 import re
 from django.template import Library
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+from django.utils.translation import get_language
 
 from lfs_criterion_extra.models import CriterionRegistrator
 
 
 register = Library()
 
+# rendered type options per language and registry version
+_type_options = {}
+
+
+def get_type_options():
+    """Returns the rendered options of all criterion types for the active
+    language. None of the options is selected.
+    """
+    key = (get_language(), CriterionRegistrator.version)
+    options = _type_options.get(key)
+    if options is None:
+        types = sorted(CriterionRegistrator.items(),
+                       key=lambda type: unicode(type.name))
+        options = render_to_string('manage/criteria/type_options.html',
+                                   {'types': types})
+        _type_options[key] = options
+    return options
+
 
 @register.inclusion_tag('manage/criteria/types.html', takes_context=True)
 def types(context):
-    types = context.get('types')
-    if types is None:
-        context['types'] = CriterionRegistrator.items()
+    id = context['id']
     content_type = context.get('content_type')
-    if types is None:
-        id = context['id']
-        context['content_type'] = re.sub("\d+", "", id)
-    return context
\ No newline at end of file
+    if content_type is None:
+        content_type = re.sub("\d+", "", id)
+
+    option = u'<option value="%s">' % content_type
+    options = get_type_options().replace(
+        option, u'<option value="%s" selected="selected">' % content_type, 1)
+    return {'id': id, 'options': mark_safe(options)}
@@ -1,16 +1,1356 @@
-"""
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
 
-Replace this with more appropriate tests for your application.
-"""
+from lfs.cart.models import Cart, CartItem
+from lfs.catalog.models import Category, Product
+from lfs.core.signals import cart_changed
+from lfs.criteria.settings import IS, IS_NOT, IS_VALID, IS_NOT_VALID
+from lfs.criteria.settings import GREATER_THAN
+from lfs.manufacturer.models import Manufacturer
 
-from django.test import TestCase
+from lfs_criterion_extra.cart import get_cart_snapshot
+from lfs_criterion_extra.models import (IS_WITH_SUBCATEGORIES,
+                                        IS_NOT_WITH_SUBCATEGORIES,
+                                        CartAmountCriterion,
+                                        CategoryCriterion,
+                                        ManufacturerCriterion,
+                                        MaxWeightCriterion,
+                                        ProductCriterion)
+from lfs_criterion_extra.plans import invalidate_plans
+
+
+class CriterionTestCase(TestCase):
+    """Creates a small catalog and a cart of the anonymous user.
+    """
+
+    def setUp(self):
+        # cached values are keyed by ids, which are reused between tests
+        cache.clear()
+        invalidate_plans()
+
+        self.manufacturer = Manufacturer.objects.create(name="m1")
+        self.category_1 = Category.objects.create(name="c1", slug="c1")
+        self.category_2 = Category.objects.create(name="c2", slug="c2")
+
+        self.product_1 = Product.objects.create(name="p1", slug="p1",
+                                                active=True, weight=5,
+                                                manufacturer=self.manufacturer)
+        self.product_2 = Product.objects.create(name="p2", slug="p2",
+                                                active=True, weight=10)
+        self.product_3 = Product.objects.create(name="p3", slug="p3",
+                                                active=True, weight=1)
+        self.category_1.products.add(self.product_1)
+        self.category_2.products.add(self.product_2)
+
+        session = SessionStore()
+        session.save()
+
+        self.request = RequestFactory().get('/')
+        self.request.session = session
+        self.request.user = AnonymousUser()
+
+        self.cart = Cart.objects.create(session=session.session_key)
+        CartItem.objects.create(cart=self.cart, product=self.product_1,
+                                amount=2)
+        CartItem.objects.create(cart=self.cart, product=self.product_2,
+                                amount=3)
+
+
+class CartSnapshotTest(CriterionTestCase):
+
+    def test_snapshot(self):
+        cart = get_cart_snapshot(self.request)
+        self.assertEqual(cart.amount, 5)
+        self.assertEqual(cart.max_weight, 10)
+        self.assertEqual(cart.product_ids,
+                         set([self.product_1.id, self.product_2.id]))
+        self.assertEqual(cart.category_ids,
+                         set([self.category_1.id, self.category_2.id]))
+        self.assertEqual(cart.manufacturer_ids, set([self.manufacturer.id]))
+
+    def test_snapshot_is_shared(self):
+        cart = get_cart_snapshot(self.request)
+        cart.items
+        self.assertNumQueries(0, lambda: get_cart_snapshot(self.request).items)
+
+    def test_snapshot_is_dropped_on_cart_changed(self):
+        cart = get_cart_snapshot(self.request)
+        cart_changed.send(self.cart, request=self.request)
+        self.assertFalse(get_cart_snapshot(self.request) is cart)
+
+    def test_cart_criteria(self):
+        c = CategoryCriterion.objects.create(operator=IS)
+        c.categories.add(self.category_2)
+        self.assertTrue(c.is_valid(self.request))
+        self.assertFalse(c.is_valid(self.request, self.product_3))
+
+        c = ProductCriterion.objects.create(operator=IS_NOT)
+        c.products.add(self.product_3)
+        self.assertTrue(c.is_valid(self.request))
+
+        c = ManufacturerCriterion.objects.create(operator=IS)
+        c.manufacturers.add(self.manufacturer)
+        self.assertTrue(c.is_valid(self.request))
+
+        c = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                               amount=4)
+        self.assertTrue(c.is_valid(self.request))
+
+        c = MaxWeightCriterion.objects.create(operator=GREATER_THAN,
+                                              max_weight=10)
+        self.assertFalse(c.is_valid(self.request))
+
+
+class CartAggregateTest(CriterionTestCase):
+
+    def get_values(self, aggregate):
+        return (aggregate.item_count, aggregate.amount,
+                aggregate.total_weight, aggregate.max_weight,
+                aggregate.product_amounts, aggregate.category_amounts,
+                aggregate.manufacturer_ids)
+
+    def test_aggregate(self):
+        from lfs_criterion_extra.models import CartAggregate
+
+        aggregate = CartAggregate.objects.get_for_cart(self.cart)
+        self.assertEqual(self.get_values(aggregate), (
+            2, 5, 40, 10,
+            {self.product_1.id: 2, self.product_2.id: 3},
+            {self.category_1.id: 2, self.category_2.id: 3},
+            set([self.manufacturer.id])))
+
+        # totals are read without the items
+        cart = get_cart_snapshot(self.request)
+        self.assertNumQueries(1, lambda: cart.max_weight)
+
+    def test_incremental_update(self):
+        from lfs_criterion_extra.models import CartAggregate
+
+        CartAggregate.objects.get_for_cart(self.cart)
+        item = CartItem.objects.create(cart=self.cart,
+                                       product=self.product_3, amount=1)
+        item.amount = 4
+        item.save()
+        CartItem.objects.filter(product=self.product_1).delete()
+
+        aggregate = CartAggregate.objects.get(cart=self.cart)
+        self.assertEqual(self.get_values(aggregate), (
+            2, 7, 34, 10,
+            {self.product_2.id: 3, self.product_3.id: 4},
+            {self.category_2.id: 3},
+            set()))
+        self.assertEqual(self.get_values(aggregate), self.get_values(
+            CartAggregate.objects.build(self.cart)))
+
+        # aggregates are built again after changes of the products
+        self.product_2.weight = 20
+        self.product_2.save()
+        self.assertEqual(CartAggregate.objects.get_for_cart(self.cart)
+                                              .max_weight, 20)
+
+        # and kept after changes of other fields
+        aggregate = CartAggregate.objects.get(cart=self.cart)
+        self.product_2.stock_amount = 10
+        self.product_2.save()
+        self.assertEqual(CartAggregate.objects.get(cart=self.cart).pk,
+                         aggregate.pk)
+
+    def test_float_amounts(self):
+        from lfs_criterion_extra.models import CartAggregate
+
+        CartAggregate.objects.get_for_cart(self.cart)
+        item = CartItem.objects.get(cart=self.cart, product=self.product_1)
+        for amount in (0.1, 0.2, 0.7, 0.3):
+            item.amount = amount
+            item.save()
+        # the category of the removed items is dropped
+        self.category_2.products.add(self.product_3)
+        CartItem.objects.create(cart=self.cart, product=self.product_3,
+                                amount=0.1)
+        CartAggregate.objects.get_for_cart(self.cart)
+        for amount in (0.2, 0.7):
+            CartItem.objects.create(cart=self.cart, product=self.product_3,
+                                    amount=amount)
+        CartItem.objects.filter(product__in=[self.product_1,
+                                             self.product_3]).delete()
+
+        aggregate = CartAggregate.objects.get(cart=self.cart)
+        self.assertEqual(self.get_values(aggregate), (
+            1, 3, 30, 10,
+            {self.product_2.id: 3},
+            {self.category_2.id: 3},
+            set()))
+
+    def test_cart_without_aggregate(self):
+        from lfs_criterion_extra.models import CartAggregate
+
+        # old values, the save and the lookup of the aggregate, products of
+        # carts without aggregate are not read
+        item = CartItem.objects.get(cart=self.cart, product=self.product_1)
+        item.amount = 3
+        self.assertNumQueries(4, item.save)
+        self.assertFalse(CartAggregate.objects.filter(cart=self.cart)
+                                              .exists())
+
+    def test_item_saved_before_build(self):
+        from lfs_criterion_extra.models import CartAggregate
+
+        # the empty row of a concurrent request, which is not built yet
+        CartAggregate.objects.create_empty(self.cart)
+        CartItem.objects.create(cart=self.cart, product=self.product_3,
+                                amount=1)
+        aggregate = CartAggregate.objects.get_for_cart(self.cart)
+        self.assertTrue(aggregate.built)
+        self.assertEqual(aggregate.amount, 6)
+        self.assertEqual(self.get_values(aggregate), self.get_values(
+            CartAggregate.objects.get(cart=self.cart)))
+
+
+class BatchEvaluationTest(CriterionTestCase):
+
+    def test_is_valid_batch(self):
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.criteria.utils import get_first_valid, is_valid_batch
+        from lfs.shipping.models import ShippingMethod
+
+        sm_1 = ShippingMethod.objects.create(name="sm1", active=True)
+        sm_2 = ShippingMethod.objects.create(name="sm2", active=True)
+        sm_3 = ShippingMethod.objects.create(name="sm3", active=True)
+
+        c = CategoryCriterion.objects.create(operator=IS_NOT)
+        c.categories.add(self.category_1)
+        CriteriaObjects.objects.create(content=sm_1, criterion=c)
+        c = CategoryCriterion.objects.create(operator=IS)
+        c.categories.add(self.category_1)
+        CriteriaObjects.objects.create(content=sm_2, criterion=c)
+        c = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                               amount=1)
+        CriteriaObjects.objects.create(content=sm_2, criterion=c)
+
+        self.assertEqual(is_valid_batch(self.request, [sm_1, sm_2, sm_3]),
+                         {sm_1: False, sm_2: True, sm_3: True})
+        self.assertEqual(get_first_valid(self.request, [sm_1, sm_2, sm_3]),
+                         sm_2)
+
+    def test_valid_checkout_methods(self):
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.payment.models import PaymentMethod
+        from lfs.payment.utils import get_valid_payment_methods
+        from lfs.shipping.models import ShippingMethod
+        from lfs.shipping.utils import get_valid_shipping_methods
+
+        sm_1 = ShippingMethod.objects.create(name="sm1", active=True)
+        sm_2 = ShippingMethod.objects.create(name="sm2", active=True)
+        pm_1 = PaymentMethod.objects.create(name="pm1", active=True)
+        pm_2 = PaymentMethod.objects.create(name="pm2", active=True)
+        c = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                               amount=100)
+        CriteriaObjects.objects.create(content=sm_1, criterion=c)
+        c = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                               amount=100)
+        CriteriaObjects.objects.create(content=pm_2, criterion=c)
+
+        self.assertEqual(get_valid_shipping_methods(self.request), [sm_2])
+        self.assertEqual(get_valid_payment_methods(self.request), [pm_1])
+
+    def test_is_valid_many(self):
+        from lfs.criteria.models import CriteriaObjects, WeightCriterion
+        from lfs.criteria.settings import LESS_THAN
+        from lfs.criteria.utils import is_valid_many
+        from lfs.shipping.models import ShippingMethod
+        from lfs_criterion_extra.models import OrderCountCriterion
+
+        c_1 = CategoryCriterion.objects.create(operator=IS_NOT)
+        c_1.categories.add(self.category_2)
+        c_2 = ManufacturerCriterion.objects.create(operator=IS)
+        c_2.manufacturers.add(self.manufacturer)
+        c_3 = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                                 amount=1)
+        c_4 = OrderCountCriterion.objects.create(operator=GREATER_THAN,
+                                                 order_count=0)
+        ids = [self.product_1.id, self.product_2.id, self.product_3.id]
+        products = lambda: list(Product.objects.filter(id__in=ids))
+
+        for c in (c_1, c_2, c_3, c_4):
+            expected = dict((product.id, c.is_valid(self.request, product))
+                            for product in products())
+            self.assertEqual(c.is_valid_many(self.request, products()),
+                             expected)
+
+        # categories and manufacturers are read from the attributes table
+        many = products()
+        self.assertNumQueries(0, lambda: c_1.is_valid_many(self.request,
+                                                            many))
+        self.assertNumQueries(0, lambda: c_2.is_valid_many(self.request,
+                                                            many))
+        del self.request._criterion_order_statistics
+        self.assertNumQueries(1, lambda: c_4.is_valid_many(self.request,
+                                                            many))
+
+        # the category tree is looked up once per batch
+        from lfs_criterion_extra import models
+        c_5 = CategoryCriterion.objects.create(operator=IS_WITH_SUBCATEGORIES)
+        c_5.categories.add(self.category_1)
+        get_category_ancestors = models.get_category_ancestors
+        calls = []
+        models.get_category_ancestors = lambda: calls.append(1) or \
+                                                get_category_ancestors()
+        try:
+            self.assertEqual(c_5.is_valid_many(self.request, many),
+                             {self.product_1.id: True,
+                              self.product_2.id: False,
+                              self.product_3.id: False})
+        finally:
+            models.get_category_ancestors = get_category_ancestors
+        self.assertEqual(len(calls), 1)
+
+        sm = ShippingMethod.objects.create(name="sm", active=True)
+        CriteriaObjects.objects.create(content=sm, criterion=c_1)
+        CriteriaObjects.objects.create(content=sm, criterion=c_2)
+        CriteriaObjects.objects.create(content=sm, criterion=c_3)
+        # criteria of lfs have no is_valid_many
+        weight = WeightCriterion.objects.create(operator=LESS_THAN, weight=7)
+        CriteriaObjects.objects.create(content=sm, criterion=weight)
+        self.assertEqual(is_valid_many(self.request, sm, products()),
+                         {self.product_1.id: True,
+                          self.product_2.id: False,
+                          self.product_3.id: False})
+
+
+class ProductAttributesTest(CriterionTestCase):
+
+    def test_attributes(self):
+        from lfs.catalog.settings import CHOICES_STANDARD, VARIANT
+        from lfs_criterion_extra import attributes as attributes_module
+        from lfs_criterion_extra.attributes import (ProductRow,
+                                                    get_product_attributes,
+                                                    get_product_rows)
+
+        variant = Product.objects.create(name="v1", slug="v1", active=True,
+                                         sub_type=VARIANT,
+                                         parent=self.product_1,
+                                         active_for_sale=CHOICES_STANDARD)
+        self.product_1.for_sale = True
+        self.product_1.manual_delivery_time = True
+        self.product_1.save()
+
+        attributes = get_product_attributes()
+        self.assertEqual(attributes.get(variant.id),
+                         ProductRow(self.category_1.id,
+                                    self.manufacturer.id, True, 5., True))
+        self.assertEqual(attributes.get(self.product_3.id),
+                         ProductRow(None, None, False, 1., False))
+
+        # rows of the table are equal to the rows of the products
+        products = list(Product.objects.all())
+        attributes_module.PRODUCT_ATTRIBUTES = False
+        try:
+            rows = get_product_rows(None, products)
+        finally:
+            attributes_module.PRODUCT_ATTRIBUTES = True
+        for product in products:
+            self.assertEqual(attributes.get(product.id), rows[product.id])
+
+        # the table is built again after a product was changed
+        self.product_3.for_sale = True
+        self.product_3.save()
+        self.assertTrue(get_product_attributes().get(self.product_3.id)
+                                                .for_sale)
+
+        # the table is kept after changes of other fields (lfs itself
+        # clears the cache on every product change)
+        from lfs_criterion_extra import listeners
+        invalidate = listeners.invalidate_product_attributes
+        calls = []
+        listeners.invalidate_product_attributes = lambda: calls.append(1)
+        try:
+            self.product_3.stock_amount = 10
+            self.product_3.save()
+            Product.objects.create(name="p4", slug="p4")
+        finally:
+            listeners.invalidate_product_attributes = invalidate
+        self.assertEqual(calls, [])
+
+    def test_product_criteria(self):
+        from lfs_criterion_extra.attributes import get_product_attributes
+        from lfs_criterion_extra.models import ManualDeliveryTimeCriterion
+
+        get_product_attributes(self.request)
+        weight = MaxWeightCriterion.objects.create(operator=GREATER_THAN,
+                                                   max_weight=4)
+        manual = ManualDeliveryTimeCriterion.objects.create(operator=IS)
+
+        # products are not read
+        product = Product(id=self.product_1.id)
+        self.assertNumQueries(0, lambda: (
+            self.assertTrue(weight.is_valid(self.request, product)),
+            self.assertFalse(manual.is_valid(self.request, product))))
+
+        self.product_2.manual_delivery_time = True
+        self.product_2.save()
+        del self.request._criterion_product_attributes
+        products = list(Product.objects.all())
+        for c in (weight, manual):
+            expected = dict((product.id, c.is_valid(self.request, product))
+                            for product in products)
+            self.assertNumQueries(0, lambda: self.assertEqual(
+                c.is_valid_many(self.request, products), expected))
+        self.assertEqual(manual.is_valid_many(self.request, products),
+                         {self.product_1.id: False,
+                          self.product_2.id: True,
+                          self.product_3.id: False})
+
+
+class PlanTest(CriterionTestCase):
+
+    def test_plan(self):
+        import pickle
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.criteria.utils import is_valid
+        from lfs.shipping.models import ShippingMethod
+        from lfs_criterion_extra.plans import get_plan
+
+        sm = ShippingMethod.objects.create(name="sm", active=True)
+        c = CategoryCriterion.objects.create(operator=IS)
+        c.categories.add(self.category_1)
+        CriteriaObjects.objects.create(content=sm, criterion=c, position=1)
+        amount = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                                    amount=1)
+        CriteriaObjects.objects.create(content=sm, criterion=amount,
+                                       position=2)
+
+        self.assertTrue(is_valid(self.request, sm))
+        plan = get_plan(sm)
+        self.assertEqual([evaluator.id for evaluator in plan.evaluators],
+                         [c.id, amount.id])
+        self.assertEqual(plan.evaluators[0].value_ids,
+                         set([self.category_1.id]))
+        self.assertEqual(plan.evaluators[1].value, 1)
+
+        # criteria are not loaded again
+        get_cart_snapshot(self.request).items
+        self.assertNumQueries(0, lambda: is_valid(self.request, sm))
+
+        plan = pickle.loads(pickle.dumps(plan))
+        self.assertTrue(plan.is_valid(self.request))
+
+        # plans are dropped on change
+        amount.amount = 10
+        amount.save()
+        self.assertFalse(is_valid(self.request, sm))
+
+
+class ResultCacheTest(CriterionTestCase):
+
+    def setUp(self):
+        super(ResultCacheTest, self).setUp()
+        from lfs_criterion_extra import results
+        self.assertEqual(results.get_cart_results(self.request), None)
+        results.RESULT_CACHE = True
+
+    def tearDown(self):
+        from lfs_criterion_extra import results
+        results.RESULT_CACHE = False
+        super(ResultCacheTest, self).tearDown()
+
+    def test_cart_results(self):
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.criteria.utils import is_valid
+        from lfs.shipping.models import ShippingMethod
+        from lfs_criterion_extra.plans import get_plan
+        from lfs_criterion_extra.results import get_cart_results
+
+        sm = ShippingMethod.objects.create(name="sm", active=True)
+        amount = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                                    amount=4)
+        CriteriaObjects.objects.create(content=sm, criterion=amount)
+
+        def get_request():
+            request = RequestFactory().get('/')
+            request.session = self.request.session
+            request.user = self.request.user
+            return request
+
+        self.assertTrue(is_valid(get_request(), sm))
+        evaluator = get_plan(sm).evaluators[0]
+        self.assertEqual(get_cart_results(get_request()).get(evaluator), True)
+        # the cart is not loaded in the next request
+        self.assertNumQueries(0, lambda: is_valid(get_request(), sm))
+
+        # results are dropped on changes of the cart and of the criteria
+        CartItem.objects.filter(product=self.product_2).delete()
+        self.assertFalse(is_valid(get_request(), sm))
+        amount.amount = 1
+        amount.save()
+        self.assertTrue(is_valid(get_request(), sm))
+
+
+class CostOrderingTest(CriterionTestCase):
+
+    def test_cost_ordering(self):
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.criteria.settings import GREATER_THAN_EQUAL
+        from lfs.shipping.models import ShippingMethod
+        from lfs_criterion_extra import costs
+        from lfs_criterion_extra.models import (OrderCountCriterion,
+                                                TimeCriterion)
+        from lfs_criterion_extra.plans import get_plan
+
+        sm = ShippingMethod.objects.create(name="sm", active=True)
+        amount = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                                    amount=100)
+        CriteriaObjects.objects.create(content=sm, criterion=amount,
+                                       position=1)
+        time = TimeCriterion.objects.create(operator=GREATER_THAN_EQUAL)
+        CriteriaObjects.objects.create(content=sm, criterion=time,
+                                       position=2)
+        count = OrderCountCriterion.objects.create(operator=GREATER_THAN)
+        CriteriaObjects.objects.create(content=sm, criterion=count,
+                                       position=0)
+        plan = get_plan(sm)
+        self.assertFalse(plan.is_valid(self.request))
+        self.assertTrue(costs.get_cost_key(TimeCriterion) <
+                        costs.get_cost_key(CartAmountCriterion))
+
+        cost_ordering = costs.COST_ORDERING
+        sample_rate = costs.COST_SAMPLE_RATE
+        costs.COST_ORDERING = True
+        try:
+            costs.COST_SAMPLE_RATE = 0
+            self.assertFalse(plan.is_valid(self.request))
+            costs.COST_SAMPLE_RATE = 1
+            self.assertFalse(plan.is_valid(self.request))
+            stats = costs.get_stats()
+            self.assertEqual(stats[CartAmountCriterion][2], 1.)
+            # clock criteria are looked up in the schedule and criteria
+            # after the rejection are not evaluated
+            self.assertFalse(TimeCriterion in stats)
+            self.assertFalse(OrderCountCriterion in stats)
+        finally:
+            costs.COST_ORDERING = cost_ordering
+            costs.COST_SAMPLE_RATE = sample_rate
+            costs.clear_stats()
+
+
+class FiltersTest(CriterionTestCase):
+
+    def test_valid_objects(self):
+        import datetime
+        from django.contrib.auth.models import Group
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.criteria.settings import (EQUAL, GREATER_THAN_EQUAL,
+                                           LESS_THAN, LESS_THAN_EQUAL)
+        from lfs.criteria.utils import is_valid
+        from lfs.shipping.models import ShippingMethod
+        from lfs_criterion_extra.filters import get_valid_objects
+        from lfs_criterion_extra.models import (DiscountCriterion,
+                                                ForSaleCriterion,
+                                                GroupCriterion,
+                                                OrderCountCriterion,
+                                                TimeCriterion,
+                                                WeekdayCriterion)
+
+        group = Group.objects.create(name="g")
+        tomorrow = (datetime.date.today().weekday() + 1) % 7
+        number_operators = (LESS_THAN, LESS_THAN_EQUAL, GREATER_THAN,
+                            GREATER_THAN_EQUAL, EQUAL, None)
+        criteria = []
+        for operator in (IS, IS_NOT, None):
+            criteria.append(ProductCriterion.create(operator,
+                                                    [self.product_1.id]))
+            criteria.append(ProductCriterion.create(operator,
+                                                    [self.product_3.id]))
+            criteria.append(ManufacturerCriterion.create(
+                                operator, [self.manufacturer.id]))
+            criteria.append(ForSaleCriterion.create(operator, True))
+            criteria.append(GroupCriterion.create(operator, [group.id]))
+        for operator in (IS, IS_NOT, IS_WITH_SUBCATEGORIES,
+                         IS_NOT_WITH_SUBCATEGORIES, None):
+            criteria.append(CategoryCriterion.create(operator,
+                                                     [self.category_1.id]))
+            criteria.append(CategoryCriterion.create(operator, []))
+        for operator in number_operators:
+            for amount in (4, 5, 6):
+                criteria.append(CartAmountCriterion.create(operator, amount))
+            criteria.append(MaxWeightCriterion.create(operator, 10))
+            criteria.append(OrderCountCriterion.create(operator, 0))
+            criteria.append(TimeCriterion.create(operator, "00:00"))
+            criteria.append(WeekdayCriterion.create(operator, tomorrow))
+        criteria.append(DiscountCriterion.create(IS_VALID, []))
+
+        for criterion in criteria:
+            sm = ShippingMethod.objects.create(name="sm", active=True)
+            CriteriaObjects.objects.create(content=sm, criterion=criterion)
+        sm = ShippingMethod.objects.create(name="sm", active=True)
+        CriteriaObjects.objects.create(content=sm, criterion=criteria[0])
+        CriteriaObjects.objects.create(content=sm, criterion=criteria[-1])
+
+        empty = RequestFactory().get('/')
+        empty.session = SessionStore()
+        empty.user = AnonymousUser()
+        for request in (self.request, empty):
+            expected = [sm for sm in ShippingMethod.objects.all()
+                        if is_valid(request, sm)]
+            self.assertEqual(get_valid_objects(request,
+                                               ShippingMethod.objects.all()),
+                             expected)
+
+
+class GroupCriterionTest(CriterionTestCase):
+
+    def test_group_criterion(self):
+        from django.contrib.auth.models import Group, User
+        from lfs_criterion_extra.groups import GROUPS_ATTR
+        from lfs_criterion_extra.models import GroupCriterion
+
+        group_1 = Group.objects.create(name="g1")
+        group_2 = Group.objects.create(name="g2")
+        is_ = GroupCriterion.create(IS, [group_1.id])
+        is_not = GroupCriterion.create(IS_NOT, [group_1.id])
+
+        self.assertFalse(is_.is_valid(self.request))
+        self.assertTrue(is_not.is_valid(self.request))
+
+        user = User.objects.create(username="u")
+        user.groups.add(group_2)
+        self.request.user = user
+        self.request.__dict__.pop(GROUPS_ATTR, None)
+        self.assertFalse(is_.is_valid(self.request))
+        self.assertNumQueries(0, lambda: is_not.is_valid(self.request))
+
+        # the groups of the user are cached between requests until changed
+        self.request.__dict__.pop(GROUPS_ATTR)
+        self.assertNumQueries(0, lambda: is_.is_valid(self.request))
+        group_1.user_set.add(user)
+        self.request.__dict__.pop(GROUPS_ATTR)
+        self.assertTrue(is_.is_valid(self.request))
+        self.assertFalse(is_not.is_valid(self.request))
+
+        group_1.delete()
+        self.request.__dict__.pop(GROUPS_ATTR)
+        self.assertFalse(is_.is_valid(self.request))
+
+
+class ClockCriteriaTest(CriterionTestCase):
+
+    def test_next_flip(self):
+        import datetime
+        from lfs.criteria.settings import (GREATER_THAN_EQUAL, LESS_THAN,
+                                           LESS_THAN_EQUAL)
+        from lfs_criterion_extra.models import (DateCriterion, TimeCriterion,
+                                                WeekdayCriterion)
+
+        # thursday
+        now = datetime.datetime(2026, 10, 15, 12, 0)
+        time = TimeCriterion(operator=LESS_THAN, time=datetime.time(18, 0))
+        self.assertTrue(time.is_valid_at(now))
+        self.assertEqual(time.get_next_flip(now),
+                         datetime.datetime(2026, 10, 15, 18, 0))
+        self.assertEqual(time.get_next_flip(now.replace(hour=20)),
+                         datetime.datetime(2026, 10, 16, 0, 0))
+
+        time = TimeCriterion(operator=LESS_THAN_EQUAL,
+                             time=datetime.time(18, 0))
+        self.assertEqual(time.get_next_flip(now),
+                         datetime.datetime(2026, 10, 15, 18, 0, 0, 1))
+
+        date = DateCriterion(operator=GREATER_THAN_EQUAL,
+                             date=datetime.date(2026, 11, 1))
+        self.assertFalse(date.is_valid_at(now))
+        self.assertEqual(date.get_next_flip(now),
+                         datetime.datetime(2026, 11, 1))
+        self.assertEqual(date.get_next_flip(datetime.datetime(2026, 11, 2)),
+                         None)
+
+        weekday = WeekdayCriterion(operator=GREATER_THAN_EQUAL, weekday=5)
+        self.assertFalse(weekday.is_valid_at(now))
+        self.assertEqual(weekday.get_next_flip(now),
+                         datetime.datetime(2026, 10, 17))
+
+    def test_schedule(self):
+        import datetime
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.criteria.settings import GREATER_THAN_EQUAL, LESS_THAN
+        from lfs.discounts.models import Discount
+        from lfs_criterion_extra.models import TimeCriterion, WeekdayCriterion
+        from lfs_criterion_extra.plans import get_plan
+        from lfs_criterion_extra.schedule import get_active_objects
+
+        discount = Discount.objects.create(name="d", value=1, type=0)
+        other = Discount.objects.create(name="o", value=1, type=0)
+        c = WeekdayCriterion.objects.create(operator=LESS_THAN, weekday=5)
+        CriteriaObjects.objects.create(content=discount, criterion=c)
+        c = TimeCriterion.objects.create(operator=GREATER_THAN_EQUAL,
+                                         time=datetime.time(9, 0))
+        CriteriaObjects.objects.create(content=discount, criterion=c)
+
+        friday = datetime.datetime(2026, 10, 16, 8, 0)
+        plan = get_plan(discount)
+        self.assertEqual(plan.get_clock_state(friday),
+                         (False, datetime.datetime(2026, 10, 16, 9, 0)))
+        self.assertEqual(plan.get_clock_state(friday.replace(hour=10)),
+                         (True, datetime.datetime(2026, 10, 17)))
+        self.assertEqual(get_plan(other).get_clock_state(friday),
+                         (True, None))
+        self.assertEqual(get_active_objects([discount, other], friday),
+                         [other])
+
+    def test_empty_date_is_reported(self):
+        from django.contrib.auth.models import User
+        from django.core.exceptions import ValidationError
+        from django.core.urlresolvers import reverse
+        from django.utils import simplejson
+        from lfs.criteria.settings import LESS_THAN
+        from lfs.shipping.models import ShippingMethod
+        from lfs_criterion_extra.models import DateCriterion
+
+        self.assertRaises(ValidationError, DateCriterion.clean_value, "")
+
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+
+        sm = ShippingMethod.objects.create(name="sm", active=True)
+        url = reverse("lfs_manage_save_shipping_method_criteria",
+                      args=[sm.id])
+        response = self.client.post(url, {
+            "type-ex123456789": "date",
+            "operator-ex123456789": str(LESS_THAN),
+            "value-ex123456789": "",
+            "position-ex123456789": "10",
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(simplejson.loads(response.content)["message"],
+                         "Date: This field is required.")
+
+    def test_save_criteria(self):
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.criteria.utils import save_criteria
+        from lfs.shipping.models import ShippingMethod
+
+        sm = ShippingMethod.objects.create(name="sm", active=True)
+        category = CategoryCriterion.objects.create(operator=IS)
+        category.categories.add(self.category_1)
+        CriteriaObjects.objects.create(content=sm, criterion=category,
+                                       position=10)
+        amount = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                                    amount=1)
+        CriteriaObjects.objects.create(content=sm, criterion=amount,
+                                       position=20)
+
+        request = RequestFactory().post('/', {
+            "type-ex%s" % category.id: "category",
+            "operator-ex%s" % category.id: str(IS_NOT),
+            "value-ex%s" % category.id: [str(self.category_2.id)],
+            "position-ex%s" % category.id: "20",
+            "type-ex123456789": "max_weight",
+            "operator-ex123456789": str(GREATER_THAN),
+            "value-ex123456789": "7",
+            "position-ex123456789": "10",
+        })
+        save_criteria(request, sm)
+
+        criteria_objects = list(sm.criteria_objects.all())
+        self.assertEqual([co.criterion.content_type
+                          for co in criteria_objects],
+                         ["max_weight", "category"])
+        # the changed criterion is updated in place
+        category = CategoryCriterion.objects.get(pk=category.pk)
+        self.assertEqual(category.operator, IS_NOT)
+        self.assertEqual(category.get_value_ids(),
+                         set([self.category_2.id]))
+        self.assertEqual(criteria_objects[1].criterion_id, category.pk)
+        self.assertFalse(CartAmountCriterion.objects.filter(pk=amount.pk)
+                                                    .exists())
+        self.assertEqual(criteria_objects[0].criterion.max_weight, 7)
+
+    def test_plans_are_dropped_after_commit(self):
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.criteria.utils import save_criteria
+        from lfs.shipping.models import ShippingMethod
+        from django.contrib.contenttypes.models import ContentType
+        from lfs_criterion_extra import monkey
+        from lfs_criterion_extra.plans import (get_plan, get_plan_cache_key,
+                                               get_plan_version)
+
+        sm = ShippingMethod.objects.create(name="sm", active=True)
+        amount = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                                    amount=1)
+        CriteriaObjects.objects.create(content=sm, criterion=amount)
+
+        update_criteria = monkey.update_criteria
+        old_plan = get_plan(sm)
+
+        def concurrent_update_criteria(request, object):
+            update_criteria(request, object)
+            # a concurrent request compiled the old criteria under the
+            # version changed within the transaction
+            cache.set(get_plan_cache_key(
+                          ContentType.objects.get_for_model(sm).id, sm.id,
+                          get_plan_version()), old_plan)
+
+        request = RequestFactory().post('/', {
+            "type-ex123456789": "max_weight",
+            "operator-ex123456789": str(GREATER_THAN),
+            "value-ex123456789": "7",
+            "position-ex123456789": "10",
+        })
+        monkey.update_criteria = concurrent_update_criteria
+        try:
+            save_criteria(request, sm)
+        finally:
+            monkey.update_criteria = update_criteria
+
+        self.assertEqual([evaluator.criterion_type
+                          for evaluator in get_plan(sm).evaluators],
+                         [MaxWeightCriterion])
+
+
+class ValueIdsTest(CriterionTestCase):
+
+    def test_value_ids_are_cached(self):
+        c = ProductCriterion.objects.create(operator=IS)
+        c.products.add(self.product_1)
+
+        c = ProductCriterion.objects.get(pk=c.pk)
+        self.assertEqual(c.get_value_ids(), frozenset([self.product_1.id]))
+
+        c = ProductCriterion.objects.get(pk=c.pk)
+        self.assertNumQueries(0, c.get_value_ids)
+
+    def test_bitmap(self):
+        import pickle
+        from lfs_criterion_extra.bitmaps import IdBitmap, get_id_set
+
+        ids = set(range(1000, 21000, 3))
+        bitmap = get_id_set(ids)
+        self.assertTrue(isinstance(bitmap, IdBitmap))
+        self.assertEqual(bitmap, ids)
+        self.assertEqual(set(bitmap), ids)
+        self.assertTrue(1003 in bitmap)
+        self.assertFalse(1004 in bitmap)
+        self.assertFalse(5 in bitmap)
+        self.assertFalse(bitmap.isdisjoint([1, 1006]))
+        self.assertTrue(bitmap.isdisjoint([1, 1007, 50000]))
+        self.assertEqual(pickle.loads(pickle.dumps(bitmap, 2)), bitmap)
+        self.assertTrue(len(pickle.dumps(bitmap, 2)) < 1000)
+
+        # sparse ids are kept in a frozenset
+        self.assertEqual(type(get_id_set([1, 10 ** 9])), frozenset)
+
+        c = ProductCriterion.objects.create(operator=IS)
+        c.products.add(self.product_1, self.product_2)
+        c = ProductCriterion.objects.get(pk=c.pk)
+        self.assertTrue(isinstance(c.get_value_ids(), IdBitmap))
+        self.assertTrue(c.is_valid(self.request))
+        self.assertFalse(c.is_valid(self.request, self.product_3))
+
+    def test_value_ids_are_dropped_on_change(self):
+        c = ProductCriterion.objects.create(operator=IS)
+        c.products.add(self.product_1)
+        self.assertTrue(c.is_valid(self.request, self.product_1))
+
+        c.products.add(self.product_3)
+        self.assertTrue(c.is_valid(self.request, self.product_3))
+
+        self.product_3.productcriterion_set.remove(c)
+        c = ProductCriterion.objects.get(pk=c.pk)
+        self.assertFalse(c.is_valid(self.request, self.product_3))
+
+        self.product_1.productcriterion_set.clear()
+        c = ProductCriterion.objects.get(pk=c.pk)
+        self.assertFalse(c.is_valid(self.request, self.product_1))
+
+
+class SubcategoriesTest(CriterionTestCase):
+
+    def test_subcategories(self):
+        root = Category.objects.create(name="root", slug="root")
+        self.category_1.parent = root
+        self.category_1.save()
+
+        c = CategoryCriterion.objects.create(operator=IS_WITH_SUBCATEGORIES)
+        c.categories.add(root)
+        self.assertTrue(c.is_valid(self.request))
+        self.assertTrue(c.is_valid(self.request, self.product_1))
+        self.assertFalse(c.is_valid(self.request, self.product_2))
+
+        c.operator = IS_NOT_WITH_SUBCATEGORIES
+        self.assertFalse(c.is_valid(self.request, self.product_1))
+
+        c.operator = IS
+        self.assertFalse(c.is_valid(self.request))
+
+    def test_tree_is_rebuilt_on_save(self):
+        root = Category.objects.create(name="root", slug="root")
+        c = CategoryCriterion.objects.create(operator=IS_WITH_SUBCATEGORIES)
+        c.categories.add(root)
+        self.assertFalse(c.is_valid(self.request, self.product_2))
+
+        self.category_2.parent = root
+        self.category_2.save()
+        self.assertTrue(c.is_valid(self.request, self.product_2))
+
+
+class OrderStatisticsTest(CriterionTestCase):
+
+    def test_statistics(self):
+        from lfs.order.models import Order, OrderItem
+        from lfs.order.settings import CLOSED, SUBMITTED
+        from lfs_criterion_extra.models import (OrderCountCriterion,
+                                                OrderStatistics,
+                                                OrderSummCriterion)
+
+        session = self.request.session.session_key
+        order = Order.objects.create(session=session, price=10.)
+        OrderItem.objects.create(order=order, product=self.product_1)
+        other = Order.objects.create(session=session, price=5.,
+                                     state=CLOSED)
+
+        order.state = CLOSED
+        order.save()
+
+        count = OrderCountCriterion.objects.create(operator=GREATER_THAN,
+                                                   order_count=1)
+        summ = OrderSummCriterion.objects.create(operator=GREATER_THAN,
+                                                 order_summ=14)
+        self.assertTrue(count.is_valid(self.request))
+        self.assertTrue(summ.is_valid(self.request))
+        del self.request._criterion_order_statistics
+        self.assertFalse(count.is_valid(self.request, self.product_1))
+        self.assertFalse(summ.is_valid(self.request, self.product_1))
+
+        statistics = lambda: sorted(OrderStatistics.objects.values_list(
+                                        'product', 'order_count', 'order_summ'))
+        self.assertEqual(statistics(),
+                         [(None, 2, 15.), (self.product_1.id, 1, 10.)])
+
+        order.state = SUBMITTED
+        order.save()
+        other.delete()
+        self.assertEqual(statistics(),
+                         [(None, 0, 0.), (self.product_1.id, 0, 0.)])
+
+        order.state = CLOSED
+        order.save()
+        OrderStatistics.objects.rebuild()
+        self.assertEqual(statistics(),
+                         [(None, 1, 10.), (self.product_1.id, 1, 10.)])
+
+    def test_items_of_closed_order(self):
+        from lfs.order.models import Order, OrderItem
+        from lfs.order.settings import CLOSED
+        from lfs_criterion_extra.models import OrderStatistics
+
+        # the order is saved as closed before its items
+        order = Order.objects.create(session=self.request.session.session_key,
+                                     price=10., state=CLOSED)
+        OrderItem.objects.create(order=order, product=self.product_1)
+        OrderItem.objects.create(order=order, product=self.product_1)
+
+        statistics = sorted(OrderStatistics.objects.values_list(
+                                'product', 'order_count', 'order_summ'))
+        self.assertEqual(statistics,
+                         [(None, 1, 10.), (self.product_1.id, 1, 10.)])
+
+        order.delete()
+        statistics = sorted(OrderStatistics.objects.values_list(
+                                'product', 'order_count', 'order_summ'))
+        self.assertEqual(statistics,
+                         [(None, 0, 0.), (self.product_1.id, 0, 0.)])
+
+    def test_duplicate_statistics(self):
+        from lfs.order.models import Order, OrderItem
+        from lfs.order.settings import CLOSED
+        from lfs_criterion_extra.models import (OrderCountCriterion,
+                                                OrderStatistics)
+
+        # rows of concurrent orders of an anonymous customer
+        session = self.request.session.session_key
+        for product in [None, self.product_1, self.product_1]:
+            OrderStatistics.objects.create(session=session, product=product,
+                                           order_count=1, order_summ=5.)
+        OrderStatistics.objects.create(session=session, order_count=1,
+                                       order_summ=5.)
+
+        order = Order.objects.create(session=session, price=10.)
+        OrderItem.objects.create(order=order, product=self.product_1)
+        order.state = CLOSED
+        order.save()
+
+        count = OrderCountCriterion.objects.create(operator=GREATER_THAN,
+                                                   order_count=2)
+        self.assertTrue(count.is_valid(self.request))
+        self.assertTrue(count.is_valid(self.request, self.product_1))
+        del self.request._criterion_order_statistics
+        self.assertEqual(count.is_valid_many(self.request, [self.product_1]),
+                         {self.product_1.id: True})
+
+        statistics = OrderStatistics.objects.get_for_request(self.request)
+        self.assertEqual((statistics.order_count, statistics.order_summ),
+                         (3, 20.))
+        statistics = OrderStatistics.objects.get_for_request(self.request,
+                                                             self.product_1)
+        self.assertEqual((statistics.order_count, statistics.order_summ),
+                         (3, 20.))
+
+
+class ProfitCriterionTest(CriterionTestCase):
+    """The ``localproduct`` of the products with the distributor prices
+    belongs to the shop, it is faked here.
+    """
+
+    def setUp(self):
+        super(ProfitCriterionTest, self).setUp()
+        test = self
+        self.prices = {self.product_1.id: 10., self.product_2.id: 20.,
+                       self.product_3.id: 5.}
+        self.distributor_prices = {self.product_1.id: 7.,
+                                   self.product_2.id: 15.,
+                                   self.product_3.id: 5.}
+        # product ids of the loaded local products per query
+        self.queries = []
+
+        class LocalProduct(object):
+            def __init__(self, product_id):
+                self.product_id = product_id
+
+            def get_best_distributor_price(self):
+                return test.distributor_prices[self.product_id]
+
+        class LocalProductManager(object):
+            def filter(self, product__in):
+                test.queries.append(sorted(product__in))
+                return [LocalProduct(id) for id in product__in]
+
+        class Field(object):
+            name = 'product'
+            attname = 'product_id'
+
+        class Related(object):
+            field = Field()
+            model = type('LocalProduct', (), {
+                'objects': LocalProductManager()})
+
+            def get_cache_name(self):
+                return '_localproduct_cache'
+
+        get_field_by_name = Product._meta.get_field_by_name
+        self.get_price = Product.__dict__['get_price']
+        Product._meta.get_field_by_name = lambda name: (
+            (Related(), None, False, False) if name == 'localproduct'
+            else get_field_by_name(name))
+        Product.get_price = lambda product, *args: test.prices[product.id]
+        Product.localproduct = property(
+            lambda product: product._localproduct_cache)
+
+    def tearDown(self):
+        del Product._meta.get_field_by_name
+        Product.get_price = self.get_price
+        del Product.localproduct
+        super(ProfitCriterionTest, self).tearDown()
+
+    def test_cart_profit(self):
+        from lfs.criteria.settings import LESS_THAN
+        from lfs_criterion_extra.models import ProfitCriterion
+
+        # (10 - 7) * 2 + (20 - 15) * 3
+        c = ProfitCriterion.objects.create(operator=GREATER_THAN, profit=20)
+        self.assertTrue(c.is_valid(self.request))
+        self.assertEqual(get_cart_snapshot(self.request).memo['profit'], 21.)
+
+        # the profit is computed once per snapshot
+        c = ProfitCriterion.objects.create(operator=LESS_THAN, profit=21)
+        self.assertFalse(c.is_valid(self.request))
+        self.assertEqual(len(self.queries), 1)
+
+    def test_product_profit(self):
+        from lfs_criterion_extra.models import ProfitCriterion
+
+        c = ProfitCriterion.objects.create(operator=GREATER_THAN, profit=4)
+        self.assertFalse(c.is_valid(self.request, self.product_1))
+        self.assertTrue(c.is_valid(self.request, self.product_2))
+
+        # local products of all products are loaded with one query
+        self.queries = []
+        products = list(Product.objects.order_by('id'))
+        self.assertEqual(c.is_valid_many(self.request, products),
+                         {self.product_1.id: False,
+                          self.product_2.id: True,
+                          self.product_3.id: False})
+        self.assertEqual(self.queries,
+                         [sorted(product.id for product in products)])
+
+
+class CompositionTest(CriterionTestCase):
+
+    def test_composition(self):
+        from lfs_criterion_extra.models import (CompositionCategory,
+                                                OrderCompositionCriterion)
+
+        c = OrderCompositionCriterion.objects.create(operator=IS)
+        CompositionCategory.objects.create(criterion=c,
+                                           category=self.category_1,
+                                           amount=2)
+        CompositionCategory.objects.create(criterion=c,
+                                           category=self.category_2,
+                                           amount=3)
+        self.assertTrue(c.is_valid(self.request))
+
+        CompositionCategory.objects.create(criterion=c,
+                                           category=self.category_2,
+                                           amount=4)
+        c = OrderCompositionCriterion.objects.get(pk=c.pk)
+        self.assertFalse(c.is_valid(self.request))
+
+
+class DiscountCriterionTest(CriterionTestCase):
+
+    def setUp(self):
+        super(DiscountCriterionTest, self).setUp()
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.discounts.models import Discount
+        from lfs_criterion_extra.models import DiscountCriterion
+
+        self.discount_1 = Discount.objects.create(name="d1", value=1)
+        self.discount_2 = Discount.objects.create(name="d2", value=1)
+        self.discount_3 = Discount.objects.create(name="d3", value=1)
+
+        # d1 is valid if d2 is valid, d2 is valid if d3 is not valid
+        c = DiscountCriterion.objects.create(operator=IS_VALID)
+        c.discounts.add(self.discount_2)
+        CriteriaObjects.objects.create(content=self.discount_1, criterion=c)
+        c = DiscountCriterion.objects.create(operator=IS_NOT_VALID)
+        c.discounts.add(self.discount_3)
+        CriteriaObjects.objects.create(content=self.discount_2, criterion=c)
+        c = CartAmountCriterion.objects.create(operator=GREATER_THAN,
+                                               amount=100)
+        CriteriaObjects.objects.create(content=self.discount_3, criterion=c)
+
+    def test_sort_discounts(self):
+        from lfs_criterion_extra.discounts import sort_discounts
+        self.assertEqual(sort_discounts([self.discount_1, self.discount_2,
+                                         self.discount_3]),
+                         [self.discount_3, self.discount_2, self.discount_1])
+
+    def test_valid_discounts(self):
+        from lfs.discounts.utils import get_valid_discounts
+        discounts = get_valid_discounts(self.request)
+        self.assertEqual([d["id"] for d in discounts],
+                         [self.discount_1.id, self.discount_2.id])
+
+    def test_cycle_is_rejected(self):
+        from django.core.exceptions import ValidationError
+        from lfs_criterion_extra.discounts import check_discount_dependencies
+        check_discount_dependencies(self.discount_3, [])
+        self.assertRaises(ValidationError, check_discount_dependencies,
+                          self.discount_3, [self.discount_1.id])
+
+    def test_cycle_is_not_saved(self):
+        from django.contrib.auth.models import User
+        from django.core.urlresolvers import reverse
+        from django.utils import simplejson
+
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+
+        url = reverse("lfs_manage_save_discount_criteria",
+                      args=[self.discount_3.id])
+        response = self.client.post(url, {
+            "type-1": "discounts",
+            "operator-1": IS_VALID,
+            "value-1": [self.discount_1.id],
+            "position-1": 10,
+        })
+        self.assertEqual(response.status_code, 200)
+        message = simplejson.loads(response.content)["message"]
+        self.assertTrue(message.startswith("Discount criteria have a cycle"))
+        self.assertEqual(
+            [co.criterion_type.model for co in
+             self.discount_3.criteria_objects.all()],
+            ["cartamountcriterion"])
+
+
+class CriterionValuesTest(CriterionTestCase):
+
+    def test_criterion_values(self):
+        from django.contrib.auth.models import User
+        from django.core.urlresolvers import reverse
+        from django.utils import simplejson
+
+        User.objects.create_superuser("admin", "admin@example.com", "admin")
+        self.client.login(username="admin", password="admin")
+
+        url = reverse("lfs_criterion_values")
+        response = self.client.get(url, {"type": "product", "term": "p"})
+        self.assertEqual(simplejson.loads(response.content), {
+            "values": [[self.product_1.id, "p1"],
+                       [self.product_2.id, "p2"],
+                       [self.product_3.id, "p3"]],
+            "has_next": False,
+        })
+
+        response = self.client.get(url, {"type": "full_user", "term": "adm"})
+        self.assertEqual(len(simplejson.loads(response.content)["values"]), 1)
+
+        response = self.client.get(url, {"type": "amount"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_as_html_renders_selected_values(self):
+        c = ProductCriterion.objects.create(operator=IS)
+        c.products.add(self.product_2)
+        html = c.as_html(self.request, 1)
+        self.assertTrue('value="%s" selected' % self.product_2.id in html)
+        self.assertFalse('>p1<' in html)
+
+
+class CriterionTypesTest(CriterionTestCase):
+
+    def test_items(self):
+        from lfs_criterion_extra.models import CriterionRegistrator
+        items = CriterionRegistrator.items()
+        self.assertEqual([item.id for item in items],
+                         sorted(CriterionRegistrator.types.keys()))
+        self.assertTrue(items is CriterionRegistrator.items())
+
+    def test_selected_type(self):
+        c = CategoryCriterion.objects.create(operator=IS)
+        html = c.as_html(self.request, 1)
+        self.assertTrue('<option value="category" selected="selected">'
+                        in html)
+        self.assertTrue('<option value="product">' in html)
+
+
+class RenderingTest(CriterionTestCase):
+
+    def test_render_criteria(self):
+        from django.contrib.auth.models import Group
+        from django.db import connection
+        from lfs.criteria.models import CriteriaObjects
+        from lfs.shipping.models import ShippingMethod
+        from lfs_criterion_extra.models import GroupCriterion
+        from lfs_criterion_extra.rendering import render_criteria
+
+        Group.objects.create(name="g1")
+        sm = ShippingMethod.objects.create(name="sm")
+        for position in range(3):
+            c = CategoryCriterion.objects.create(operator=IS)
+            c.categories.add(self.category_2)
+            CriteriaObjects.objects.create(content=sm, criterion=c,
+                                           position=position)
+            c = GroupCriterion.objects.create(operator=IS)
+            CriteriaObjects.objects.create(content=sm, criterion=c,
+                                           position=position)
+            c = ProductCriterion.objects.create(operator=IS)
+            c.products.add(self.product_1)
+            CriteriaObjects.objects.create(content=sm, criterion=c,
+                                           position=position)
+
+        def count_queries(func):
+            use_debug_cursor = connection.use_debug_cursor
+            connection.use_debug_cursor = True
+            queries = len(connection.queries)
+            try:
+                return func(), len(connection.queries) - queries
+            finally:
+                connection.use_debug_cursor = use_debug_cursor
+
+        cache.clear()
+        rows, queries = count_queries(lambda: [
+            co.criterion.as_html(self.request, (i + 1) * 10)
+            for i, co in enumerate(sm.criteria_objects.all())])
+        cache.clear()
+        batch_rows, batch_queries = count_queries(
+            lambda: render_criteria(self.request, sm))
+
+        self.assertEqual(batch_rows, rows)
+        self.assertEqual(len(rows), 9)
+        self.assertTrue(batch_queries < queries)
+
+
+class InstrumentationTest(CriterionTestCase):
+
+    def test_instrumentation(self):
+        from StringIO import StringIO
+        from django.core.management import call_command
+        from lfs.criteria.models import WeightCriterion
+        from lfs_criterion_extra import instrumentation
+
+        sink = instrumentation.CacheSink()
+        sinks = instrumentation._sinks[:]
+        instrumentation._sinks[:] = [sink]
+        instrumentation.instrument(CategoryCriterion)
+        try:
+            c = CategoryCriterion.objects.create(operator=IS)
+            c.categories.add(self.category_1)
+            c = CategoryCriterion.objects.get(pk=c.pk)
+            self.assertTrue(c.is_valid(self.request))
+            self.assertTrue(c.is_valid(self.request))
+        finally:
+            instrumentation.uninstrument(CategoryCriterion)
+            instrumentation._sinks[:] = sinks
+
+        # criteria of lfs have no is_valid_many
+        instrumentation.instrument(WeightCriterion)
+        instrumentation.uninstrument(WeightCriterion)
+        self.assertFalse(hasattr(WeightCriterion, 'is_valid_many'))
+
+        histogram = sink.histograms[("category", c.id, "is_valid")]
+        self.assertEqual(histogram.calls, 2)
+        self.assertTrue(histogram.queries > 0)
+        # value ids are read from the database once
+        self.assertEqual((histogram.cache_hits, histogram.cache_misses),
+                         (1, 1))
+
+        sink.flush()
+        output = StringIO()
+        call_command('criterion_offenders', stdout=output, reset=True)
+        self.assertTrue("category" in output.getvalue())
+        self.assertEqual(instrumentation.get_cached_histograms(), {})
+
+
+class BenchmarkTest(TestCase):
+
+    def test_command(self):
+        import os
+        import tempfile
+        from django.core.management import call_command
+        from django.db import connection
+        from django.utils import simplejson
 
+        # the catalog is seeded into the database of the test
+        creation = connection.creation
+        creation.create_test_db = lambda *args, **kwargs: None
+        creation.destroy_test_db = lambda *args, **kwargs: None
+        fd, output = tempfile.mkstemp(suffix=".json")
+        os.close(fd)
+        try:
+            call_command("criterion_benchmark", products=20, cart_sizes="1",
+                         iterations=1, customers=2, orders=5,
+                         interactive=False, output=output)
+            f = open(output)
+            try:
+                result = simplejson.load(f)
+            finally:
+                f.close()
+        finally:
+            del creation.create_test_db
+            del creation.destroy_test_db
+            os.remove(output)
 
-class SimpleTest(TestCase):
-    def test_basic_addition(self):
-        """
-        Tests that 1 + 1 always equals 2.
-        """
-        self.assertEqual(1 + 1, 2)
+        self.assertEqual(result["meta"]["products"], 20)
+        self.assertEqual(result["meta"]["cart_sizes"], [1])
+        self.assertEqual(set(r["name"] for r in result["results"]),
+                         set(["is_valid", "as_html", "render_criteria",
+                              "save_criteria"]))
+        for r in result["results"]:
+            if "error" in r:
+                # the profit needs the local products of the shop
+                self.assertEqual(r["criterion"], "profit")
+                continue
+            self.assertEqual(r["iterations"], 1)
+            for key in ("p50_ms", "p90_ms", "p99_ms", "max_ms",
+                        "mean_queries", "max_queries"):
+                self.assertTrue(r[key] >= 0)
@@ -0,0 +1,7 @@
+from django.conf.urls.defaults import patterns, url
+
+
+urlpatterns = patterns('lfs_criterion_extra.monkey',
+    url(r'^criterion-values$', "criterion_values",
+        name="lfs_criterion_values"),
+)